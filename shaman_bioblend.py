@@ -12,7 +12,8 @@
 #    http://www.gnu.org/licenses/gpl-3.0.html
 from bioblend.galaxy import GalaxyInstance
 import bioblend
-from threading import Thread
+from threading import Thread, Event, Lock, current_thread, main_thread
+from threading import enumerate as list_threads
 # python-daemon package
 import daemon
 import logging
@@ -23,7 +24,19 @@ import os
 import sys
 import argparse
 import json
+import hashlib
 import glob
+import queue
+import itertools
+import functools
+import random
+import gzip
+import collections
+import concurrent.futures
+import struct
+import array
+import traceback
+import zlib
 import shutil
 import smtplib
 from email.mime.multipart import MIMEMultipart
@@ -31,12 +44,59 @@ from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 import requests
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import socketserver
+# Optional packages for the columnar export and the summaries
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import scipy.sparse
+    import scipy.special
+except ImportError:
+    scipy = None
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
 #import keyring
-#import tarfile
+import tarfile
+import re
 import zipfile
 import lockfile
 import datetime
 import socket
+import signal
+import uuid
+
+# Workflow steps that do not run a galaxy job
+input_step_types = ["data_input", "data_collection_input", "parameter_input"]
+# Galaxy job and invocation states
+done_job_states = ["ok", "skipped"]
+failed_job_states = ["error", "failed", "deleted", "deleting", "paused"]
+failed_invocation_states = ["failed", "cancelled", "cancelling"]
+# Task parameters that can change between the runs of a sweep
+sweep_parameters = ["aKmin", "aPmin", "aPmax", "aCmin", "aCmax", "aOmin",
+                    "aOmax", "aFmin", "aFmax", "aGmin", "aGmax", "aSmin",
+                    "annotationstrand", "clusteringthreshold",
+                    "clusteringstrand", "phredthres", "mincorrect",
+                    "minreadlength", "dreptype", "minampliconlength",
+                    "maxampliconlength", "minabundance"]
+# Galaxy hash names
+hash_functions = {"MD5": "md5", "SHA-1": "sha1", "SHA-256": "sha256",
+                  "SHA-512": "sha512"}
+# Other task parameters that change the result
+cache_parameters = ["host", "type", "paired", "pattern_R1", "sweep"]
+# Fields of a task not copied to its preview
+preview_excluded = ["name", "data_history_name", "result_history_name",
+                    "workflow_id", "invocation_id", "runs", "batch",
+                    "batch_size", "preview"]
+# Options read once by the daemon, a reload cannot change them
+fixed_options = ["work_dir", "interactive_mode", "cache_size", "api_port",
+                 "api_socket", "lease_time", "compress_threads",
+                 "profile_rate", "janitor", "input_root"]
 
 class FullPaths(argparse.Action):
     """Expand user- and relative-paths"""
@@ -64,11 +124,16 @@ class FullPaths(argparse.Action):
 class galaxy(Thread):
 
     def __init__(self, logger, task_file, doing_dir, done_dir, error_dir,
-                 galaxy_url, galaxy_key, num_job, https_mode, delete_mode):
+                 galaxy_url, galaxy_key, num_job, https_mode, delete_mode,
+                 options, board=None, cache=None, janitor=None,
+                 admission=None, model=None, leases=None, limiter=None,
+                 share=None, batches=None, compressor=None):
         Thread.__init__(self)
         self.logger = logger
         self.galaxy_url = galaxy_url
         self.galaxy_key = galaxy_key
+        self.limiter = limiter
+        self.share = share
         self.logger.info("Starting galaxy instance for {0} : {1}".format(
                     galaxy_url, galaxy_key))
         self.gi = GalaxyInstance(url=galaxy_url, key=galaxy_key)
@@ -76,6 +141,8 @@ class galaxy(Thread):
         self.logger.info("Connection obtained for {0} : {1}".format(
                     galaxy_url, galaxy_key))
         self.gi.verify = https_mode
+        if limiter:
+            self.gi = limited_galaxy(self.gi, limiter)
         self.task_file = task_file
         self.doing_dir = doing_dir
         self.done_dir = done_dir
@@ -83,6 +150,45 @@ class galaxy(Thread):
         self.num_job = num_job
         self.dataset_ids = []
         self.delete_mode = delete_mode
+        self.options = options
+        self.list_result = {}
+        self.list_downloaded_files = []
+        self.lib = None
+        self.data_history = None
+        self.workflow = None
+        self.dataset_map = None
+        self.watcher = None
+        self.runs = []
+        self.tool_steps = 0
+        self.lock = Lock()
+        self.board = board
+        self.progress = None
+        self.cache = cache
+        self.cache_key_value = None
+        self.cached_file = None
+        self.janitor = janitor
+        self.admission = admission
+        self.model = model
+        self.leases = leases
+        self.resumed = False
+        self.arrival = time.time()
+        self.start_time = None
+        self.features = None
+        self.priority = 0.0
+        self.phase = None
+        self.phase_start = None
+        self.cancelled = Event()
+        self.cancel_reason = None
+        self.cancel_mail = False
+        self.cancel_cleanup = True
+        self.aborted = False
+        self.abort_lock = Lock()
+        self.batches = batches
+        self.batch = None
+        self.compressor = compressor
+        self.previewer = None
+        # Deleted with -d when the job can no longer upload them again
+        self.sent_reads = []
 
     def load_json(self):
         """Load and validate Json
@@ -92,52 +198,9 @@ class galaxy(Thread):
             try:
                 with open(self.task_file, "rt") as task:
                     data_task = json.load(task)
-                    if isinstance(data_task, (list, tuple)):
-                        data_task = data_task[0]
-                    data_task["name"] = os.path.splitext(os.path.basename(self.task_file))[0]
-                    if "paired" not in data_task:
-                        raise ValueError("Paired information is missing in {0}".format(self.task_file))
-                    isinstance(data_task["paired"], bool)
-                    if data_task["paired"]:
-                        for pair in ["path_R1", "path_R2"]:
-                            if pair not in data_task:
-                                raise ValueError(
-                                    pair + " information is missing in {0}".format(self.task_file))
-                            if not os.path.isdir(data_task[pair]):
-                                raise ValueError(
-                                    pair + " is not a file in {0}".format(self.task_file))
-                            if "pattern_R1" not in data_task:
-                                raise ValueError(
-                                "pattern_R1 information is missing in {0}".format(self.task_file))
-                    else:
-                        if "path" not in data_task:
-                            raise ValueError(
-                                "path information is missing in {0}".format(self.task_file))
-                        if not os.path.isdir(data_task["path"]):
-                            raise ValueError(
-                                "path information is not a directory for {0}".format(self.task_file))
-                    if "contaminant" not in data_task:
-                        raise ValueError(
-                            "path information is missing in {0}".format(self.task_file))
-                    if not os.path.isfile(data_task["contaminant"]):        
-                        raise ValueError(
-                            "contaminant information is not a file for {0}".format(self.task_file))
-                    if "host" not in data_task:
-                        raise ValueError("host information is missing in {0}".format(self.task_file))
-                    if "type" not in data_task:
-                        raise ValueError("type information is missing in {0}".format(self.task_file))
-                    if data_task["type"] not in ["16S", "18S", "23S_28S",
-                                                 "ITS", "WGS"]:
-                        raise ValueError("type information is incorrect in {0}".format(self.task_file))
-                    if "mail" not in data_task:
-                        raise ValueError(
-                                "mail information is missing in {0}".format(self.task_file))
-                    assert(len(data_task) > 0)
-                    data_task_ok = data_task
+                    data_task_ok = validate_task(data_task, self.task_file)
             except IOError as err:
                 err.extra_info("Error cannot open {0}".format(self.task_file)) 
-            except AssertionError as err:
-                err.extra_info("Json {0} is empty".format(self.task_file))
             #except TypeError as err:
             #    err.extra_info("Check information format in {0}".format(self.task_file))
         except Exception as e: 
@@ -152,21 +215,29 @@ class galaxy(Thread):
         """Dump json file with galaxy info
         """
         todo_file = self.doing_dir + os.path.basename(self.task_file)
-        os.remove(self.task_file)  
+        # Never in todo and doing at the same time
+        os.rename(self.task_file, todo_file)
+        self.task_file = todo_file
+        self.save_task()
+
+
+    def save_task(self):
+        """Update the task in doing with the galaxy state
+          Returns: False when the task cannot be written
+        """
         try:
-            with open(todo_file, "wt") as task:
-                json.dump(self.data_task, task)
+            write_atomic(self.task_file, json.dumps(self.data_task))
         except IOError:
             self.logger.error("Failed to write {0}".format(self.task_file))
-        self.task_file = todo_file
-
+            return False
+        return True
 
     def check_file_size(self, path):
-        """Check if no file above 2Gb
+        """Check if no file above the large file size
         """
         large_file_size = False
         for file in glob.glob('{0}/*.f*q*'.format(path)):
-            if os.path.getsize(file) > 2000000000:
+            if os.path.getsize(file) > self.options["large_file"]:
                 large_file_size = True
         return large_file_size
 
@@ -177,6 +248,13 @@ class galaxy(Thread):
                                    'element_identifiers': [],
                                    'name': "collection_{0}".format(str(os.getpid()))}
         for i,fastq_file in enumerate(sorted(glob.glob('{0}/*.f*q*'.format(path)))):
+            if self.cancelled.is_set():
+                raise RuntimeError("Upload cancelled")
+            # Bioblend sends the whole file, its bytes are counted first,
+            # only for the large files of a library with a bandwidth limit
+            if self.share:
+                self.share.consume(self.data_task["mail"],
+                                   os.path.getsize(fastq_file))
             retry = 0
             send_is_ok = False
             while not send_is_ok and retry <= 5 :
@@ -207,58 +285,134 @@ class galaxy(Thread):
                     print("retry")
                     time.sleep(5)
                     retry += 1 
+            self.progress.add_bytes(os.path.getsize(fastq_file))
             # Add dataset in the collection
             collection_description['element_identifiers'].append(
                 {'id': dataset['outputs'][0]["id"],
                 'name': "element {0}".format(i),
                 'src': 'hda'})
             if self.delete_mode:
-                os.remove(fastq_file)
+                self.sent_reads.append(fastq_file)
         return collection_description#, i
 
+    def fetch_collections(self, history_id, list_path):
+        """Send the fastq of each path as a list collection in one request
+        """
+        targets = []
+        list_fastq = []
+        for path in list_path:
+            elements = []
+            for i,fastq_file in enumerate(sorted(glob.glob('{0}/*.f*q*'.format(path)))):
+                # Raw fastq are gzipped on the fly by the compressor
+                if fastq_file.endswith(".gz") or self.compressor:
+                    ext = "fastq.gz"
+                else:
+                    ext = "auto"
+                elements.append({'src': 'files', 'name': "element {0}".format(i),
+                                 'ext': ext})
+                list_fastq.append(fastq_file)
+            targets.append({'destination': {'type': 'hdca'},
+                            'collection_type': 'list',
+                            'name': "collection_{0}".format(str(os.getpid())),
+                            'elements': elements})
+        fields = [('history_id', history_id),
+                  ('targets', json.dumps(targets))]
+        files = [("files_{0}|file_data".format(i), fastq_file)
+                 for i,fastq_file in enumerate(list_fastq)]
+        sent_bytes = self.progress.sent_bytes
+        retry = 0
+        while True:
+            if self.cancelled.is_set():
+                raise RuntimeError("Upload cancelled")
+            # The body is a stream, read again from the start
+            body = multipart_body(fields, files, self.progress,
+                                  share=self.share,
+                                  mail=self.data_task["mail"],
+                                  compressor=self.compressor)
+            post = requests.post
+            if self.limiter:
+                self.limiter.acquire("upload")
+                post = functools.partial(self.limiter.timed, "tools.fetch",
+                                         requests.post)
+            try:
+                response = post(
+                    self.galaxy_url.rstrip("/") + "/api/tools/fetch",
+                    params={'key': self.galaxy_key}, data=body,
+                    headers={'Content-Type': body.content_type()},
+                    verify=self.gi.verify)
+                response.raise_for_status()
+                break
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.HTTPError):
+                # A request refused by galaxy would be refused again
+                failed = getattr(sys.exc_info()[1], "response", None)
+                if retry >= 5 or (failed is not None and
+                                  failed.status_code < 500):
+                    raise
+                # The message of requests holds the url with the key
+                self.logger.warning("Retry to send the reads of {0}: {1}"
+                                    .format(self.data_task["name"],
+                                            failed.status_code if failed
+                                            is not None else
+                                            type(sys.exc_info()[1]).__name__))
+                time.sleep(5 * 2 ** retry)
+                retry += 1
+                self.progress.sent_bytes = sent_bytes
+        collections = response.json()['output_collections']
+        if self.delete_mode:
+            self.sent_reads += list_fastq
+        return collections
+
+    def streamed(self, lib=None):
+        """Check if the reads go in one fetch request, the only upload
+        compressed on the fly and metered as it is sent
+        """
+        return not lib and (self.options["fetch_mode"] or
+                            self.compressor is not None or
+                            (self.share is not None and
+                             self.share.bandwidth > 0))
+
     def paired_process(self, history, lib=None):
         """
         """
         dataset_map = {}
         # Upload data
-        fasta_dataset = self.gi.tools.upload_file(
-            self.data_task["contaminant"], history['id'])
-        # Upload fastq
-        # , count_r1
-        collection_description_R1 = self.send_fastq(
-            history['id'], self.data_task["path_R1"], lib)
-        # , count_r2
-        collection_description_R2 = self.send_fastq(
-            history['id'], self.data_task["path_R2"], lib)
-        # Create collection
-        collection_R1 = self.gi.histories.create_dataset_collection(
-            history['id'], collection_description_R1)
-        collection_R2 = self.gi.histories.create_dataset_collection(
-            history['id'], collection_description_R2)
-        # Get the workflow
-        if self.data_task['host'] != "":
-            workflow = self.gi.workflows.get_workflows(
-                name="masque_paired_end_" + self.data_task["type"])
+        fasta_dataset = self.send_contaminant(history)
+        if self.streamed(lib):
+            # Upload fastq and create collections at once
+            collection_R1, collection_R2 = self.fetch_collections(
+                history['id'], [self.data_task["path_R1"],
+                                self.data_task["path_R2"]])
         else:
-            workflow = self.gi.workflows.get_workflows(
-                name="masque_paired_end_" + self.data_task["type"]
-                + "_short")
+            # Upload fastq
+            # , count_r1
+            collection_description_R1 = self.send_fastq(
+                history['id'], self.data_task["path_R1"], lib)
+            # , count_r2
+            collection_description_R2 = self.send_fastq(
+                history['id'], self.data_task["path_R2"], lib)
+            # Create collection
+            collection_R1 = self.gi.histories.create_dataset_collection(
+                history['id'], collection_description_R1)
+            collection_R2 = self.gi.histories.create_dataset_collection(
+                history['id'], collection_description_R2)
+        # Get the workflow
+        workflow = self.get_workflow()
 
         #detailworkflow = self.gi.workflows.show_workflow(
         #    workflow[0]['id'])
         # Get fastq input
-        input_collection_R1 = self.gi.workflows.get_workflow_inputs(
-            workflow[0]['id'], label='reads_dataset_collection_R1')[0]
-        input_collection_R2 = self.gi.workflows.get_workflow_inputs(
-            workflow[0]['id'], label='reads_dataset_collection_R2')[0]
+        input_collection_R1 = self.workflow_input(
+            workflow, 'reads_dataset_collection_R1')
+        input_collection_R2 = self.workflow_input(
+            workflow, 'reads_dataset_collection_R2')
         # Dataset input
         dataset_map[input_collection_R1] = {'id':collection_R1['id'],
                                             'src':'hdca'}
         dataset_map[input_collection_R2] = {'id':collection_R2['id'],
                                             'src':'hdca'}
         # Get contaminant input                                                 
-        input_fasta = self.gi.workflows.get_workflow_inputs(
-            workflow[0]['id'], label='contaminant_dataset')[0]
+        input_fasta = self.workflow_input(workflow, 'contaminant_dataset')
         # Dataset input
         dataset_map[input_fasta] = {'id':fasta_dataset['outputs'][0]['id'],
                                     'src':'hda'}
@@ -269,80 +423,366 @@ class galaxy(Thread):
         """
         dataset_map = {}
         # Upload data
-        fasta_dataset = self.gi.tools.upload_file(
-            self.data_task["contaminant"], history['id'])
-        # Upload fastq
-        #, count_fastq
-        collection_description = self.send_fastq(history['id'],
-                                                 self.data_task["path"],
-                                                 lib)
-        # Create collection
-        collection = self.gi.histories.create_dataset_collection(
-            history['id'], collection_description)
-        # Get the workflow
-        if self.data_task['host'] != "":
-            workflow = self.gi.workflows.get_workflows(
-                name="masque_single_end_" + self.data_task["type"])
+        fasta_dataset = self.send_contaminant(history)
+        if self.streamed(lib):
+            # Upload fastq and create the collection at once
+            collection = self.fetch_collections(history['id'],
+                                                [self.data_task["path"]])[0]
         else:
-            workflow = self.gi.workflows.get_workflows(
-                name="masque_single_end_" + self.data_task["type"]
-                + "_short")
+            # Upload fastq
+            #, count_fastq
+            collection_description = self.send_fastq(history['id'],
+                                                     self.data_task["path"],
+                                                     lib)
+            # Create collection
+            collection = self.gi.histories.create_dataset_collection(
+                history['id'], collection_description)
+        # Get the workflow
+        workflow = self.get_workflow()
         #detailworkflow = self.gi.workflows.show_workflow(
         #    workflow[0]['id'])
         # Get fastq input
-        input_collection = self.gi.workflows.get_workflow_inputs(
-            workflow[0]['id'], label='reads_dataset_collection')[0]
+        input_collection = self.workflow_input(workflow,
+                                               'reads_dataset_collection')
         # Dataset input
         dataset_map[input_collection] = {'id' : collection['id'],
                                          'src' : 'hdca'}
         # Get contaminant input                                                 
-        input_fasta = self.gi.workflows.get_workflow_inputs(
-            workflow[0]['id'], label='contaminant_dataset')[0]
+        input_fasta = self.workflow_input(workflow, 'contaminant_dataset')
         # Dataset input
         dataset_map[input_fasta] = {'id' : fasta_dataset['outputs'][0]['id'],
                                     'src' : 'hda'}
         return workflow, dataset_map#, count_fastq
 
+    def input_size(self):
+        """Count the bytes to send
+        """
+        return task_size(self.data_task)
+
+    def input_paths(self):
+        """Directories of the reads
+        """
+        return task_paths(self.data_task)
+
+    def input_files(self):
+        """Fastq files of the reads
+        """
+        list_file = []
+        for path in self.input_paths():
+            list_file += sorted(glob.glob('{0}/*.f*q*'.format(path)))
+        return list_file
+
+    def get_workflow(self):
+        """Identify the workflow of the task
+        """
+        if self.data_task["paired"]:
+            workflow_name = "masque_paired_end_" + self.data_task["type"]
+        else:
+            workflow_name = "masque_single_end_" + self.data_task["type"]
+        if self.data_task['host'] == "":
+            workflow_name += "_short"
+        if self.batch:
+            return self.batches.workflow(self, workflow_name)
+        return self.gi.workflows.get_workflows(name=workflow_name)
+
+    def workflow_input(self, workflow, label):
+        """Identify a workflow input by its label
+        """
+        if self.batch:
+            return self.batches.workflow_input(self, workflow[0]['id'], label)
+        return self.gi.workflows.get_workflow_inputs(workflow[0]['id'],
+                                                     label=label)[0]
+
+    def send_contaminant(self, history):
+        """Send the contaminant, once for all the jobs of a batch
+        """
+        if self.batch:
+            fasta_dataset = self.batches.contaminant(self)
+        else:
+            fasta_dataset = self.gi.tools.upload_file(
+                self.data_task["contaminant"], history['id'])
+        self.progress.add_bytes(os.path.getsize(self.data_task["contaminant"]))
+        return fasta_dataset
+
+    def spawn_preview(self):
+        """Queue in todo a run of the workflow on a subsample of the reads,
+        its results come long before the full run
+        """
+        preview = self.data_task.get("preview", False)
+        if "preview_of" in self.data_task:
+            return
+        if not preview and not (
+                self.options["preview_size"] > 0 and
+                self.progress.total_bytes >= self.options["preview_size"]):
+            return
+        if isinstance(preview, int) and not isinstance(preview, bool):
+            num_reads = preview
+        else:
+            num_reads = self.options["preview_reads"]
+        name = self.data_task["name"] + "_preview"
+        work_dir = os.path.dirname(os.path.normpath(self.doing_dir)) + os.sep
+        # Already queued before a take over
+        for state in ["todo", "doing", "done", "error"]:
+            if os.path.isfile(work_dir + state + os.sep + name + ".json"):
+                return
+        # The reads are sampled while the full run is uploaded
+        self.previewer = Thread(target=self.make_preview,
+                                args=(name, num_reads, work_dir),
+                                name="preview_" + self.data_task["name"])
+        self.previewer.daemon = True
+        self.previewer.start()
+
+    def make_preview(self, name, num_reads, work_dir):
+        """Subsample the reads and queue the preview task
+        """
+        reads_dir = self.doing_dir + name + os.sep
+        preview_task = {key: value for key, value in self.data_task.items()
+                        if key not in preview_excluded}
+        preview_task["preview_of"] = self.data_task["name"]
+        preview_task["preview_reads"] = num_reads
+        try:
+            if self.data_task["paired"]:
+                output_dirs = [reads_dir + "R1" + os.sep,
+                               reads_dir + "R2" + os.sep]
+                preview_task["path_R1"], preview_task["path_R2"] = output_dirs
+            else:
+                output_dirs = [reads_dir + "reads" + os.sep]
+                preview_task["path"] = output_dirs[0]
+            subsample_fastq(self.input_paths(), output_dirs, num_reads,
+                            self.data_task["name"])
+            # Not worth it once the full run is stopped
+            if self.cancelled.is_set():
+                shutil.rmtree(reads_dir, ignore_errors=True)
+                return
+            write_atomic(work_dir + "todo" + os.sep + name + ".json",
+                         json.dumps(preview_task))
+            self.logger.info("Preview of {0} on {1} reads per sample queued"
+                             .format(self.data_task["name"], num_reads))
+        except:
+            # The full run goes on without preview
+            self.logger.error("Failed to subsample the reads of {0}".format(
+                self.data_task["name"]))
+            self.logger.error(sys.exc_info()[1])
+            shutil.rmtree(reads_dir, ignore_errors=True)
+
+    def remove_reads(self):
+        """Delete the sent reads once the invocations are saved in the task,
+        a job resumed before sends them again, and once the preview has
+        sampled them
+        """
+        if self.previewer:
+            self.previewer.join()
+        for fastq_file in self.sent_reads:
+            try:
+                os.remove(fastq_file)
+            except OSError:
+                self.logger.error("Failed to delete {0}".format(fastq_file))
+        self.sent_reads = []
+
+    def clear_preview(self):
+        """Remove the subsample of a preview
+        """
+        if self.data_task and "preview_of" in self.data_task:
+            shutil.rmtree(self.doing_dir + self.data_task["name"] + os.sep,
+                          ignore_errors=True)
+
+    def leave_batch(self, status):
+        """Report the end of a job of a batch
+        """
+        if self.batches and self.data_task and "batch" in self.data_task:
+            try:
+                self.batches.leave(self, status)
+            except:
+                self.logger.error("Failed to report {0} to the batch {1}"
+                                  .format(self.data_task["name"],
+                                          self.data_task["batch"]))
+                self.logger.error(sys.exc_info()[1])
+
+    def leave_invalid(self, name):
+        """Report as failed a task of a batch which cannot be read
+        """
+        if not self.batches:
+            return
+        try:
+            with open(self.error_dir + name + ".json", "rt") as task:
+                data_task = json.load(task)
+            if isinstance(data_task, dict) and "batch" in data_task:
+                self.batches.write_report(
+                    data_task["batch"], data_task.get("batch_size", 1), name,
+                    {"status": "error", "error": name + ".json"})
+        except (IOError, ValueError):
+            pass
+
+    def cache_key(self):
+        """Hash the inputs, the parameters and the workflow version
+        """
+        key = hashlib.sha256()
+        list_file = [self.data_task["contaminant"]]
+        for path in self.input_paths():
+            list_file += sorted(glob.glob('{0}/*.f*q*'.format(path)))
+        for input_file in list_file:
+            key.update(os.path.basename(input_file).encode())
+            with open(input_file, "rb") as input_data:
+                for chunk in iter(lambda: input_data.read(1048576), b""):
+                    key.update(chunk)
+        parameters = {name: self.data_task.get(name)
+                      for name in sweep_parameters + cache_parameters}
+        # Packaging options change the archive
+        parameters["columnar"] = self.options["columnar"]
+        parameters["summary"] = self.options["summary"]
+        key.update(json.dumps(parameters, sort_keys=True).encode())
+        workflow = self.get_workflow()
+        detailworkflow = self.gi.workflows.show_workflow(workflow[0]['id'])
+        key.update("{0}:{1}:{2}".format(
+            workflow[0]['name'], detailworkflow.get('version'),
+            detailworkflow.get('latest_workflow_uuid')).encode())
+        return key.hexdigest()
+
     def reconnect(self):
         """Reconnect to galaxy
         """
         self.gi = GalaxyInstance(url=self.galaxy_url, key=self.galaxy_key)
         self.gi.verify = False
+        if self.limiter:
+            self.gi = limited_galaxy(self.gi, self.limiter)
 
     def get_unique(self, seq):
         # Not order preserving
-        return {}.fromkeys(seq).keys()
+        return list({}.fromkeys(seq).keys())
+
+    def report_jobs(self, error_jobid, run=None):
+        """Write the error of the failed galaxy jobs and warn the user
+        """
+        key = self.data_task["name"].replace("file", "")
+        error_file = (self.error_dir + os.sep + self.data_task["name"]
+                         + "_error.txt")
+        if run and run['index'] != None:
+            key += " (run {0})".format(run['index'])
+            error_file = (self.error_dir + os.sep + self.data_task["name"]
+                          + "_run_{0}_error.txt".format(run['index']))
+        error_list = []
+        error_mess_list = []
+        # Get error message
+        for job_id in error_jobid:
+            error_list.append(self.gi.jobs.show_job(job_id, full_details=True))
+        # Write error message
+        with open(error_file, "wt") as error_log:
+            for error in error_list:
+                error_mess = ("tool_id:{1}{0}error:{0}{2}"
+                                .format(os.linesep, 
+                                        error['tool_id'],
+                                        error['stderr']))
+                error_log.write(error_mess)
+                error_mess_list.append(error_mess)
+
+        message = ("The workflow failed during progression for the "
+                   "key {0}.{1}{2}"
+                   .format(key, os.linesep, os.linesep.join(error_mess_list)))
+        # error mail
+        self.send_mail(message)
 
-    def check_progress(self, history, glob_progress=0.0, prev_progress=0.0):
+    def report_error(self, history):
+        """Report the galaxy jobs in error in an history
+        """
+        error_datasets = self.gi.histories.show_history(history['id'])['state_ids']['error']
+        error_jobid = [self.gi.histories.show_dataset_provenance(history['id'], dataset_id)['job_id']
+                       for dataset_id in error_datasets]
+        # Unique jobid in error
+        error_jobid.sort()
+        error_jobid = self.get_unique(error_jobid)
+        self.report_jobs(error_jobid)
+
+    def workflow_fraction(self, step_jobs):
+        """Fraction of the workflow steps with all their jobs done
+        """
+        done_steps = 0.0
+        for step in step_jobs:
+            total_jobs = sum(step['states'].values())
+            if total_jobs > 0:
+                done_steps += float(step['states'].get('ok', 0)) / total_jobs
+        return done_steps / max(self.tool_steps, len(step_jobs), 1)
+
+    def check_invocation(self, run):
+        """Follow the workflow invocation of a run step by step
+        """
+        job_done = False
+        try:
+            while not job_done:
+                # Uploads checked in parallel of the workflow
+                if self.watcher and self.watcher.failed.is_set():
+                    self.logger.error("Upload failed for {0}".format(
+                        self.data_history_name))
+                    with self.lock:
+                        if not self.watcher.reported:
+                            self.watcher.reported = True
+                            self.report_error(self.data_history)
+                    break
+                invocation_story = self.gi.invocations.show_invocation(
+                    run['invocation']['id'])
+                step_jobs = self.gi.invocations.get_invocation_step_jobs_summary(
+                    run['invocation']['id'])
+                run['fraction'] = self.workflow_fraction(step_jobs)
+                self.progress.update("workflow", sum(
+                    run['fraction'] for run in self.runs) / len(self.runs))
+                failed_steps = [step for step in step_jobs
+                                if set(step['states']) & set(failed_job_states)]
+                running_steps = [step for step in step_jobs
+                                 if set(step['states']) - set(done_job_states)]
+                # fail at the first step in error
+                if invocation_story['state'] in failed_invocation_states:
+                    self.logger.error("Invocation {0} is {1}".format(
+                        run['invocation']['id'], invocation_story['state']))
+                    self.report_jobs([], run)
+                    break
+                elif failed_steps:
+                    self.logger.error("Invocation {0} failed at {1}".format(
+                        run['invocation']['id'], failed_steps))
+                    error_jobid = [job['id'] for job in self.gi.jobs.get_jobs(
+                        invocation_id=run['invocation']['id'], state="error")]
+                    self.report_jobs(error_jobid, run)
+                    break
+                # Success once every step is scheduled and its jobs are ok
+                elif (invocation_story['state'] == "scheduled" and
+                      not running_steps):
+                    job_done = True
+                    self.logger.info("Invocation {0} is done".format(
+                        run['invocation']['id']))
+                else:
+                    self.logger.info("Invocation {0} is {1}, {2} steps "
+                                     "running".format(
+                                         run['invocation']['id'],
+                                         invocation_story['state'],
+                                         len(running_steps)))
+                    if self.cancelled.wait(self.options["poll_time"]):
+                        break
+        except bioblend.ConnectionError:
+            time.sleep(5)
+            self.reconnect()
+            job_done = self.check_invocation(run)
+        if job_done:
+            run['fraction'] = 1.0
+            run['status'] = "done"
+        elif self.cancelled.is_set():
+            run['status'] = "cancelled"
+        else:
+            run['status'] = "failed"
+        return job_done
+
+    def check_progress(self, history, phase):
         """Check progression
         """
         countdown = 0
-        progress_file = (self.doing_dir + os.sep + self.data_task["name"]
-                         + "_progress.txt")
         error_file = (self.error_dir + os.sep + self.data_task["name"]
                          + "_error.txt")
         job_done = False
-        error_list = []
-        error_mess_list = []
         try:
             # Check status
             while not job_done:
                 progress_story = self.gi.histories.get_status(history['id'])
-                #new_progress = float(self.gi.histories.get_status(history['id'])['percent_complete'])
                 new_progress = float(progress_story['percent_complete'])
-                if prev_progress > new_progress:
-                    glob_progress = 200.0 + new_progress
-                    prev_progress = glob_progress
-                else:
-                    glob_progress = glob_progress + (new_progress - prev_progress)
-                    prev_progress = new_progress
-                with open(progress_file, "wt") as progress:
-                    progress.write("{0}".format(glob_progress / 3.0))
-                # print("progression {0}".format(glob_progress))
-                # print("progression {0}".format(glob_progress / 3.0))
-                
+                self.progress.update(phase, new_progress / 100.0)
                 # Success
-                if progress_story['state'] == "ok" and (glob_progress == 100.0 or glob_progress == 300.0):
+                if progress_story['state'] == "ok" and new_progress == 100.0:
                     job_done = True
                     self.logger.info(progress_story)
                 elif progress_story['state'] == "ok" and countdown >= 10:
@@ -353,43 +793,22 @@ class galaxy(Thread):
                 # fail 
                 elif progress_story['state'] == "error" or progress_story['state_details']['error'] > 0: 
                     self.logger.error(progress_story)
-                    error_datasets = self.gi.histories.show_history(history['id'])['state_ids']['error']
-                    error_jobid = [self.gi.histories.show_dataset_provenance(history['id'], dataset_id)['job_id']
-                                   for dataset_id in error_datasets]
-                    # Unique jobid in error
-                    error_jobid.sort()
-                    error_jobid = self.get_unique(error_jobid)
-                    # Get error message
-                    for job_id in error_jobid:
-                        error_list.append(self.gi.jobs.show_job(job_id, full_details=True))
-                    # Write error message
-                    with open(error_file, "wt") as error_log:
-                        for error in error_list:
-                            error_mess = ("tool_id:{1}{0}error:{0}{2}"
-                                            .format(os.linesep, 
-                                                    error['tool_id'],
-                                                    error['stderr']))
-                            error_log.write(error_mess)
-                            error_mess_list.append(error_mess)
-
-                    message = ("The workflow failed during progression for the "
-                               "key {0}.{1}{2}"
-                               .format(self.data_task["name"].replace("file", ""),
-                                os.linesep, os.linesep.join(error_mess_list)))
-                    # error mail
-                    self.send_mail(message)
+                    self.report_error(history)
                     break
                 else:
                     self.logger.info(progress_story)
-                time.sleep(10)                   
+                if self.cancelled.wait(self.options["poll_time"]):
+                    break
         except bioblend.ConnectionError:
             time.sleep(5)
             self.reconnect()
-            job_done = self.check_progress(history, glob_progress, prev_progress)
+            job_done = self.check_progress(history, phase)
         except IOError:
             self.logger.error("Error cannot open {0} or {1}"
-                              .format(progress_file, error_file))
-            job_done = self.check_progress(history, glob_progress, prev_progress)
+                              .format(self.progress.progress_file, error_file))
+            job_done = self.check_progress(history, phase)
+        if job_done:
+            self.progress.update(phase, 1.0)
         return job_done
 
     # def get_members(self, tar, prefix):
@@ -411,7 +830,7 @@ class galaxy(Thread):
     #         for file in files:
     #             ziph.write(os.path.join(root, file), file)
 
-    def zip_archive(self, list_downloaded_files, zip_file):
+    def zip_archive(self, list_downloaded_files, zip_file, root=None):
         """Extract tar file and build a clean zip file
         """
         #if not os.path.isdir(path):
@@ -436,7 +855,10 @@ class galaxy(Thread):
         #try:
         with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for file in list_downloaded_files:
-                zipf.write(file, os.path.basename(file))
+                if root:
+                    zipf.write(file, os.path.relpath(file, root))
+                else:
+                    zipf.write(file, os.path.basename(file))
         #except IOError:
         #    self.logger.error("Error cannot open {0}".format(zip_file))
 
@@ -453,7 +875,7 @@ class galaxy(Thread):
         msg['Subject'] = "Shaman result"
         msg.attach(MIMEText(message, 'plain'))
         if result_file:
-            if os.path.getsize(result_file) < 10000000:
+            if os.path.getsize(result_file) < self.options["attachment_size"]:
                 part = MIMEBase('application', 'octet-stream')
                 with open(result_file, "rb") as attachment:
                     part.set_payload((attachment).read())
@@ -473,25 +895,157 @@ class galaxy(Thread):
         #except IOError:
         #    self.logger.error("Error cannot open {0}".format(result_file))
     
-    # def download_result(self, history_id, jeha_id, result_file):
-    #     """Download tar archive from galaxy
-    #     """
-    #     success = False
-    #     try:
-    #         with open(result_file, 'wb') as result:
-    #             self.gi.histories.download_history(
-    #                 history_id, jeha_id, result)
-    #         if os.stat(result_file).st_size != 0:
-    #             success = True
-    #     except IOError:
-    #         self.logger.error("Error cannot open {0}".format(result_file))
-    #     except requests.exceptions.HTTPError:
-    #         self.logger.error("Error requests try again")
-    #         time.sleep(5)
-    #         success = self.download_result(history_id, jeha_id, result_file)
-    #     return success
-
-    def download_result(self, history_id, list_result, result_dir):
+    def check_dataset(self, res, dataset_id):
+        """Compare a downloaded file with the galaxy metadata
+          Returns: True when the file is consistent
+        """
+        dataset = self.gi.datasets.show_dataset(dataset_id)
+        file_size = os.path.getsize(res)
+        if dataset.get('file_size') not in (None, file_size):
+            self.logger.error("File {0} has {1} bytes instead of {2}".format(
+                res, file_size, dataset['file_size']))
+            return False
+        # Error page saved in place of the result
+        with open(res, "rb") as result:
+            head = result.read(512).lstrip().lower()
+        if head.startswith(b"<!doctype html") or head.startswith(b"<html"):
+            self.logger.error("File {0} is an html page".format(res))
+            return False
+        for dataset_hash in dataset.get('hashes') or []:
+            hash_function = hash_functions.get(dataset_hash['hash_function'])
+            if (hash_function and file_hash(res, hash_function) !=
+                dataset_hash['hash_value']):
+                self.logger.error("File {0} has a wrong {1}".format(
+                    res, dataset_hash['hash_function']))
+                return False
+        return True
+
+    def check_otu_ids(self, list_downloaded_files, result_dir):
+        """Warn when the OTU of the tables are not in the OTU fasta, the
+        names of the workflow may differ between the files
+          Returns: Files that disagree with the fasta
+        """
+        fasta_file = result_dir + "shaman_otu.fasta"
+        if fasta_file not in list_downloaded_files:
+            return []
+        fasta_ids = set(read_fasta_ids(fasta_file))
+        mismatched = []
+        for res in list_downloaded_files:
+            if res == result_dir + "shaman_otu_table.tsv":
+                otu_ids = read_tsv(res)[1]
+            elif res.endswith(".biom"):
+                otu_ids = read_biom_ids(res)
+            else:
+                continue
+            # Hdf5 biom are not read
+            if otu_ids is None:
+                continue
+            if not fasta_ids or not set(otu_ids) <= fasta_ids:
+                self.logger.warning("OTU of {0} are not in {1}".format(
+                    res, fasta_file))
+                mismatched += [res, fasta_file]
+        return self.get_unique(mismatched)
+
+    def verify_result(self, run, retries=2):
+        """Check the downloaded files and fetch again only the wrong ones
+          Returns: True when all the files are consistent
+        """
+        dataset_ids = dict(run['delivered'])
+        if None in dataset_ids.values():
+            # Dataset of the exported files
+            contents = self.gi.histories.show_history(
+                run['result_history']['id'], contents=True)
+            for res in dataset_ids:
+                if dataset_ids[res] is None:
+                    name = os.path.splitext(os.path.basename(res))[0]
+                    for dataset in contents:
+                        if dataset['name'] == name and not dataset['deleted']:
+                            dataset_ids[res] = dataset['id']
+                            break
+        to_check = [res for res in run['list_downloaded_files']
+                    if dataset_ids.get(res)]
+        for attempt in range(retries + 1):
+            wrong_files = [res for res in to_check
+                           if not self.check_dataset(res, dataset_ids[res])]
+            if not wrong_files:
+                # Only reported, fetching the files again cannot fix it
+                self.check_otu_ids(run['list_downloaded_files'],
+                                   run['result_dir'])
+                return True
+            if attempt == retries:
+                break
+            for res in wrong_files:
+                self.logger.info("Fetch again {0}".format(res))
+                self.gi.datasets.download_dataset(
+                    dataset_ids[res], file_path=res,
+                    use_default_filename=False, maxwait=60)
+            to_check = wrong_files
+        self.logger.error("Files still wrong after {0} retries: {1}".format(
+            retries, ", ".join(wrong_files)))
+        return False
+
+    def export_result(self, history_id, list_result, result_dir):
+        """Stream the export of the history and extract the result files
+        """
+        extracted = {}
+        patterns = {}
+        for result_type in list_result:
+            for result_file in list_result[result_type]:
+                patterns[result_dir + result_file + "." + result_type] = (
+                    re.compile(re.escape(result_file) + r"_\d+\.[^.]+$"))
+        if not os.path.isdir(result_dir):
+            os.makedirs(result_dir)
+        jeha_id = self.gi.histories.export_history(history_id, gzip=True,
+                                                   wait=True)
+        read_fd, write_fd = os.pipe()
+        errors = []
+        def pump():
+            writer = None
+            try:
+                writer = os.fdopen(write_fd, "wb")
+                self.gi.histories.download_history(
+                    history_id, jeha_id, writer, chunk_size=1048576)
+            except Exception as err:
+                errors.append(err)
+            finally:
+                # The reader sees the end of the stream whatever happened
+                try:
+                    if writer:
+                        writer.close()
+                    else:
+                        os.close(write_fd)
+                except OSError:
+                    pass
+        pumper = Thread(target=pump)
+        pumper.start()
+        with os.fdopen(read_fd, "rb") as reader:
+            try:
+                with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+                    for member in tar:
+                        if not member.isfile():
+                            continue
+                        for res in patterns:
+                            if (res not in extracted and patterns[res].match(
+                                    os.path.basename(member.name))):
+                                with open(res, "wb") as result:
+                                    shutil.copyfileobj(
+                                        tar.extractfile(member), result)
+                                # Dataset id found back for the checks
+                                extracted[res] = None
+                                break
+                # Padding after the end of the archive
+                while reader.read(1048576):
+                    pass
+            finally:
+                # Unblock the download if the archive is broken
+                reader.close()
+                pumper.join()
+        if errors:
+            raise errors[0]
+        return extracted
+
+    def download_result(self, history_id, list_result, result_dir,
+                        delivered=None):
         """Download tar archive from galaxy
         """
         list_downloaded_files = []
@@ -499,14 +1053,18 @@ class galaxy(Thread):
         # Create output directory
         #try:
         if not os.path.isdir(result_dir):
-            os.mkdir(result_dir)
+            os.makedirs(result_dir)
         try:
             for result_type in list_result:
                 for result_file in list_result[result_type]:
+                    res = result_dir + result_file + "." + result_type
+                    # Already delivered while the workflow was running
+                    if delivered and res in delivered:
+                        list_downloaded_files.append(res)
+                        continue
                     match = self.gi.histories.show_matching_datasets(
                                     history_id, result_file)
                     if len(match) >0:
-                        res = result_dir + result_file + "." + result_type
                         #wait_for_completion=True,
                         self.gi.datasets.download_dataset(
                             match[0]['id'], file_path = res, 
@@ -517,6 +1075,8 @@ class galaxy(Thread):
                             #success = False
                         else:
                             list_downloaded_files.append(res)
+                            if delivered is not None:
+                                delivered[res] = match[0]['id']
                     else:
                         self.logger.error("Match for result file: {} and result type: {} = {}"
                             .format(result_file, result_type, match))
@@ -529,532 +1089,3887 @@ class galaxy(Thread):
             success = False
         return success, list_downloaded_files
 
-    def run(self):
-        """Upload, run galaxy workflow and dowload results
+    def get_params(self, data_task):
+        """Build the workflow parameters from the task
+        """
+        align_dict = {
+        'id':data_task["aKmin"],
+        'strand':data_task["annotationstrand"]
+        }
+        clustering_dict = {
+            'id':data_task["clusteringthreshold"],
+            'strand':data_task["clusteringstrand"]
+        }
+        annot_dict = {
+            'aKmin':data_task["aKmin"],
+            'aPmin':data_task["aPmin"],
+            'aPmax':data_task["aPmax"],
+            'aCmin':data_task["aCmin"],
+            'aCmax':data_task["aCmax"],
+            'aOmin':data_task["aOmin"],
+            'aOmax':data_task["aOmax"],
+            'aFmin':data_task["aFmin"],
+            'aFmax':data_task["aFmax"],
+            'aGmin':data_task["aGmin"],
+            'aGmax':data_task["aGmax"],
+            'aSmin':data_task["aSmin"]
+        }
+        quality_dict = {
+            'q': data_task["phredthres"],
+            'p': data_task["mincorrect"],
+            'l': data_task["minreadlength"]
+        }
+        derep_dict = {
+            'derep_method': data_task["dreptype"],
+            'minseqlength': data_task["minampliconlength"]
+        }
+        # paired end with host
+        if data_task['host'] != "" and data_task["paired"]:
+            params = {
+                # From 3 to 4
+                "4":{"reference_genome|index":data_task["host"]},
+                # From 5 to 3
+                "3": quality_dict,
+                "7":{
+                'pattern|sub_pattern': data_task["pattern_R1"],
+                'max_amplicon_length':data_task["maxampliconlength"]},
+                "9": derep_dict,
+                "10":{'sorting_mode|minsize':data_task["minabundance"]},
+                #Clustering
+                "12":clustering_dict
+                     }
+            if data_task["type"] == "16S" :
+                params.update(
+                    {
+                    #Count matrix
+                    "16":clustering_dict,
+                    #Greengenes
+                    "14":align_dict,
+                    "18":annot_dict,
+                    #Silva
+                    "15":align_dict,
+                    "19":annot_dict,
+                    #Extract Result
+                    "23":{'paired|pattern': data_task["pattern_R1"]}
+                    }
+                )
+            elif data_task["type"] == "18S" or data_task["type"] == "23S_28S":
+                params.update(
+                    {
+                    # Count matrix
+                    "16":clustering_dict,
+                    # Silva
+                    "14":align_dict,
+                    "17":annot_dict,
+                    # Extract Result
+                    "20":{'paired|pattern': data_task["pattern_R1"]}
+                    }
+                )
+            else:
+                params.update(
+                    {
+                    # Count matrix
+                    "17":clustering_dict,
+                    # Findley
+                    "14":align_dict,
+                    "19":annot_dict,
+                    # Underhill
+                    "15":align_dict,
+                    "20":annot_dict,
+                    # Unite
+                    "18":align_dict,
+                    "21":annot_dict,
+                    # new 26 instead of 28 Extract Result
+                    "26":{'paired|pattern': data_task["pattern_R1"]}
+                    }
+                )
+        # paired end no host
+        elif data_task['host'] == "" and data_task["paired"]:
+            params={
+                "3":quality_dict,
+                "5":{'pattern|sub_pattern': data_task["pattern_R1"]},
+                "7": derep_dict,
+                "8":{'sorting_mode|minsize':data_task["minabundance"]},
+                #Clustering
+                "10":clustering_dict,
+                }
+            if data_task["type"] == "16S":
+                params.update(
+                    {
+                    #Count matrix
+                    "14":clustering_dict,
+                    #Greengenes
+                    "12":align_dict, "16":annot_dict,
+                    #Silva
+                    "13":align_dict, "17":annot_dict,
+                    #Extract result
+                    "21":{'paired|pattern' : data_task["pattern_R1"]}
+                    }
+                )
+            elif data_task["type"] == "18S":
+                params.update(
+                    {
+                    # Count matrix
+                    "14":clustering_dict,
+                    # Silva
+                    "12":align_dict, "15":annot_dict,
+                    # Extract result
+                    "17":{'paired|pattern': data_task["pattern_R1"]}
+                    }
+                )
+            elif data_task["type"] == "23S_28S":
+                params.update(
+                    {
+                    # Count matrix
+                    "14":clustering_dict,
+                    # Silva
+                    "12":align_dict, "15":annot_dict,
+                    # Extract result
+                    "18":{'paired|pattern': data_task["pattern_R1"]}
+                    }
+                )
+            else:
+                params.update(
+                    {
+                    # Count matrix
+                    "15":clustering_dict,
+                    # Findley
+                    "12":align_dict, "17":annot_dict,
+                    # Underhill
+                    "13":align_dict, "18":annot_dict,
+                    # Unite
+                    "16":align_dict, "19":annot_dict,
+                    # Extract result
+                    #new 24 instead of 26
+                    "24":{'paired|pattern': data_task["pattern_R1"]}
+                    }
+                )
+        # single end with host
+        elif data_task['host'] != "" and not data_task["paired"]:
+            params={
+                # 2 to 3
+                "3":{"reference_genome|index":data_task["host"]},
+                # 4 to 2
+                "2":quality_dict,
+                "5":{'max_amplicon_length':data_task["maxampliconlength"]},
+                "7": derep_dict,
+                "8":{'sorting_mode|minsize':data_task["minabundance"]},
+                #Clustering
+                "10":clustering_dict,
+                }
+            if data_task["type"] == "16S":
+                params.update(
+                    {
+                    #Count matrix
+                    "15":clustering_dict,
+                    #Greengenes
+                    "12":align_dict, "16":annot_dict,
+                    #Silva
+                    "13":align_dict, "17":annot_dict
+                    }
+                )
+            elif data_task["type"] == "18S" or data_task["type"] == "23S_28S":
+                params.update(
+                    {
+                    # Count matrix
+                    "14":clustering_dict,
+                    # Silva
+                    "12":align_dict, "15":annot_dict
+                    }
+                )
+            else:
+                params.update(
+                    {
+                    # Count matrix
+                    "15":clustering_dict,
+                    # Findley
+                    "12":align_dict, "17":annot_dict,
+                    # Underhill
+                    "13":align_dict, "18":annot_dict,
+                    # Unite
+                    "16":align_dict, "19":annot_dict
+                    }
+                )
+        # single end no host
+        else:
+            params={
+                "2":quality_dict,
+                "3":{'max_amplicon_length':data_task["maxampliconlength"]},
+                "5":derep_dict,
+                "6":{'sorting_mode|minsize':data_task["minabundance"]},
+                # Clustering
+                "8":clustering_dict
+            }
+            if data_task["type"] == "16S":
+                params.update(
+                    {
+                    # Count matrix
+                    "13":clustering_dict,                                        
+                    # Greengenes
+                    "10":align_dict, "14":annot_dict,
+                    # Silva
+                    "11":align_dict, "15":annot_dict
+                    }
+                )
+            elif data_task["type"] == "18S" or data_task["type"] == "23S_28S":
+                params.update(
+                    {
+                    # Count matrix
+                    "12":clustering_dict,
+                    # Silva
+                    "10":align_dict, "13":annot_dict
+                    }
+                )
+            else:
+                params.update(
+                    {
+                    # Count matrix
+                    "13":clustering_dict,
+                    # Findley
+                    "10":align_dict, "15":annot_dict,
+                    # Underhill
+                    "11":align_dict, "16":annot_dict,
+                    # Unite
+                    "14":align_dict, "17":annot_dict
+                    }
+                )
+        return params
+
+    def track(self, kind, item):
+        """Register a galaxy history or library for the janitor
+        """
+        if self.janitor:
+            self.janitor.track(kind, item, self.data_history_name)
+
+    def enter(self, phase):
+        """Start the clock of a phase for its deadline
+        """
+        self.phase = phase
+        self.phase_start = time.time()
+
+    def pause(self):
+        """Stop the clock while the job waits for a worker of its next stage
+        """
+        self.phase_start = None
+
+    def cancel(self, reason, mail=False, cleanup=True):
+        """Stop the job from another thread, galaxy is cleaned at once
+        unless the job now belongs to another daemon
+        """
+        if self.cancelled.is_set():
+            return
+        self.logger.info("Cancel {0}: {1}".format(self.task_file, reason))
+        self.cancel_reason = reason
+        self.cancel_mail = mail
+        self.cancel_cleanup = cleanup
+        self.cancelled.set()
+        cleaner = Thread(target=self.abort)
+        cleaner.daemon = True
+        cleaner.start()
+
+    def checkpoint(self):
+        """Leave the job in doing for another daemon or the next start,
+        what runs in galaxy is kept and resumed from the task
+        """
+        self.cancel("daemon stopped", cleanup=False)
+
+    def abort(self):
+        """Cancel the galaxy jobs, purge the histories and close the task,
+        called again by the stage thread for what it created meanwhile
+        """
+        with self.abort_lock:
+            if not self.cancel_cleanup:
+                if not self.aborted and self.progress:
+                    self.progress.finish("moved")
+                if not self.aborted:
+                    self.leave_batch("moved")
+                    if self.admission:
+                        self.admission.release(self.data_history_name)
+                self.aborted = True
+                return
+            for run in self.runs:
+                # Histories purged by a previous call
+                if not run['invocation'] or not run['result_history']:
+                    continue
+                try:
+                    self.gi.invocations.cancel_invocation(
+                        run['invocation']['id'])
+                    for state in ["new", "queued", "running"]:
+                        for job in self.gi.jobs.get_jobs(
+                                invocation_id=run['invocation']['id'],
+                                state=state):
+                            self.gi.jobs.cancel_job(job['id'])
+                except:
+                    self.logger.error("Failed to cancel the invocation {0}"
+                                      .format(run['invocation']['id']))
+                    self.logger.error(sys.exc_info()[1])
+            try:
+                if self.lib:
+                    self.gi.libraries.delete_library(self.lib['id'])
+                    self.lib = None
+                if self.data_history:
+                    self.gi.histories.delete_history(self.data_history['id'],
+                                                     purge=True)
+                    self.data_history = None
+                for run in self.runs:
+                    if run['result_history']:
+                        self.gi.histories.delete_history(
+                            run['result_history']['id'], purge=True)
+                        run['result_history'] = None
+                if self.janitor:
+                    self.janitor.forget(self.data_history_name)
+            except:
+                self.logger.error("Failed to purge the histories of {0}"
+                                  .format(self.data_history_name))
+                self.logger.error(sys.exc_info()[1])
+                # Left to the janitor
+                if self.janitor:
+                    self.janitor.release(self.data_history_name, 0)
+            if self.aborted:
+                return
+            self.aborted = True
+            if self.progress:
+                self.progress.finish("cancelled")
+            self.leave_batch("cancelled")
+            self.clear_preview()
+            if self.admission:
+                self.admission.release(self.data_history_name)
+            name = self.data_task["name"]
+            try:
+                with open(self.error_dir + name + "_error.txt", "wt") as error:
+                    error.write("{0}\n".format(self.cancel_reason))
+                if os.path.isfile(self.task_file):
+                    shutil.move(self.task_file, self.error_dir +
+                                os.path.basename(self.task_file))
+                cancel_file = self.doing_dir + name + ".cancel"
+                if os.path.isfile(cancel_file):
+                    os.remove(cancel_file)
+            except (IOError, OSError):
+                self.logger.error("Failed to close the task {0}".format(name))
+                self.logger.error(sys.exc_info()[1])
+            if self.cancel_mail:
+                self.send_mail("Shaman job {0} was stopped: {1}".format(
+                    name.replace("file", ""), self.cancel_reason))
+
+    def fail(self, message=None):
+        """Move the task in error and warn the user
+        """
+        # Closed by abort()
+        if self.cancelled.is_set():
+            return
+        if self.progress:
+            self.progress.finish("error")
+        else:
+            # Left by the daemon whose job was taken over
+            remove_progress(self.doing_dir + os.sep + os.path.splitext(
+                os.path.basename(self.task_file))[0] + "_progress.txt")
+        if self.admission:
+            self.admission.release(self.data_history_name)
+        # Kept for shaman_finisher.py during the grace time
+        if self.janitor:
+            self.janitor.release(self.data_history_name)
+        if os.path.isfile(self.task_file):
+            shutil.move(self.task_file, self.error_dir +
+                        os.path.basename(self.task_file))
+        self.leave_batch("error")
+        self.clear_preview()
+        if message:
+            self.send_mail(message)
+
+    def discard(self, error=None):
+        """Fail the job after an unexpected error, which must not stop the
+        caller, and warn the user
+        """
+        name = os.path.splitext(os.path.basename(self.task_file))[0]
+        try:
+            self.fail("Shaman job failed for the key {0}: {1}".format(
+                name.replace("file", ""), error or "unexpected error"))
+        except:
+            self.logger.error("Failed to close {0} in error".format(
+                self.task_file))
+            self.logger.error(sys.exc_info()[1])
+        self.release_lease(name)
+
+    def name_histories(self):
+        """Galaxy names of the job, unique over the daemon hosts
+        """
+        job_id = "{0}_{1}_{2}".format(self.options["node"], os.getpid(),
+                                      self.num_job)
+        self.data_history_name = 'data_shaman_' + job_id
+        self.lib_name = 'lib_shaman_' + job_id
+        self.result_history_name = 'shaman_' + job_id
+
+    def prepare(self):
+        """Claim the task, move it in doing and list the expected results
         """
-        list_result = {}
-        #count_fastq = 0
-        lib = None
-        param = None
-        jeha_id = ""
-        result_history = None
-        dataset_map = None
-        data_history_name = ('data_shaman_' + str(os.getpid())+ "_" + 
-                             str(self.num_job))
-        lib_name = 'lib_shaman_' + str(os.getpid())+ "_" + str(self.num_job)
-        result_history_name = ('shaman_' + str(os.getpid())+ "_" + 
-                                str(self.num_job))
+        self.name_histories()
+        name = os.path.splitext(os.path.basename(self.task_file))[0]
+        # Only one daemon goes further for a task
+        if self.leases and not self.leases.acquire(name, self):
+            return False
         # Load json data
         self.logger.info("Start reading {0}".format(
                     self.task_file))
         self.data_task = self.load_json()
         self.logger.info("Done reading {0}".format(
                     self.task_file))
-
+        wait_file = os.path.splitext(self.task_file)[0] + ".wait"
+        if self.data_task == None:
+            if os.path.isfile(wait_file):
+                os.remove(wait_file)
+            self.leave_invalid(name)
+            self.release_lease(name)
+            return False
+        # Wait in todo until galaxy and the disk can take the job
+        input_size = self.input_size()
+        if self.admission:
+            reason = self.admission.admit(
+                self.data_history_name, input_size,
+                len(self.data_task.get("sweep", [None])))
+            if reason:
+                record_wait(self.logger, wait_file, reason)
+                self.release_lease(name)
+                return False
+        if os.path.isfile(wait_file):
+            os.remove(wait_file)
+        # Time waited in todo counts for the aging
+        self.arrival = os.path.getmtime(self.task_file)
         # Add galaxy info
-        #print(self.data_task)
-        self.data_task['data_history_name'] = data_history_name
-        self.data_task['result_history_name'] = result_history_name
+        self.data_task['data_history_name'] = self.data_history_name
+        self.data_task['result_history_name'] = self.result_history_name
+        # Checked by the daemon which resumes the upload
+        self.data_task['input_files'] = self.input_files()
         self.logger.info("Starting dump of {0}".format(
                     self.task_file))
-        self.dump_json()
+        try:
+            self.dump_json()
+        except FileNotFoundError:
+            self.logger.error("{0} was claimed by another daemon".format(
+                self.task_file))
+            if self.admission:
+                self.admission.release(self.data_history_name)
+            self.release_lease(name)
+            return False
         self.logger.info("Done dumping of {0}".format(
                     self.task_file))
+        # Client, contaminant and workflows shared with the batch
+        if self.batches and "batch" in self.data_task:
+            self.batches.join(self)
+        self.setup(input_size)
+        return True
+
+    def setup(self, input_size):
+        """Follow the progression and list the expected results
+        """
+        self.progress = progress_model(
+            self.doing_dir + os.sep + self.data_task["name"] + "_progress.txt",
+            self.data_task["name"], self.board)
+        self.progress.total_bytes = input_size
         # Output
-        zip_file = self.done_dir + os.sep + "shaman_" + self.data_task["name"].replace("file", "") + ".zip"
-        result_dir = self.done_dir + os.sep + self.data_task["name"] + os.sep
+        self.zip_file = (self.done_dir + os.sep + "shaman_" +
+                         self.data_task["name"].replace("file", "") + ".zip")
+        self.result_dir = (self.done_dir + os.sep + self.data_task["name"] +
+                           os.sep)
         # Expected result files
-        list_result['fasta'] = ["shaman_otu"]
-        list_result['tsv'] = ["shaman_rdp_annotation", "shaman_otu_table",
+        self.list_result['fasta'] = ["shaman_otu"]
+        self.list_result['tsv'] = ["shaman_rdp_annotation", "shaman_otu_table",
                         "shaman_process_build", "shaman_process_annotation"]
         if self.data_task["type"] == "16S":
-            list_result['biom'] = ["shaman_silva", "shaman_greengenes"]
+            self.list_result['biom'] = ["shaman_silva", "shaman_greengenes"]
         elif self.data_task["type"] == "18S" or self.data_task["type"] == "23S_28S":
-            list_result['biom'] = ["shaman_silva"]
+            self.list_result['biom'] = ["shaman_silva"]
         else:
-            list_result['biom'] = ["shaman_findley", "shaman_unite", "shaman_underhill"]
+            self.list_result['biom'] = ["shaman_findley", "shaman_unite", "shaman_underhill"]
         # Add tree and annotation files
-        list_result['tsv'] += [i + "_annotation"  for i in list_result['biom']]
-        list_result['nhx'] = [i + "_tree"  for i in list_result['biom']]
-        # Check file size
-        if self.data_task != None:
-            # Output result
-            #result_file = self.done_dir + os.sep + self.data_task["name"] + ".tar.gz"
-            
-            # Send data
+        self.list_result['tsv'] += [i + "_annotation"  for i in self.list_result['biom']]
+        self.list_result['nhx'] = [i + "_tree"  for i in self.list_result['biom']]
+        # One result history per set of parameters
+        if "sweep" in self.data_task:
+            for index, parameters in enumerate(self.data_task["sweep"]):
+                run_task = dict(self.data_task)
+                run_task.update(parameters)
+                self.runs.append(self.new_run(
+                    run_task, parameters, index,
+                    self.result_history_name + "_" + str(index),
+                    self.result_dir + "run_{0}".format(index) + os.sep))
+        else:
+            self.runs.append(self.new_run(self.data_task, {}, None,
+                                          self.result_history_name,
+                                          self.result_dir))
+        # Shortest expected job first, older jobs overtake with time
+        self.features = self.job_features(input_size)
+        if self.model:
+            estimate = self.model.estimate(self.features)
+            self.priority = self.arrival + estimate / self.options["aging"]
+            self.logger.info("{0} is expected to last {1} s".format(
+                self.data_task["name"], int(estimate)))
+
+    def resume(self):
+        """Take over a job of doing whose daemon stopped renewing its lease
+          Returns: The stage to start from, None if the job is not taken
+        """
+        name = os.path.splitext(os.path.basename(self.task_file))[0]
+        if not self.leases.acquire(name, self):
+            return None
+        self.logger.info("Take over {0}".format(self.task_file))
+        self.data_task = self.load_json()
+        if self.data_task == None:
+            self.release_lease(name)
+            return None
+        if self.data_task.get('cached'):
+            # Archive copied from the cache, the reads may be deleted
+            self.data_history_name = self.data_task['data_history_name']
+            self.result_history_name = self.data_task['result_history_name']
+            self.lib_name = 'lib_' + self.data_history_name[len('data_'):]
+            self.setup(self.input_size())
+            if not os.path.isfile(self.zip_file):
+                self.fail("Shaman cannot resume the job for the key {0}, "
+                          "its archive is missing".format(
+                              self.data_task["name"].replace("file", "")))
+                self.release_lease(name)
+                return None
+            self.cached_file = self.zip_file
+            self.start_time = time.time()
+            self.reserve()
+            return "package"
+        if 'invocation_id' not in self.data_task:
+            # Uploads cannot be resumed, the partial history is purged
+            if 'data_history_name' in self.data_task:
+                for history in self.gi.histories.get_histories(
+                        name=self.data_task['data_history_name']):
+                    self.gi.histories.delete_history(history['id'],
+                                                     purge=True)
+            self.name_histories()
+            # Sending again a part of the reads would give a wrong result
+            missing = [fastq_file for fastq_file in
+                       self.data_task.get('input_files', [])
+                       if not os.path.isfile(fastq_file)]
+            if missing:
+                self.logger.error("Cannot resume {0}, reads are missing: {1}"
+                                  .format(self.task_file, ", ".join(missing)))
+                self.fail("Shaman cannot resume the job for the key {0}, "
+                          "some reads are missing".format(
+                              self.data_task["name"].replace("file", "")))
+                self.release_lease(name)
+                return None
+            self.data_task['data_history_name'] = self.data_history_name
+            self.data_task['result_history_name'] = self.result_history_name
+            self.save_task()
+            self.setup(self.input_size())
+            self.reserve()
+            return "upload"
+        self.data_history_name = self.data_task['data_history_name']
+        self.result_history_name = self.data_task['result_history_name']
+        self.lib_name = 'lib_' + self.data_history_name[len('data_'):]
+        self.setup(self.input_size())
+        # Galaxy state of the previous owner
+        self.start_time = time.time()
+        self.progress.update("upload", 1.0)
+        self.progress.update("data", 1.0)
+        self.workflow = [self.gi.workflows.show_workflow(
+            self.data_task['workflow_id'])]
+        self.tool_steps = len([
+            step for step in self.workflow[0]['steps'].values()
+            if step['type'] not in input_step_types])
+        for history in self.gi.histories.get_histories(
+                name=self.data_history_name):
+            self.data_history = history
+        for lib in self.gi.libraries.get_libraries(name=self.lib_name):
+            self.lib = lib
+        invocation_ids = [self.data_task['invocation_id']]
+        if "sweep" in self.data_task:
+            invocation_ids = [run['invocation_id']
+                              for run in self.data_task['runs']]
+        for run, invocation_id in zip(self.runs, invocation_ids):
+            invocation = self.gi.invocations.show_invocation(invocation_id)
+            run['invocation'] = {'id': invocation_id,
+                                 'history_id': invocation['history_id']}
+            run['result_history'] = {'id': invocation['history_id'],
+                                     'name': run['result_history_name']}
+            run['status'] = "running"
+        # Purged by the janitor of this host from now on
+        if self.data_history:
+            self.track("history", self.data_history)
+        if self.lib:
+            self.track("library", self.lib)
+        for run in self.runs:
+            self.track("history", run['result_history'])
+        if self.janitor and "batch_history_name" in self.data_task:
+            # Kept while a job of the batch is in doing
+            batch_name = self.data_task['batch_history_name']
+            for history in self.gi.histories.get_histories(name=batch_name):
+                self.janitor.track("history", history, batch_name)
+            self.janitor.release(batch_name, 0)
+        self.reserve()
+        self.resumed = True
+        return "execute"
+
+    def reserve(self):
+        """Count the resources of a job taken over in the admission
+        """
+        if self.admission:
+            self.admission.reserve(self.data_history_name,
+                                   self.progress.total_bytes, len(self.runs))
+
+    def release_lease(self, name=None):
+        """Let the other daemons claim the task
+        """
+        if self.leases:
+            if name is None:
+                name = self.data_task["name"]
+            self.leases.release(name)
+
+    def job_features(self, input_size):
+        """Describe the job for the runtime model
+        """
+        num_files = 0
+        for path in self.input_paths():
+            num_files += len(glob.glob('{0}/*.f*q*'.format(path)))
+        return {"type": self.data_task["type"],
+                "paired": bool(self.data_task["paired"]),
+                "host": self.data_task["host"] != "",
+                "num_files": num_files, "input_size": input_size,
+                "databases": len(self.list_result['biom']),
+                "runs": len(self.runs)}
+
+    def new_run(self, run_task, parameters, index, result_history_name,
+                result_dir):
+        """Describe one invocation of the workflow
+        """
+        return {'index': index, 'task': run_task, 'parameters': parameters,
+                'result_history_name': result_history_name,
+                'result_history': None, 'invocation': None,
+                'result_dir': result_dir, 'delivered': {}, 'deliverer': None,
+                'fraction': 0.0, 'status': "new",
+                'list_downloaded_files': []}
+
+    def invoke(self, run):
+        """Create the result history of a run and invoke the workflow
+        """
+        run['result_history'] = self.gi.histories.create_history(
+                                    name=run['result_history_name'])
+        self.track("history", run['result_history'])
+        self.logger.info("Load workflow for {0} : {1}".format(
+            self.data_history_name, run['result_history']['id']))
+        run['invocation'] = self.gi.workflows.invoke_workflow(
+            self.workflow[0]['id'], inputs=self.dataset_map,
+            params=self.get_params(run['task']),
+            history_id=run['result_history']['id'])
+        run['status'] = "running"
+
+    def upload(self):
+        """Create the data history, send the reads and identify the workflow
+        """
+        self.start_time = time.time()
+        self.enter("upload")
+        if self.cache:
             try:
-                # Create an history
-                self.logger.info("Starting new history {0}".format(
-                    data_history_name))
-                data_history = self.gi.histories.create_history(
-                    name=data_history_name)
-                self.logger.info("Load data for {0} : {1}".format(
-                    data_history_name, data_history['id']))
-                # Send data to the history
-                if self.data_task["paired"]:
-                    if (self.check_file_size(self.data_task["path_R1"]) or 
-                        self.check_file_size(self.data_task["path_R2"])):
-                        lib = self.gi.libraries.create_library(lib_name)
-                        #, count_fastq
-                        workflow, dataset_map = self.paired_process(
-                            data_history, lib)
-                    else:
-                        #, count_fastq
-                        workflow, dataset_map = self.paired_process(data_history)
-                else:
-                    # Check file size
-                    if self.check_file_size(self.data_task["path"]):
-                        lib = self.gi.libraries.create_library(lib_name)
-                        #, count_fastq
-                        workflow, dataset_map = self.single_process(
-                            data_history, lib)
-                    else:
-                        #, count_fastq
-                        workflow, dataset_map = self.single_process(data_history)
+                self.cache_key_value = self.cache_key()
+                if self.cache.get(self.cache_key_value, self.zip_file):
+                    self.cached_file = self.zip_file
             except:
-                self.logger.error("Shaman failed to submit data for the history {0}"
-                    .format(data_history_name))
+                self.logger.error("Failed to look for {0} in the cache"
+                                  .format(self.data_task["name"]))
                 self.logger.error(sys.exc_info()[1])
-                shutil.move(self.task_file, self.error_dir +  
-                            os.path.basename(self.task_file))
-                message = "Shaman failed to submit data for the history {0}".format(self.data_task["name"].replace("file", ""))
-                self.send_mail(message)
-                # if lib:
-                #    self.gi.libraries.delete_library(lib['id'])
-                # #delete_history
-                # if data_history:
-                #     self.gi.histories.delete_history(data_history['id'], purge=True)
-                data_history = None
-            # Run workflow
-            if data_history:
-                if self.check_progress(data_history):
-                    try:
-                        if dataset_map:
-                            #result_history = data_history
-                            result_history = self.gi.histories.create_history(
-                                                 name=result_history_name)
-                            self.logger.info("Load workflow for {0} : {1}".format(
-                            data_history_name, result_history['id']))
-                            align_dict = {
-                            'id':self.data_task["aKmin"],
-                            'strand':self.data_task["annotationstrand"]
-                            }
-                            clustering_dict = {
-                                'id':self.data_task["clusteringthreshold"],
-                                'strand':self.data_task["clusteringstrand"]
-                            }
-                            annot_dict = {
-                                'aKmin':self.data_task["aKmin"],
-                                'aPmin':self.data_task["aPmin"],
-                                'aPmax':self.data_task["aPmax"],
-                                'aCmin':self.data_task["aCmin"],
-                                'aCmax':self.data_task["aCmax"],
-                                'aOmin':self.data_task["aOmin"],
-                                'aOmax':self.data_task["aOmax"],
-                                'aFmin':self.data_task["aFmin"],
-                                'aFmax':self.data_task["aFmax"],
-                                'aGmin':self.data_task["aGmin"],
-                                'aGmax':self.data_task["aGmax"],
-                                'aSmin':self.data_task["aSmin"]
-                            }
-                            quality_dict = {
-                                'q': self.data_task["phredthres"],
-                                'p': self.data_task["mincorrect"],
-                                'l': self.data_task["minreadlength"]
-                            }
-                            derep_dict = {
-                                'derep_method': self.data_task["dreptype"],
-                                'minseqlength': self.data_task["minampliconlength"]
-                            }
-                            # paired end with host
-                            if self.data_task['host'] != "" and self.data_task["paired"]:
-                                params = {
-                                    # From 3 to 4
-                                    "4":{"reference_genome|index":self.data_task["host"]},
-                                    # From 5 to 3
-                                    "3": quality_dict,
-                                    "7":{
-                                    'pattern|sub_pattern': self.data_task["pattern_R1"],
-                                    'max_amplicon_length':self.data_task["maxampliconlength"]},
-                                    "9": derep_dict,
-                                    "10":{'sorting_mode|minsize':self.data_task["minabundance"]},
-                                    #Clustering
-                                    "12":clustering_dict
-                                         }
-                                if self.data_task["type"] == "16S" :
-                                    params.update(
-                                        {
-                                        #Count matrix
-                                        "16":clustering_dict,
-                                        #Greengenes
-                                        "14":align_dict,
-                                        "18":annot_dict,
-                                        #Silva
-                                        "15":align_dict,
-                                        "19":annot_dict,
-                                        #Extract Result
-                                        "23":{'paired|pattern': self.data_task["pattern_R1"]}
-                                        }
-                                    )
-                                elif self.data_task["type"] == "18S" or self.data_task["type"] == "23S_28S":
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "16":clustering_dict,
-                                        # Silva
-                                        "14":align_dict,
-                                        "17":annot_dict,
-                                        # Extract Result
-                                        "20":{'paired|pattern': self.data_task["pattern_R1"]}
-                                        }
-                                    )
-                                else:
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "17":clustering_dict,
-                                        # Findley
-                                        "14":align_dict,
-                                        "19":annot_dict,
-                                        # Underhill
-                                        "15":align_dict,
-                                        "20":annot_dict,
-                                        # Unite
-                                        "18":align_dict,
-                                        "21":annot_dict,
-                                        # new 26 instead of 28 Extract Result
-                                        "26":{'paired|pattern': self.data_task["pattern_R1"]}
-                                        }
-                                    )
-                                self.gi.workflows.invoke_workflow(
-                                    workflow[0]['id'], inputs=dataset_map,
-                                    params=params, history_id=result_history['id'])
-                            # paired end no host
-                            elif self.data_task['host'] == "" and self.data_task["paired"]:
-                                params={
-                                    "3":quality_dict,
-                                    "5":{'pattern|sub_pattern': self.data_task["pattern_R1"]},
-                                    "7": derep_dict,
-                                    "8":{'sorting_mode|minsize':self.data_task["minabundance"]},
-                                    #Clustering
-                                    "10":clustering_dict,
-                                    }
-                                if self.data_task["type"] == "16S":
-                                    params.update(
-                                        {
-                                        #Count matrix
-                                        "14":clustering_dict,
-                                        #Greengenes
-                                        "12":align_dict, "16":annot_dict,
-                                        #Silva
-                                        "13":align_dict, "17":annot_dict,
-                                        #Extract result
-                                        "21":{'paired|pattern' : self.data_task["pattern_R1"]}
-                                        }
-                                    )
-                                elif self.data_task["type"] == "18S":
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "14":clustering_dict,
-                                        # Silva
-                                        "12":align_dict, "15":annot_dict,
-                                        # Extract result
-                                        "17":{'paired|pattern': self.data_task["pattern_R1"]}
-                                        }
-                                    )
-                                elif self.data_task["type"] == "23S_28S":
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "14":clustering_dict,
-                                        # Silva
-                                        "12":align_dict, "15":annot_dict,
-                                        # Extract result
-                                        "18":{'paired|pattern': self.data_task["pattern_R1"]}
-                                        }
-                                    )
-                                else:
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "15":clustering_dict,
-                                        # Findley
-                                        "12":align_dict, "17":annot_dict,
-                                        # Underhill
-                                        "13":align_dict, "18":annot_dict,
-                                        # Unite
-                                        "16":align_dict, "19":annot_dict,
-                                        # Extract result
-                                        #new 24 instead of 26
-                                        "24":{'paired|pattern': self.data_task["pattern_R1"]}
-                                        }
-                                    )
-                                self.gi.workflows.invoke_workflow(
-                                    workflow[0]['id'], inputs=dataset_map,
-                                    params=params, history_id=result_history['id'])
-                            # single end with host
-                            elif self.data_task['host'] != "" and not self.data_task["paired"]:
-                                params={
-                                    # 2 to 3
-                                    "3":{"reference_genome|index":self.data_task["host"]},
-                                    # 4 to 2
-                                    "2":quality_dict,
-                                    "5":{'max_amplicon_length':self.data_task["maxampliconlength"]},
-                                    "7": derep_dict,
-                                    "8":{'sorting_mode|minsize':self.data_task["minabundance"]},
-                                    #Clustering
-                                    "10":clustering_dict,
-                                    }
-                                if self.data_task["type"] == "16S":
-                                    params.update(
-                                        {
-                                        #Count matrix
-                                        "15":clustering_dict,
-                                        #Greengenes
-                                        "12":align_dict, "16":annot_dict,
-                                        #Silva
-                                        "13":align_dict, "17":annot_dict
-                                        }
-                                    )
-                                elif self.data_task["type"] == "18S" or self.data_task["type"] == "23S_28S":
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "14":clustering_dict,
-                                        # Silva
-                                        "12":align_dict, "15":annot_dict
-                                        }
-                                    )
-                                else:
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "15":clustering_dict,
-                                        # Findley
-                                        "12":align_dict, "17":annot_dict,
-                                        # Underhill
-                                        "13":align_dict, "18":annot_dict,
-                                        # Unite
-                                        "16":align_dict, "19":annot_dict
-                                        }
-                                    )
-                                self.gi.workflows.invoke_workflow(
-                                    workflow[0]['id'], inputs=dataset_map,
-                                    params=params,
-                                    history_id=result_history['id'])
-                            # single end no host
-                            else:
-                                params={
-                                    "2":quality_dict,
-                                    "3":{'max_amplicon_length':self.data_task["maxampliconlength"]},
-                                    "5":derep_dict,
-                                    "6":{'sorting_mode|minsize':self.data_task["minabundance"]},
-                                    # Clustering
-                                    "8":clustering_dict
-                                }
-                                if self.data_task["type"] == "16S":
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "13":clustering_dict,                                        
-                                        # Greengenes
-                                        "10":align_dict, "14":annot_dict,
-                                        # Silva
-                                        "11":align_dict, "15":annot_dict
-                                        }
-                                    )
-                                elif self.data_task["type"] == "18S" or self.data_task["type"] == "23S_28S":
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "12":clustering_dict,
-                                        # Silva
-                                        "10":align_dict, "13":annot_dict
-                                        }
-                                    )
-                                else:
-                                    params.update(
-                                        {
-                                        # Count matrix
-                                        "13":clustering_dict,
-                                        # Findley
-                                        "10":align_dict, "15":annot_dict,
-                                        # Underhill
-                                        "11":align_dict, "16":annot_dict,
-                                        # Unite
-                                        "14":align_dict, "17":annot_dict
-                                        }
-                                    )
-                                self.gi.workflows.invoke_workflow(
-                                    workflow[0]['id'], inputs=dataset_map,
-                                    params=params,
-                                    history_id=result_history['id'])
-                    except:
-                        self.logger.error("Job failed at execution for the history: {0}"
-                            .format(result_history_name))
-                        self.logger.error(sys.exc_info()[1])
-                        shutil.move(self.task_file, self.error_dir +  
-                                    os.path.basename(self.task_file))
-                        message = "Workflow failed to start for the key: {0}".format(self.data_task["name"].replace("file", ""))
-                        self.send_mail(message)
-                        # # Delete history
-                        # if lib:     
-                        #    self.gi.libraries.delete_library(lib['id'])
-                        # #delete_history
-                        # if data_history:
-                        #     self.gi.histories.delete_history(data_history['id'], purge=True)
-                        # if result_history:
-                        #     self.gi.histories.delete_history(result_history['id'], purge=True)
-                        # result_history = None
-            #, count_fastq
-            if result_history:
-                if self.check_progress(result_history, 100.0):
-                    # Remove reads after success
-                    self.logger.info("Workflow finished work for {0} : {1}".format(
-                        data_history_name, result_history['id']))
-                    # Download results
-                    download_success, list_downloaded_files = self.download_result(
-                                            result_history['id'], list_result,
-                                            result_dir)
-                    # Build archive
-                    #jeha_id = self.gi.histories.export_history(result_history['id'], wait=True)
-
-                    # Download archive
-                    #download_success = self.download_result(
-                    #                        result_history['id'], 
-                    #                        jeha_id, result_file)
-                    # Send mail
-                    #if os.path.isfile(result_file) and download_success:
-                    if download_success:
-                        self.logger.info("Download succeded for {0} : {1}".format(
-                        data_history_name, result_history['id']))
-                        # Prepare zip
-                        self.zip_archive(list_downloaded_files, zip_file)
-                        # Send email
-                        # solve file size problem
-                        message = ("Shaman result is available for the key {0}"
-                            .format(self.data_task["name"].replace("file", "")))
-                        self.send_mail(message, zip_file)
-                        shutil.move(self.task_file, self.done_dir + 
-                                    os.path.basename(self.task_file))
-                        # Delete_history
-                        if lib:
-                           self.gi.libraries.delete_library(lib['id'])
-                        self.gi.histories.delete_history(data_history['id'], purge=True)
-                        self.gi.histories.delete_history(result_history['id'], purge=True)
-                    else:
-                        self.logger.error("Failed to download result file for {0}"
-                            .format(result_history_name))
-                        shutil.move(self.task_file, self.error_dir +  
-                                    os.path.basename(self.task_file))
-                        message = ("Workflow failed to download the results for the key {0}"
-                                   .format(self.data_task["name"].replace("file", "")))
-                        self.send_mail(message)
-                        # handle error message
-                        #print("Job failed during download", file=sys.stderr)
+            if self.cached_file:
+                self.logger.info("Result of {0} found in the cache".format(
+                    self.data_task["name"]))
+                # Resumed from the archive after a take over
+                self.data_task['cached'] = True
+                if self.delete_mode and self.save_task():
+                    for path in self.input_paths():
+                        for fastq_file in glob.glob('{0}/*.f*q*'.format(path)):
+                            os.remove(fastq_file)
+                return True
+        self.spawn_preview()
+        if self.share:
+            self.share.open(self.data_task["mail"])
+        try:
+            # Create an history
+            self.logger.info("Starting new history {0}".format(
+                self.data_history_name))
+            self.data_history = self.gi.histories.create_history(
+                name=self.data_history_name)
+            self.track("history", self.data_history)
+            self.logger.info("Load data for {0} : {1}".format(
+                self.data_history_name, self.data_history['id']))
+            # Send data to the history
+            if self.data_task["paired"]:
+                if (self.check_file_size(self.data_task["path_R1"]) or
+                    self.check_file_size(self.data_task["path_R2"])):
+                    self.lib = self.gi.libraries.create_library(self.lib_name)
+                    self.track("library", self.lib)
+                    self.workflow, self.dataset_map = self.paired_process(
+                        self.data_history, self.lib)
+                else:
+                    self.workflow, self.dataset_map = self.paired_process(
+                        self.data_history)
+            else:
+                # Check file size
+                if self.check_file_size(self.data_task["path"]):
+                    self.lib = self.gi.libraries.create_library(self.lib_name)
+                    self.track("library", self.lib)
+                    self.workflow, self.dataset_map = self.single_process(
+                        self.data_history, self.lib)
                 else:
-                    self.logger.error("Workflow failed during progression for the key {0}"
-                        .format(result_history_name))
-                    #message = "Workflow failed during progression for the key {0}".format(self.data_task["name"].replace("file", ""))
-                    #self.send_mail(message)
-                    if(os.path.isfile(self.task_file)):
-                        shutil.move(self.task_file, self.error_dir +  
-                                    os.path.basename(self.task_file))
-                    # # delete_library
-                    # if lib:
-                    #   self.gi.libraries.delete_library(lib['id'])
-                    # # delete_history
-                    # if data_history:
-                    #    self.gi.histories.delete_history(data_history['id'], purge=True)
-                    # if result_history:
-                    #    self.gi.histories.delete_history(result_history['id'], purge=True)
+                    self.workflow, self.dataset_map = self.single_process(
+                        self.data_history)
+        except:
+            self.logger.error("Shaman failed to submit data for the history {0}"
+                .format(self.data_history_name))
+            self.logger.error(sys.exc_info()[1])
+            message = "Shaman failed to submit data for the history {0}".format(self.data_task["name"].replace("file", ""))
+            self.fail(message)
+            # if lib:
+            #    self.gi.libraries.delete_library(lib['id'])
+            # #delete_history
+            # if data_history:
+            #     self.gi.histories.delete_history(data_history['id'], purge=True)
+            self.data_history = None
+            return False
+        finally:
+            if self.share:
+                self.share.close(self.data_task["mail"])
+        return True
 
-def isdir(path):
-    """Check if path is an existing file.
-      Arguments:
-          path: Path to the file
-    """
-    if not os.path.isdir(path):
-        if os.path.isfile(path):
-            msg = "{0} is a file.".format(path)
+    def start_workflow(self):
+        """Wait for the data and invoke the workflow of each run
+        """
+        self.enter("data")
+        if self.options["upload_wait"]:
+            if not self.check_progress(self.data_history, "data"):
+                self.logger.error("Data upload failed for the history {0}"
+                    .format(self.data_history_name))
+                self.fail()
+                return False
         else:
-            msg = "{0} does not exist.".format(path)
-        raise argparse.ArgumentTypeError(msg)
-    return path
+            # Galaxy holds the workflow jobs until their inputs are ready
+            self.watcher = upload_watcher(self.logger, self.gi,
+                                          self.data_history, self.progress,
+                                          self.options["poll_time"])
+            self.watcher.start()
+        try:
+            #result_history = data_history
+            for run in self.runs:
+                self.invoke(run)
+            # Keep the invocations to follow or resume them
+            self.data_task['workflow_id'] = self.workflow[0]['id']
+            self.data_task['invocation_id'] = self.runs[0]['invocation']['id']
+            if "sweep" in self.data_task:
+                self.data_task['runs'] = [
+                    {'result_history_name': run['result_history_name'],
+                     'invocation_id': run['invocation']['id'],
+                     'parameters': run['parameters']} for run in self.runs]
+            if self.save_task():
+                self.remove_reads()
+            self.enter("workflow")
+            # Steps running galaxy jobs
+            self.tool_steps = len([
+                step for step in self.gi.workflows.show_workflow(
+                    self.workflow[0]['id'])['steps'].values()
+                if step['type'] not in input_step_types])
+        except:
+            self.logger.error("Job failed at execution for the history: {0}"
+                .format(self.result_history_name))
+            self.logger.error(sys.exc_info()[1])
+            if self.watcher:
+                self.watcher.stop()
+            message = "Workflow failed to start for the key: {0}".format(self.data_task["name"].replace("file", ""))
+            self.fail(message)
+            # # Delete history
+            # if lib:
+            #    self.gi.libraries.delete_library(lib['id'])
+            # #delete_history
+            # if data_history:
+            #     self.gi.histories.delete_history(data_history['id'], purge=True)
+            # if result_history:
+            #     self.gi.histories.delete_history(result_history['id'], purge=True)
+            # result_history = None
+            return False
+        return True
 
+    def execute(self):
+        """Wait for the data, run the workflow and follow its progression
+        """
+        if self.cached_file:
+            return True
+        if self.resumed:
+            self.enter("workflow")
+        elif not self.start_workflow():
+            return False
+        if self.options["incremental"]:
+            for run in self.runs:
+                run['deliverer'] = result_watcher(
+                    self.logger, self.gi, run['result_history'],
+                    self.list_result, run['result_dir'], run['delivered'],
+                    self.options["poll_time"])
+                run['deliverer'].start()
+        # The invocations of a sweep are followed at the same time
+        if len(self.runs) == 1:
+            self.check_invocation(self.runs[0])
+        else:
+            monitors = [Thread(target=self.check_invocation, args=(run,))
+                        for run in self.runs]
+            for monitor in monitors:
+                monitor.start()
+            for monitor in monitors:
+                monitor.join()
+        if self.watcher:
+            self.watcher.stop()
+        for run in self.runs:
+            if run['deliverer']:
+                run['deliverer'].stop()
+                run['deliverer'].join()
+        if self.cancelled.is_set():
+            # Checkpointed for another daemon or cancelled, not a failure
+            self.logger.info("Stop following the workflow of {0}: {1}"
+                             .format(self.result_history_name,
+                                     self.cancel_reason))
+            return False
+        if not [run for run in self.runs if run['status'] == "done"]:
+            self.logger.error("Workflow failed during progression for the key {0}"
+                .format(self.result_history_name))
+            #message = "Workflow failed during progression for the key {0}".format(self.data_task["name"].replace("file", ""))
+            self.fail()
+            # # delete_library
+            # if lib:
+            #   self.gi.libraries.delete_library(lib['id'])
+            # # delete_history
+            # if data_history:
+            #    self.gi.histories.delete_history(data_history['id'], purge=True)
+            # if result_history:
+            #    self.gi.histories.delete_history(result_history['id'], purge=True)
+            return False
+        for run in self.runs:
+            self.logger.info("Workflow {0} for {1} : {2}".format(
+                run['status'], self.data_history_name,
+                run['result_history']['id']))
+        return True
 
-def getArguments():
-    """Retrieves the arguments of the program.
-      Returns: An object that contains the arguments
-    """
-    # Parsing arguments
-    parser = argparse.ArgumentParser(description=__doc__, usage=
-                                     "{0} -h".format(sys.argv[0]))
-    parser.add_argument('-u', dest='galaxy_url', type=str, #required=True,
-                        default='https://galaxy.pasteur.fr',
-                        #default='https://galaxy-dev.pasteur.fr',
-                        #default='https://maestro-galaxy-dev.maestro.pasteur.fr',
-                        #default='http://127.0.0.1:8080',
-                        help='Url to galaxy.')
-    parser.add_argument('-k', dest='galaxy_key', type=str, #required=True,
-                        default='31f05d9edaa2228b66c538f43b0d5d52',
-                        #default=keyring.get_password("galaxy", "aghozlan"),
-                        #default='7ac30484f696937116f960531a05c2b6',
-                        #default='f293dce7785a77c338db9e8b8df9922c',
-                        help='User galaxy key.')
-    parser.add_argument('-w', dest='work_dir', type=isdir, required=True,
-                        action=FullPaths, help='Path to the top directory.')
-    parser.add_argument('-i', dest='interactive_mode', action='store_false',
-                        default=True, help='Do not detatch process.')
-    parser.add_argument('-s', dest='https_mode', action='store_true',
-                        default=False, help='Activate https verification.')
-    parser.add_argument('-d', dest='delete_mode', action='store_true',
-                        default=False, help='Delete reads provided as input.')
-    args = parser.parse_args()
-    return args
+    def write_manifest(self):
+        """Describe the runs of a sweep in the archive
+        """
+        manifest_file = self.result_dir + "manifest.json"
+        manifest = {'name': self.data_task["name"].replace("file", ""),
+                    'runs': []}
+        for run in self.runs:
+            manifest['runs'].append({
+                'run': "run_{0}".format(run['index']),
+                'parameters': run['parameters'],
+                'status': run['status'],
+                'result_history_name': run['result_history_name'],
+                'files': [os.path.relpath(file, self.result_dir)
+                          for file in run['list_downloaded_files']]})
+        with open(manifest_file, "wt") as manifest_json:
+            json.dump(manifest, manifest_json, indent=2)
+        return manifest_file
 
+    def download(self):
+        """Download the result files
+        """
+        if self.cached_file:
+            return True
+        self.enter("download")
+        for run in self.runs:
+            if self.cancelled.is_set():
+                return False
+            if run['status'] != "done":
+                continue
+            # One archive rather than one request per file
+            expected = sum(len(self.list_result[result_type])
+                           for result_type in self.list_result)
+            if expected - len(run['delivered']) >= self.options["export_threshold"]:
+                try:
+                    run['delivered'].update(self.export_result(
+                        run['result_history']['id'], self.list_result,
+                        run['result_dir']))
+                except:
+                    self.logger.error("Failed to export the history {0}"
+                                      .format(run['result_history_name']))
+                    self.logger.error(sys.exc_info()[1])
+            download_success, run['list_downloaded_files'] = self.download_result(
+                                    run['result_history']['id'], self.list_result,
+                                    run['result_dir'], run['delivered'])
+            if download_success and self.options["verify"]:
+                download_success = self.verify_result(run)
+            if download_success:
+                self.list_downloaded_files += run['list_downloaded_files']
+                self.logger.info("Download succeded for {0} : {1}".format(
+                    self.data_history_name, run['result_history']['id']))
+            else:
+                run['status'] = "download failed"
+                self.logger.error("Failed to download result file for {0}"
+                    .format(run['result_history_name']))
+        if not self.list_downloaded_files:
+            message = ("Workflow failed to download the results for the key {0}"
+                       .format(self.data_task["name"].replace("file", "")))
+            self.fail(message)
+            # handle error message
+            #print("Job failed during download", file=sys.stderr)
+            return False
+        return True
 
-def get_log(path_log):
-    """
-    """
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
-    # Create log file
-    file_handler = RotatingFileHandler(path_log, 'a', 1000000, 1)
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    # Stream in the the console
-    ## TO REMOVE IF daemon
-    stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(logging.DEBUG)
-    logger.addHandler(stream_handler)
-    return logger
+    def build_columnar(self, run):
+        """Add a columnar copy of the OTU table and the annotations
+        """
+        for tsv_file in list(run['list_downloaded_files']):
+            name = os.path.basename(tsv_file)
+            if not (name == "shaman_otu_table.tsv" or
+                    (name.endswith("_annotation.tsv") and
+                     not name.startswith("shaman_process"))):
+                continue
+            try:
+                columnar_file = export_columnar(tsv_file,
+                                                self.options["columnar"])
+                run['list_downloaded_files'].append(columnar_file)
+                self.list_downloaded_files.append(columnar_file)
+            except (ImportError, ValueError, IOError):
+                self.logger.error("Failed to convert {0}".format(tsv_file))
+                self.logger.error(sys.exc_info()[1])
 
+    def build_summary(self, run):
+        """Add the precomputed statistics of the OTU table
+        """
+        otu_table_file = run['result_dir'] + "shaman_otu_table.tsv"
+        if otu_table_file not in run['list_downloaded_files']:
+            return
+        annotation_files = [
+            tsv_file for tsv_file in run['list_downloaded_files']
+            if tsv_file.endswith("_annotation.tsv") and
+            not os.path.basename(tsv_file).startswith("shaman_process")]
+        try:
+            summary_files = summarize(otu_table_file, annotation_files,
+                                      run['result_dir'] + "summary" + os.sep)
+            run['list_downloaded_files'] += summary_files
+            self.list_downloaded_files += summary_files
+        except (ImportError, ValueError, IOError):
+            self.logger.error("Failed to summarize {0}".format(
+                otu_table_file))
+            self.logger.error(sys.exc_info()[1])
 
-def check_work(todo_dir):
-    """Check if a new job need to be done
-    """
-    return glob.glob('{0}/*.json'.format(todo_dir))
+    def rename_manifest(self):
+        """Name the job in the manifest of an archive from the cache
+        """
+        tmp_path = "{0}.{1}".format(self.zip_file, uuid.uuid4().hex[:8])
+        # The archive may be a link to the cache, it is written again
+        with zipfile.ZipFile(self.zip_file, 'r') as cached:
+            if "manifest.json" not in cached.namelist():
+                return
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                for item in cached.infolist():
+                    data = cached.read(item.filename)
+                    if item.filename == "manifest.json":
+                        manifest = json.loads(data.decode("utf-8"))
+                        manifest['name'] = self.data_task["name"].replace(
+                            "file", "")
+                        data = json.dumps(manifest, indent=2)
+                    zipf.writestr(item, data)
+        os.replace(tmp_path, self.zip_file)
 
-def create_dir(list_dir):
-    """
-    """
-    try:
-        for dir_path in list_dir:
-            os.mkdir(dir_path)
-    except FileExistsError:
-        pass
+    def package(self):
+        """Build the zip archive
+        """
+        if self.cached_file:
+            if "sweep" in self.data_task:
+                self.rename_manifest()
+            return True
+        if self.options["columnar"]:
+            for run in self.runs:
+                self.build_columnar(run)
+        if self.options["summary"]:
+            for run in self.runs:
+                self.build_summary(run)
+        if "sweep" in self.data_task:
+            self.list_downloaded_files.append(self.write_manifest())
+        self.zip_archive(self.list_downloaded_files, self.zip_file,
+                         self.result_dir)
+        # Only complete results are reused
+        if (self.cache and self.cache_key_value and
+            not [run for run in self.runs if run['status'] != "done"]):
+            self.cache.put(self.cache_key_value, self.zip_file)
+        return True
 
+    def notify(self):
+        """Send the result, close the task and clear galaxy
+        """
+        # solve file size problem
+        message = ("Shaman result is available for the key {0}"
+            .format(self.data_task["name"].replace("file", "")))
+        if "preview_of" in self.data_task:
+            message = ("Shaman preview on {0} reads per sample is available "
+                       "for the key {1}, check the parameters before the end "
+                       "of the full analysis".format(
+                           self.data_task["preview_reads"],
+                           self.data_task["preview_of"].replace("file", "")))
+        failed_runs = [run['index'] for run in self.runs
+                       if run['status'] != "done"]
+        if failed_runs:
+            message += (" except for the runs {0}, see manifest.json"
+                        .format(", ".join(str(index) for index in failed_runs)))
+        self.send_mail(message, self.zip_file)
+        shutil.move(self.task_file, self.done_dir +
+                    os.path.basename(self.task_file))
+        self.progress.finish("done")
+        self.leave_batch("done")
+        self.clear_preview()
+        if self.admission:
+            self.admission.release(self.data_history_name)
+        # Complete galaxy executions teach the runtime model
+        if (self.model and not self.cached_file and not failed_runs and
+            self.start_time):
+            self.model.record(self.features, time.time() - self.start_time)
+        # Delete_history
+        if self.janitor:
+            # Purged later by the janitor if the deletion fails
+            self.janitor.release(self.data_history_name, 0)
+        if self.lib:
+           self.gi.libraries.delete_library(self.lib['id'])
+        if self.data_history:
+            self.gi.histories.delete_history(self.data_history['id'],
+                                             purge=True)
+        for run in self.runs:
+            if run['result_history']:
+                self.gi.histories.delete_history(run['result_history']['id'],
+                                                 purge=True)
+        if self.janitor:
+            self.janitor.forget(self.data_history_name)
+        return True
 
-def pandaemonium(path_log, galaxy_url, galaxy_key, work_dir, https_mode, 
-                 delete_mode):
-    """Daemon function that should do something
+    def run(self):
+        """Upload, run galaxy workflow and dowload results
+        """
+        if self.prepare() and self.upload() and self.execute() and self.download():
+            self.package()
+            self.notify()
+
+
+class multipart_body(object):
+    """Multipart form read by requests like a file, the files are streamed
     """
-    todo_dir = work_dir + os.sep + "todo" + os.sep
-    doing_dir = work_dir + os.sep + "doing" + os.sep
-    done_dir = work_dir + os.sep + "done" + os.sep
+
+    def __init__(self, fields, files, progress=None, chunk_size=1048576,
+                 share=None, mail=None, compressor=None):
+        self.boundary = uuid.uuid4().hex
+        self.fields = fields
+        self.files = files
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.share = share
+        self.mail = mail
+        self.compressor = compressor
+        self.length = len(self.closing())
+        for name, value in self.fields:
+            self.length += len(self.field_header(name)) + len(value.encode()) + 2
+        for name, path in self.files:
+            if self.compressed(path):
+                # Known once sent, the body goes chunked
+                self.length = None
+                break
+            self.length += (len(self.file_header(name, path)) +
+                            os.path.getsize(path) + 2)
+        if self.length is not None:
+            # Read by requests for the content length, the body goes
+            # chunked without it
+            self.len = self.length
+        self.chunks = self.generate()
+        self.buffer = b""
+        self.offset = 0
+
+    def content_type(self):
+        """Content type with the boundary
+        """
+        return "multipart/form-data; boundary={0}".format(self.boundary)
+
+    def field_header(self, name):
+        """Start of a form field
+        """
+        return ('--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n'
+                .format(self.boundary, name)).encode()
+
+    def file_header(self, name, path):
+        """Start of a form file
+        """
+        filename = os.path.basename(path)
+        if self.compressed(path):
+            filename += ".gz"
+        return ('--{0}\r\nContent-Disposition: form-data; name="{1}"; '
+                'filename="{2}"\r\nContent-Type: application/octet-stream'
+                '\r\n\r\n'.format(self.boundary, name, filename)).encode()
+
+    def compressed(self, path):
+        """Check if a file is compressed on the fly
+        """
+        return self.compressor is not None and not path.endswith(".gz")
+
+    def closing(self):
+        """End of the form
+        """
+        return "--{0}--\r\n".format(self.boundary).encode()
+
+    def file_chunks(self, path):
+        """Content of a file by chunks, gzipped when it is raw fastq
+        """
+        if self.compressed(path):
+            chunks = self.compressor.stream(path, self.progress)
+        else:
+            chunks = self.read_chunks(path)
+        for chunk in chunks:
+            # Bandwidth shared with the uploads of the other users
+            if self.share:
+                self.share.consume(self.mail, len(chunk))
+            yield chunk
+
+    def read_chunks(self, path):
+        """Content of a file as it is
+        """
+        with open(path, "rb") as input_file:
+            for chunk in iter(lambda: input_file.read(self.chunk_size), b""):
+                if self.progress:
+                    self.progress.add_bytes(len(chunk))
+                yield chunk
+
+    def generate(self):
+        """Body of the request by chunks
+        """
+        for name, value in self.fields:
+            yield self.field_header(name) + value.encode() + b"\r\n"
+        for name, path in self.files:
+            yield self.file_header(name, path)
+            for chunk in self.file_chunks(path):
+                yield chunk
+            yield b"\r\n"
+        yield self.closing()
+
+    def __iter__(self):
+        return self.chunks
+
+    def read(self, size=-1):
+        """Read like a file, at most one chunk at a time
+        """
+        if size < 0:
+            data = self.buffer[self.offset:] + b"".join(self.chunks)
+            self.buffer = b""
+            self.offset = 0
+            return data
+        if self.offset >= len(self.buffer):
+            self.buffer = next(self.chunks, b"")
+            self.offset = 0
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+class block_compressor(object):
+    """Parallel gzip of raw fastq in independent blocks, readable by gzip
+    and by the bgzf tools
+    """
+    # Input of a block, its deflate always fits in 64 Kb
+    block_size = 65280
+    # Empty block closing a bgzf file
+    eof_block = bytes.fromhex("1f8b08040000000000ff0600424302001b00"
+                              "03000000000000000000")
+
+    def __init__(self, threads, level=6):
+        self.threads = threads
+        self.level = level
+        # Shared by the uploads of all the jobs
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def compress_block(self, data):
+        """Gzip member with the bgzf extra field giving its size
+        """
+        deflate = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = deflate.compress(data) + deflate.flush()
+        return (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" +
+                struct.pack("<H", len(cdata) + 25) + cdata +
+                struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                            len(data)))
+
+    def stream(self, path, progress=None):
+        """Compressed blocks of a file in order, a few compressed ahead
+        """
+        pending = collections.deque()
+        with open(path, "rb") as input_file:
+            for data in iter(lambda: input_file.read(self.block_size), b""):
+                pending.append((len(data), self.executor.submit(
+                    self.compress_block, data)))
+                if len(pending) > 2 * self.threads:
+                    nbytes, block = pending.popleft()
+                    if progress:
+                        progress.add_bytes(nbytes)
+                    yield block.result()
+        while pending:
+            nbytes, block = pending.popleft()
+            if progress:
+                progress.add_bytes(nbytes)
+            yield block.result()
+        yield self.eof_block
+
+
+class progress_model(object):
+    """Monotonic progression of a job over its upload, data and workflow phases
+    """
+    weights = {"upload": 0.2, "data": 0.1, "workflow": 0.7}
+
+    def __init__(self, progress_file, name, board=None):
+        self.progress_file = progress_file
+        self.name = name
+        self.board = board
+        self.fractions = dict.fromkeys(self.weights, 0.0)
+        self.value = 0.0
+        self.written = None
+        self.status = "running"
+        self.start_time = time.time()
+        self.total_bytes = 0
+        self.sent_bytes = 0
+        self.closed = False
+        self.lock = Lock()
+
+    def add_bytes(self, nbytes):
+        """Account bytes sent to galaxy
+        """
+        self.sent_bytes += nbytes
+        self.update("upload",
+                    float(self.sent_bytes) / max(self.total_bytes, 1))
+
+    def eta(self):
+        """Remaining time in seconds from the mean speed so far
+        """
+        if self.value <= 0.0 or self.value >= 100.0:
+            return None
+        elapsed = time.time() - self.start_time
+        return round(elapsed * (100.0 - self.value) / self.value)
+
+    def state(self):
+        """Current state of the job
+        """
+        return {"progress": round(self.value, 1), "eta": self.eta(),
+                "status": self.status, "phases": dict(self.fractions),
+                "time": time.time()}
+
+    def update(self, phase, fraction):
+        """Record the fraction done for a phase, never going backwards
+        """
+        with self.lock:
+            fraction = min(max(fraction, 0.0), 1.0)
+            self.fractions[phase] = max(self.fractions[phase], fraction)
+            self.value = max(self.value, 100.0 * sum(
+                self.weights[key] * self.fractions[key]
+                for key in self.weights))
+            self.publish()
+
+    def finish(self, status):
+        """Close the progression, its file is deleted when the job failed or
+        was cancelled
+        """
+        with self.lock:
+            self.status = status
+            if status == "done":
+                self.fractions = dict.fromkeys(self.weights, 1.0)
+                self.value = 100.0
+            self.publish()
+            if status in ["error", "cancelled"]:
+                # Not written again by the stage still running
+                self.closed = True
+                remove_progress(self.progress_file)
+
+    def publish(self):
+        """Write the progression only when it changed
+        """
+        value = round(self.value, 1)
+        if not self.closed and value != self.written and os.path.isdir(
+                os.path.dirname(self.progress_file)):
+            write_atomic(self.progress_file, "{0}".format(value))
+            self.written = value
+        if self.board:
+            self.board.update(self.name, self.state())
+
+
+class progress_board(object):
+    """Progression of all the jobs of the daemon
+    """
+
+    def __init__(self, keep_time=3600, host=None):
+        self.keep_time = keep_time
+        self.host = host
+        self.jobs = {}
+        self.dirty = False
+        self.written = None
+        self.lock = Lock()
+
+    def update(self, name, state):
+        """Store the state of a job
+        """
+        with self.lock:
+            self.jobs[name] = dict(state, host=self.host)
+            self.dirty = True
+
+    def snapshot(self):
+        """Copy of the states
+        """
+        with self.lock:
+            return dict(self.jobs)
+
+    def dump(self, board_file):
+        """Write all the states in one file when something changed
+        """
+        with self.lock:
+            # Forget finished jobs after a while
+            for name in list(self.jobs):
+                if (self.jobs[name]["status"] != "running" and
+                    time.time() - self.jobs[name]["time"] > self.keep_time):
+                    del self.jobs[name]
+                    self.dirty = True
+            try:
+                board_date = os.path.getmtime(board_file)
+            except OSError:
+                board_date = None
+            # Written again when another daemon replaced it
+            if not self.dirty and board_date == self.written:
+                return
+            jobs = {}
+            try:
+                with open(board_file, "rt") as board:
+                    jobs = json.load(board)
+            except (IOError, ValueError):
+                pass
+            # Jobs of the other daemons sharing the work directory
+            jobs = {name: state for name, state in jobs.items()
+                    if state.get("host") != self.host and
+                    time.time() - state.get("time", 0) < self.keep_time}
+            jobs.update(self.jobs)
+            write_atomic(board_file, json.dumps(jobs))
+            self.written = os.path.getmtime(board_file)
+            self.dirty = False
+
+
+class result_cache(object):
+    """Archives of the previous jobs, evicted from the least recently used
+    """
+
+    def __init__(self, cache_dir, cache_size):
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.lock = Lock()
+
+    def get(self, key, zip_file):
+        """Link or copy the archive of a key, before it can be evicted
+          Returns: True when the key is in the cache
+        """
+        cache_file = self.cache_dir + key + ".zip"
+        tmp_path = "{0}.{1}".format(zip_file, uuid.uuid4().hex[:8])
+        with self.lock:
+            try:
+                # Mark as recently used
+                os.utime(cache_file, None)
+                os.link(cache_file, tmp_path)
+            except FileNotFoundError:
+                # Evicted by another daemon
+                return False
+            except OSError:
+                # No hard link, the cache is on another file system
+                try:
+                    shutil.copyfile(cache_file, tmp_path)
+                except FileNotFoundError:
+                    return False
+        os.replace(tmp_path, zip_file)
+        return True
+
+    def put(self, key, zip_file):
+        """Store an archive and evict the oldest ones above the size
+        """
+        cache_file = self.cache_dir + key + ".zip"
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".")
+        os.close(handle)
+        shutil.copyfile(zip_file, tmp_path)
+        with self.lock:
+            os.replace(tmp_path, cache_file)
+            list_cache = sorted(glob.glob(self.cache_dir + "*.zip"),
+                                key=os.path.getmtime)
+            total_size = sum(os.path.getsize(path) for path in list_cache)
+            while total_size > self.cache_size and list_cache:
+                oldest = list_cache.pop(0)
+                total_size -= os.path.getsize(oldest)
+                os.remove(oldest)
+
+
+class task_batches(object):
+    """Galaxy setup shared by the jobs of a batch file and its report
+    """
+
+    def __init__(self, logger, done_dir, janitor=None):
+        self.logger = logger
+        self.done_dir = done_dir
+        self.janitor = janitor
+        # Batches with jobs in the pipeline by name
+        self.batches = {}
+        self.lock = Lock()
+
+    def join(self, djinn):
+        """Add a job to its batch, the first one gives the galaxy client
+        """
+        name = djinn.data_task["batch"]
+        with self.lock:
+            if name not in self.batches:
+                self.batches[name] = {
+                    'gi': djinn.gi, 'members': set(), 'history': None,
+                    'history_name': "batch_" + djinn.result_history_name,
+                    'contaminants': {}, 'workflows': {}, 'inputs': {},
+                    'keep': False, 'lock': Lock()}
+            batch = self.batches[name]
+            batch['members'].add(djinn.data_task["name"])
+        djinn.batch = name
+        djinn.gi = batch['gi']
+        # Kept by the janitor while a job of the batch runs
+        djinn.data_task['batch_history_name'] = batch['history_name']
+        djinn.save_task()
+
+    def contaminant(self, djinn):
+        """Dataset of the contaminant, sent in the batch history once
+        """
+        batch = self.batches[djinn.batch]
+        path = djinn.data_task["contaminant"]
+        with batch['lock']:
+            if path not in batch['contaminants']:
+                if not batch['history']:
+                    batch['history'] = batch['gi'].histories.create_history(
+                        name=batch['history_name'])
+                    if self.janitor:
+                        self.janitor.track("history", batch['history'],
+                                           batch['history_name'])
+                self.logger.info("Load contaminant of the batch {0} : {1}"
+                                 .format(djinn.batch, batch['history']['id']))
+                batch['contaminants'][path] = batch['gi'].tools.upload_file(
+                    path, batch['history']['id'])
+            return batch['contaminants'][path]
+
+    def workflow(self, djinn, workflow_name):
+        """Workflow found by name once for the batch
+        """
+        batch = self.batches[djinn.batch]
+        with batch['lock']:
+            if workflow_name not in batch['workflows']:
+                batch['workflows'][workflow_name] = (
+                    batch['gi'].workflows.get_workflows(name=workflow_name))
+            return batch['workflows'][workflow_name]
+
+    def workflow_input(self, djinn, workflow_id, label):
+        """Workflow input found by label once for the batch
+        """
+        batch = self.batches[djinn.batch]
+        with batch['lock']:
+            if (workflow_id, label) not in batch['inputs']:
+                batch['inputs'][(workflow_id, label)] = (
+                    batch['gi'].workflows.get_workflow_inputs(
+                        workflow_id, label=label)[0])
+            return batch['inputs'][(workflow_id, label)]
+
+    def leave(self, djinn, status):
+        """Report the end of a job, the last one purges the batch history
+        unless a job goes on with another daemon
+        """
+        if status != "moved":
+            self.report(djinn, status)
+        if not djinn.batch:
+            return
+        name = djinn.batch
+        djinn.batch = None
+        with self.lock:
+            batch = self.batches[name]
+            batch['members'].discard(djinn.data_task["name"])
+            if status == "moved":
+                batch['keep'] = True
+            if batch['members']:
+                return
+            del self.batches[name]
+        if not batch['history']:
+            return
+        if batch['keep']:
+            # Still read by the invocations resumed elsewhere
+            if self.janitor:
+                self.janitor.release(batch['history_name'])
+            return
+        if self.janitor:
+            self.janitor.release(batch['history_name'], 0)
+        batch['gi'].histories.delete_history(batch['history']['id'],
+                                             purge=True)
+        if self.janitor:
+            self.janitor.forget(batch['history_name'])
+
+    def report(self, djinn, status):
+        """Write the status of a job in the report of its batch
+        """
+        job = {"status": status}
+        if status == "done":
+            job["result"] = os.path.basename(djinn.zip_file)
+        else:
+            job["error"] = djinn.data_task["name"] + "_error.txt"
+        self.write_report(djinn.data_task["batch"],
+                          djinn.data_task.get("batch_size", 1),
+                          djinn.data_task["name"], job)
+
+    def write_report(self, name, size, member, job):
+        """Write the status of a job in its own file, then the report of
+        the batch from the files of all its jobs
+        """
+        report_dir = self.done_dir + name + "_report" + os.sep
+        report_file = self.done_dir + name + "_report.json"
+        job["date"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            create_dir([report_dir])
+            write_atomic(report_dir + member + ".json", json.dumps(job))
+            # Daemons sharing done write the report in turn, until the
+            # last writer sees no new job after its write
+            jobs = None
+            while True:
+                found = {}
+                for job_file in glob.glob(report_dir + "*.json"):
+                    try:
+                        with open(job_file, "rt") as job_data:
+                            found[os.path.basename(job_file)[:-5]] = (
+                                json.load(job_data))
+                    except (IOError, ValueError):
+                        pass
+                if found == jobs:
+                    break
+                jobs = found
+                report = {"batch": name, "size": size, "jobs": jobs,
+                          "complete": len(jobs) >= size}
+                write_atomic(report_file, json.dumps(report, indent=1))
+        if report["complete"]:
+            self.logger.info("Batch {0} is complete: {1} of {2} jobs "
+                             "done".format(
+                                 name, len([job for job in
+                                            report["jobs"].values()
+                                            if job["status"] == "done"]),
+                                 report["size"]))
+
+
+class api_server(socketserver.ThreadingMixIn, HTTPServer):
+    """Http server of the submission api on a local port
+    """
+    daemon_threads = True
+
+
+class unix_api_server(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """Http server of the submission api on a unix socket
+    """
+    daemon_threads = True
+
+
+class api_handler(BaseHTTPRequestHandler):
+    """Requests of the submission api:
+      POST /jobs, GET /jobs, GET /jobs/<id>, DELETE /jobs/<id>, and
+      GET /debug for the threads and the jobs of the daemon
+    """
+
+    def reply(self, code, payload):
+        """Send a json answer
+        """
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job_name(self):
+        """Job id of a /jobs/<id> path, None for /jobs
+        """
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if not parts or parts[0] != "jobs" or len(parts) > 2:
+            return False
+        return parts[1] if len(parts) == 2 else None
+
+    def do_GET(self):
+        if self.path.split("?")[0].rstrip("/") == "/debug":
+            self.reply(200, introspect(self.server.api.workers,
+                                       self.server.api.limiter))
+            return
+        name = self.job_name()
+        if name is False:
+            self.reply(404, {"error": "unknown path {0}".format(self.path)})
+        elif name is None:
+            self.reply(200, self.server.api.board.snapshot())
+        else:
+            self.reply(*self.server.api.status(name))
+
+    def do_POST(self):
+        if self.job_name() is not None:
+            self.reply(404, {"error": "unknown path {0}".format(self.path)})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data_task = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            self.reply(400, {"error": "the task is not json"})
+            return
+        self.reply(*self.server.api.submit(data_task))
+
+    def do_DELETE(self):
+        name = self.job_name()
+        if not name:
+            self.reply(404, {"error": "unknown path {0}".format(self.path)})
+        else:
+            self.reply(*self.server.api.cancel(name))
+
+    def log_message(self, format, *args):
+        self.server.api.logger.debug("Api: " + format % args)
+
+
+class submission_api(object):
+    """Submit the tasks and follow the jobs without the shared directories
+    """
+    name_pattern = re.compile(r"^[A-Za-z0-9_-]+$")
+
+    def __init__(self, logger, work_dirs, board, workers, wake, port=0,
+                 socket_path=None, limiter=None, input_root=None):
+        self.logger = logger
+        self.limiter = limiter
+        self.input_root = input_root
+        self.todo_dir, self.doing_dir, self.done_dir, self.error_dir = work_dirs
+        self.board = board
+        self.workers = workers
+        self.wake = wake
+        self.port = port
+        self.socket_path = socket_path
+        self.lock = Lock()
+        self.server = None
+
+    def start(self):
+        """Serve the requests in the background
+          Returns: False when the api cannot listen
+        """
+        try:
+            if self.socket_path:
+                if os.path.exists(self.socket_path):
+                    os.remove(self.socket_path)
+                self.server = unix_api_server(self.socket_path, api_handler,
+                                              bind_and_activate=False)
+                self.server.server_bind()
+                # Tasks are run with the rights of the daemon
+                os.chmod(self.socket_path, 0o600)
+                self.server.server_activate()
+            else:
+                self.server = api_server(("127.0.0.1", self.port),
+                                         api_handler)
+        except OSError:
+            self.logger.warning("Submission api disabled, cannot listen on "
+                                "{0}: {1}".format(
+                                    self.socket_path or
+                                    "127.0.0.1:{0}".format(self.port),
+                                    sys.exc_info()[1]))
+            if self.server:
+                self.server.server_close()
+                self.server = None
+            return False
+        self.server.api = self
+        server_thread = Thread(target=self.server.serve_forever,
+                               name="api")
+        server_thread.daemon = True
+        server_thread.start()
+        self.logger.info("Submission api listening on {0}".format(
+            self.socket_path or "127.0.0.1:{0}".format(self.port)))
+        return True
+
+    def known(self, name):
+        """Check if a job name is already used
+        """
+        return (name in self.board.snapshot() or
+                [work_dir for work_dir in [self.todo_dir, self.doing_dir,
+                                           self.done_dir, self.error_dir]
+                 if os.path.isfile(work_dir + name + ".json")])
+
+    def outside(self, data_task):
+        """Paths of a task out of the input root, read with the rights of
+        the daemon
+          Returns: The first path outside, None when all are inside
+        """
+        if not self.input_root:
+            return None
+        root = os.path.realpath(self.input_root)
+        for path in task_paths(data_task) + [data_task["contaminant"]]:
+            if os.path.commonpath([root, os.path.realpath(path)]) != root:
+                return path
+        return None
+
+    def submit(self, data_task):
+        """Validate a task and queue it in todo
+          Returns: http code, answer
+        """
+        name = None
+        if isinstance(data_task, dict) and "name" in data_task:
+            name = str(data_task["name"])
+            if not self.name_pattern.match(name):
+                return 400, {"error": "name {0} is incorrect".format(name)}
+        if not name:
+            name = "file" + uuid.uuid4().hex
+        todo_file = self.todo_dir + name + ".json"
+        members = batch_members(data_task)
+        try:
+            if members:
+                # Split by the daemon, each task is checked now
+                tasks = [validate_task(
+                    dict(member) if isinstance(member, dict) else member,
+                    "{0}{1}_{2}.json".format(self.todo_dir, name, num_member))
+                         for num_member, member in enumerate(members)]
+            else:
+                data_task = validate_task(data_task, todo_file)
+                tasks = [data_task]
+        except ValueError as err:
+            return 400, {"error": str(err)}
+        for task in tasks:
+            path = self.outside(task)
+            if path:
+                return 403, {"error": "{0} is outside of {1}".format(
+                    path, self.input_root)}
+        with self.lock:
+            if self.known(name):
+                return 409, {"error": "job {0} already exists".format(name)}
+            write_atomic(todo_file, json.dumps(data_task))
+        self.logger.info("Api queued {0}".format(todo_file))
+        self.wake.set()
+        if members:
+            return 201, {"id": name, "status": "queued",
+                         "tasks": ["{0}_{1}".format(name, num_member)
+                                   for num_member in range(len(members))]}
+        return 201, {"id": name, "status": "queued"}
+
+    def status(self, name):
+        """State of a job from memory, or from its directory
+          Returns: http code, answer
+        """
+        state = self.board.snapshot().get(name)
+        if state:
+            return 200, dict(state, id=name)
+        if os.path.isfile(self.todo_dir + name + ".json"):
+            wait_file = self.todo_dir + name + ".wait"
+            if os.path.isfile(wait_file):
+                with open(wait_file, "rt") as wait:
+                    return 200, {"id": name, "status": "waiting",
+                                 "reason": wait.readline().rstrip("\n")}
+            return 200, {"id": name, "status": "queued"}
+        if os.path.isfile(self.doing_dir + name + ".json"):
+            # Job of another daemon
+            progress = 0.0
+            try:
+                with open(self.doing_dir + name + "_progress.txt",
+                          "rt") as progress_file:
+                    progress = float(progress_file.read())
+            except (IOError, ValueError):
+                pass
+            return 200, {"id": name, "status": "running",
+                         "progress": progress}
+        if os.path.isfile(self.done_dir + name + ".json"):
+            return 200, {"id": name, "status": "done", "progress": 100.0}
+        if os.path.isfile(self.error_dir + name + ".json"):
+            answer = {"id": name, "status": "error"}
+            error_file = self.error_dir + name + "_error.txt"
+            if os.path.isfile(error_file):
+                with open(error_file, "rt") as error:
+                    answer["reason"] = error.read().strip()
+            return 200, answer
+        report_file = self.done_dir + name + "_report.json"
+        if os.path.isfile(report_file):
+            # Batch with some tasks finished
+            with open(report_file, "rt") as report_data:
+                report = json.load(report_data)
+            return 200, {"id": name, "jobs": report["jobs"],
+                         "status": ("done" if report["complete"]
+                                    else "running")}
+        return 404, {"error": "unknown job {0}".format(name)}
+
+    def cancel(self, name):
+        """Cancel a running job or withdraw a waiting one
+          Returns: http code, answer
+        """
+        with self.workers.lock:
+            djinn = self.workers.jobs.get(name)
+        if djinn:
+            djinn.cancel("cancelled on request")
+            return 202, {"id": name, "status": "cancelled"}
+        if os.path.isfile(self.doing_dir + name + ".json"):
+            # Cancelled by the daemon which runs it
+            open(self.doing_dir + name + ".cancel", "wt").close()
+            return 202, {"id": name, "status": "cancelled"}
+        todo_file = self.todo_dir + name + ".json"
+        with self.lock:
+            if not os.path.isfile(todo_file):
+                return 404, {"error": "unknown job {0}".format(name)}
+            try:
+                shutil.move(todo_file, self.error_dir + name + ".json")
+            except FileNotFoundError:
+                # Claimed meanwhile
+                open(self.doing_dir + name + ".cancel", "wt").close()
+                return 202, {"id": name, "status": "cancelled"}
+            with open(self.error_dir + name + "_error.txt", "wt") as error:
+                error.write("cancelled on request\n")
+            if os.path.isfile(self.todo_dir + name + ".wait"):
+                os.remove(self.todo_dir + name + ".wait")
+        return 200, {"id": name, "status": "cancelled"}
+
+
+class runtime_model(object):
+    """Duration of a job fitted on the timings of the previous jobs
+    """
+    types = ["16S", "18S", "23S_28S", "ITS", "WGS"]
+
+    def __init__(self, logger, timing_file, max_timings=1000, min_timings=10,
+                 ridge=1.0):
+        self.logger = logger
+        self.timing_file = timing_file
+        self.max_timings = max_timings
+        self.min_timings = min_timings
+        self.ridge = ridge
+        self.lock = Lock()
+        self.timings = []
+        self.coefficients = None
+        if os.path.isfile(timing_file):
+            try:
+                with open(timing_file, "rt") as timing:
+                    self.timings = json.load(timing)
+            except ValueError:
+                self.logger.error("Cannot read the job timings {0}".format(
+                    timing_file))
+        self.fit()
+
+    def vector(self, features):
+        """Numeric description of a job
+        """
+        return ([1.0, features["input_size"] / 1e9,
+                 features["num_files"] / 100.0, float(features["databases"]),
+                 float(features["paired"]), float(features["host"]),
+                 float(features["runs"])] +
+                [float(features["type"] == seq_type)
+                 for seq_type in self.types])
+
+    def fit(self):
+        """Ridge regression of the durations, called with the lock or
+        before the threads start
+        """
+        if len(self.timings) < self.min_timings:
+            self.coefficients = None
+            return
+        rows = [self.vector(timing["features"]) for timing in self.timings]
+        targets = [timing["duration"] for timing in self.timings]
+        size = len(rows[0])
+        # Normal equations (X'X + ridge I) b = X'y
+        matrix = [[sum(row[i] * row[j] for row in rows) +
+                   (self.ridge if i == j and i > 0 else 0.0)
+                   for j in range(size)] +
+                  [sum(row[i] * target for row, target in zip(rows, targets))]
+                  for i in range(size)]
+        self.coefficients = solve_linear(matrix)
+
+    def estimate(self, features):
+        """Expected duration in seconds
+        """
+        with self.lock:
+            coefficients = self.coefficients
+        if coefficients is None:
+            # Until enough jobs are known: ten minutes and one hour per Gb
+            return (600.0 + 3600.0 * features["input_size"] / 1e9 *
+                    max(1, features["runs"]))
+        return max(60.0, sum(coefficient * value for coefficient, value in
+                             zip(coefficients, self.vector(features))))
+
+    def record(self, features, duration):
+        """Add the timing of a job and fit again
+        """
+        with self.lock:
+            self.timings.append({"features": features, "duration": duration,
+                                 "time": time.time()})
+            self.timings = self.timings[-self.max_timings:]
+            try:
+                write_atomic(self.timing_file, json.dumps(self.timings))
+            except IOError:
+                self.logger.error("Failed to write {0}".format(
+                    self.timing_file))
+            self.fit()
+
+
+class admission_control(object):
+    """Start a job only when the disk, the galaxy quota and the galaxy
+    queue can take it
+    """
+
+    def __init__(self, logger, galaxy_url, galaxy_key, https_mode, done_dir,
+                 result_size, max_quota, max_galaxy_jobs, poll_time=60,
+                 limiter=None):
+        self.logger = logger
+        self.gi = GalaxyInstance(url=galaxy_url, key=galaxy_key)
+        self.gi.verify = https_mode
+        if limiter:
+            self.gi = limited_galaxy(self.gi, limiter)
+        self.done_dir = done_dir
+        self.result_size = result_size
+        self.max_quota = max_quota
+        self.max_galaxy_jobs = max_galaxy_jobs
+        self.poll_time = poll_time
+        self.limiter = limiter
+        self.lock = Lock()
+        # Disk and quota taken by the admitted jobs until they end
+        self.reserved = {}
+        self.user = None
+        self.galaxy_jobs = 0
+        self.poll_date = 0
+
+    def configure(self, galaxy_url, galaxy_key, https_mode, result_size,
+                  max_quota, max_galaxy_jobs):
+        """Change the galaxy and the thresholds, the reservations are kept
+        """
+        with self.lock:
+            gi = GalaxyInstance(url=galaxy_url, key=galaxy_key)
+            gi.verify = https_mode
+            if self.limiter:
+                gi = limited_galaxy(gi, self.limiter)
+            self.gi = gi
+            self.result_size = result_size
+            self.max_quota = max_quota
+            self.max_galaxy_jobs = max_galaxy_jobs
+            # Ask the new galaxy on the next admission
+            self.poll_date = 0
+
+    def refresh(self):
+        """Ask galaxy for the quota and the number of jobs, not too often
+        """
+        if time.time() - self.poll_date < self.poll_time:
+            return
+        if self.max_quota > 0:
+            self.user = self.gi.users.get_current_user()
+        if self.max_galaxy_jobs > 0:
+            self.galaxy_jobs = (len(self.gi.jobs.get_jobs(state="queued")) +
+                                len(self.gi.jobs.get_jobs(state="running")))
+        self.poll_date = time.time()
+
+    def check(self, input_size, num_runs):
+        """Reason why a job cannot start, None when it can
+        """
+        result_size = num_runs * self.result_size
+        reserved_disk = sum(disk for disk, _ in self.reserved.values())
+        reserved_upload = sum(upload for _, upload in self.reserved.values())
+        free_disk = shutil.disk_usage(self.done_dir).free - reserved_disk
+        if free_disk < result_size:
+            return ("not enough disk space for the results: {0} Mb free "
+                    "for {1} Mb".format(free_disk // 1000000,
+                                        result_size // 1000000))
+        try:
+            self.refresh()
+        except:
+            self.logger.error("Admission cannot reach galaxy")
+            self.logger.error(sys.exc_info()[1])
+            return "galaxy is unreachable"
+        if self.max_quota > 0 and self.user:
+            quota_bytes = self.user.get('quota_bytes')
+            usage = self.user.get('total_disk_usage') or 0
+            if quota_bytes:
+                if (usage + reserved_upload + input_size >
+                    quota_bytes * self.max_quota / 100.0):
+                    return ("galaxy quota would exceed {0}%: {1} Mb used "
+                            "of {2} Mb".format(self.max_quota,
+                                               int(usage) // 1000000,
+                                               int(quota_bytes) // 1000000))
+            elif (self.user.get('quota_percent') is not None and
+                  self.user['quota_percent'] >= self.max_quota):
+                return "galaxy quota is {0}% used".format(
+                    self.user['quota_percent'])
+        if (self.max_galaxy_jobs > 0 and
+            self.galaxy_jobs >= self.max_galaxy_jobs):
+            return "galaxy has {0} queued or running jobs".format(
+                self.galaxy_jobs)
+        return None
+
+    def hold(self, input_size, num_runs):
+        """Reason why a job would wait, nothing is reserved
+        """
+        with self.lock:
+            return self.check(input_size, num_runs)
+
+    def admit(self, name, input_size, num_runs):
+        """Reserve the resources of a job
+          Returns: None when admitted, or the reason to wait
+        """
+        with self.lock:
+            reason = self.check(input_size, num_runs)
+            if reason is None:
+                self.reserved[name] = (num_runs * self.result_size,
+                                       input_size)
+                # Until the next poll
+                self.galaxy_jobs += num_runs
+            return reason
+
+    def reserve(self, name, input_size, num_runs):
+        """Reserve the resources of a job already started in galaxy
+        """
+        with self.lock:
+            self.reserved[name] = (num_runs * self.result_size, input_size)
+
+    def release(self, name):
+        """Free the resources of a finished job
+        """
+        with self.lock:
+            self.reserved.pop(name, None)
+
+
+class token_bucket(object):
+    """Calls allowed at a mean rate with some burst
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = Lock()
+
+    def acquire(self, tokens=1.0):
+        """Wait for the tokens and take them
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def configure(self, rate, burst):
+        """Change the rate, the tokens already earned are kept
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.rate = rate
+            self.burst = burst
+
+
+class rate_limiter(object):
+    """Budgets of galaxy calls shared by all the jobs of the daemon
+    """
+    budgets = {"upload_file": "upload", "upload_file_from_local_path": "upload",
+               "upload_dataset_from_library": "upload",
+               "invoke_workflow": "invoke"}
+
+    def __init__(self, read_rate, upload_rate, invoke_rate):
+        self.buckets = {}
+        # Last galaxy call of each thread
+        self.calls = {}
+        self.configure(read_rate, upload_rate, invoke_rate)
+
+    def configure(self, read_rate, upload_rate, invoke_rate):
+        """Set the rate of each budget, the waiting calls keep their place
+        """
+        for budget, rate in [("read", read_rate), ("upload", upload_rate),
+                             ("invoke", invoke_rate)]:
+            # No limit for a null rate
+            if rate <= 0:
+                self.buckets.pop(budget, None)
+            elif budget in self.buckets:
+                self.buckets[budget].configure(rate, max(1.0, rate))
+            else:
+                self.buckets[budget] = token_bucket(rate, max(1.0, rate))
+
+    def acquire(self, budget):
+        """Wait for the budget of one call
+        """
+        if budget in self.buckets:
+            self.buckets[budget].acquire()
+
+    def call(self, method):
+        """Wait for the budget of a client method
+        """
+        self.acquire(self.budgets.get(method, "read"))
+
+    def timed(self, method, function, *args, **kwargs):
+        """Run a galaxy call, kept with its latency for the introspection
+        """
+        call = {"method": method, "start": time.time(), "latency": None}
+        self.calls[current_thread().ident] = call
+        try:
+            return function(*args, **kwargs)
+        finally:
+            call["latency"] = time.time() - call["start"]
+
+    def snapshot(self):
+        """Last galaxy call of the living threads, or the one in progress
+        """
+        now = time.time()
+        alive = set(thread.ident for thread in list_threads())
+        calls = {}
+        for ident, call in list(self.calls.items()):
+            if ident not in alive:
+                self.calls.pop(ident, None)
+            elif call["latency"] is None:
+                calls[ident] = {"method": call["method"], "running": True,
+                                "seconds": round(now - call["start"], 3)}
+            else:
+                calls[ident] = {"method": call["method"], "running": False,
+                                "seconds": round(call["latency"], 3),
+                                "ago": round(now - call["start"], 1)}
+        return calls
+
+
+class limited_client(object):
+    """Bioblend client whose methods wait for the rate limiter
+    """
+
+    def __init__(self, client, limiter, client_name=None):
+        self.client = client
+        self.limiter = limiter
+        self.client_name = client_name
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+        def limited_call(*args, **kwargs):
+            self.limiter.call(name)
+            return self.limiter.timed(
+                "{0}.{1}".format(self.client_name, name), attribute, *args,
+                **kwargs)
+        return limited_call
+
+
+class limited_galaxy(object):
+    """Galaxy instance whose clients go through the rate limiter
+    """
+    clients = ["histories", "tools", "workflows", "invocations", "jobs",
+               "datasets", "libraries", "users"]
+
+    def __init__(self, gi, limiter):
+        object.__setattr__(self, "gi", gi)
+        object.__setattr__(self, "limiter", limiter)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.gi, name)
+        if name in self.clients:
+            return limited_client(attribute, self.limiter, name)
+        return attribute
+
+    def __setattr__(self, name, value):
+        setattr(self.gi, name, value)
+
+
+class bandwidth_share(object):
+    """Upload bandwidth shared between the submitters in proportion to
+    their weight, each one uses what the idle ones leave
+    """
+
+    def __init__(self, bandwidth, weights=None):
+        self.bandwidth = bandwidth
+        self.weights = weights or {}
+        # Open upload streams and byte credit of each submitter
+        self.streams = {}
+        self.credits = {}
+        self.last = time.time()
+        self.lock = Lock()
+
+    def configure(self, bandwidth, weights=None):
+        """Change the bandwidth and the weights of the submitters
+        """
+        with self.lock:
+            self.refill()
+            self.bandwidth = bandwidth
+            self.weights = weights or {}
+
+    def open(self, mail):
+        with self.lock:
+            self.refill()
+            self.streams[mail] = self.streams.get(mail, 0) + 1
+            self.credits.setdefault(mail, 0.0)
+
+    def close(self, mail):
+        with self.lock:
+            self.refill()
+            self.streams[mail] -= 1
+            if self.streams[mail] == 0:
+                del self.streams[mail]
+                del self.credits[mail]
+
+    def rate(self, mail):
+        """Bytes per second of a submitter, called with the lock
+        """
+        total_weight = sum(self.weights.get(active, 1.0)
+                           for active in self.streams)
+        return self.bandwidth * self.weights.get(mail, 1.0) / total_weight
+
+    def refill(self):
+        """Credit the active submitters, called with the lock
+        """
+        now = time.time()
+        for mail in self.streams:
+            rate = self.rate(mail)
+            # At most one second of burst
+            self.credits[mail] = min(rate, self.credits[mail] +
+                                     (now - self.last) * rate)
+        self.last = now
+
+    def consume(self, mail, nbytes):
+        """Wait until a submitter may send bytes, the credit may go
+        negative for a large block which delays the next one
+        """
+        if self.bandwidth <= 0:
+            return
+        while True:
+            with self.lock:
+                self.refill()
+                # The bandwidth may be released by a reload
+                if self.bandwidth <= 0 or mail not in self.streams:
+                    return
+                if self.credits[mail] >= 0:
+                    self.credits[mail] -= nbytes
+                    return
+                wait = -self.credits[mail] / self.rate(mail)
+            time.sleep(min(wait, 1.0))
+
+
+class lease_manager(Thread):
+    """Heartbeat leases of the jobs claimed by this daemon, so that several
+    daemons share the work directory and take over the jobs of a dead one
+    """
+
+    def __init__(self, logger, doing_dir, node, lease_time=60):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = "leases"
+        self.logger = logger
+        self.doing_dir = doing_dir
+        self.lease_time = lease_time
+        self.owner = "{0}:{1}:{2}".format(node, os.getpid(),
+                                          uuid.uuid4().hex[:8])
+        self.jobs = {}
+        self.lock = Lock()
+        # Offset of the clock of the file server of doing
+        self.skew = 0.0
+        self.skew_date = None
+
+    def lease_file(self, name):
+        return self.doing_dir + name + ".lease"
+
+    def content(self):
+        return json.dumps({"owner": self.owner, "time": time.time()})
+
+    def read_owner(self, lease_file):
+        """Owner of a lease, None when it is missing
+        """
+        try:
+            with open(lease_file, "rt") as lease:
+                return json.load(lease).get("owner")
+        except (IOError, ValueError):
+            return None
+
+    def clock(self):
+        """Time of the file server of doing, which dates the leases of
+        all the hosts
+        """
+        if (self.skew_date is None or
+                abs(time.time() - self.skew_date) > self.lease_time / 4.0):
+            probe_file = self.doing_dir + ".clock_" + self.owner.replace(
+                ":", "_")
+            try:
+                with open(probe_file, "wt") as probe:
+                    probe.write(self.owner)
+                self.skew = os.path.getmtime(probe_file) - time.time()
+                os.remove(probe_file)
+                self.skew_date = time.time()
+            except OSError:
+                self.logger.error("Cannot read the clock of {0}".format(
+                    self.doing_dir))
+        return time.time() + self.skew
+
+    def expired(self, lease_file):
+        """Check if the owner of a lease stopped renewing it
+        """
+        try:
+            return (self.clock() - os.path.getmtime(lease_file) >
+                    self.lease_time)
+        except OSError:
+            return True
+
+    def acquire(self, name, djinn=None):
+        """Take the lease of a job, free or expired
+          Returns: True when this daemon owns the job
+        """
+        lease_file = self.lease_file(name)
+        handle, tmp_path = tempfile.mkstemp(dir=self.doing_dir,
+                                            prefix="." + name + ".lease")
+        with os.fdopen(handle, "wt") as tmp_file:
+            tmp_file.write(self.content())
+        os.chmod(tmp_path, 0o644)
+        try:
+            for attempt in range(2):
+                try:
+                    # Hard links are exclusive, even on nfs
+                    os.link(tmp_path, lease_file)
+                    with self.lock:
+                        self.jobs[name] = djinn
+                    return True
+                except FileExistsError:
+                    if attempt > 0 or not self.expired(lease_file):
+                        return False
+                # Only one daemon moves the expired lease away
+                stale_file = "{0}.{1}".format(lease_file,
+                                              uuid.uuid4().hex[:8])
+                try:
+                    os.rename(lease_file, stale_file)
+                except FileNotFoundError:
+                    return False
+                if not self.expired(stale_file):
+                    # Renewed meanwhile, given back to its owner
+                    try:
+                        os.link(stale_file, lease_file)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale_file)
+                    return False
+                os.remove(stale_file)
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def release(self, name):
+        """Remove the lease of a job this daemon still owns
+        """
+        with self.lock:
+            self.jobs.pop(name, None)
+        lease_file = self.lease_file(name)
+        if self.read_owner(lease_file) == self.owner:
+            os.remove(lease_file)
+
+    def renew(self):
+        """Renew the leases, drop the jobs taken by another daemon
+        """
+        with self.lock:
+            jobs = dict(self.jobs)
+        for name, djinn in jobs.items():
+            if not self.touch(self.lease_file(name)):
+                self.logger.error("Lease of {0} taken by another "
+                                  "daemon".format(name))
+                with self.lock:
+                    self.jobs.pop(name, None)
+                if djinn:
+                    djinn.cancel("lease lost", cleanup=False)
+
+    def touch(self, lease_file):
+        """Renew a lease in place while this daemon owns it, a take over
+        links a new file which is never overwritten
+          Returns: False when the lease is lost
+        """
+        try:
+            with open(lease_file, "rt") as lease:
+                if json.load(lease).get("owner") != self.owner:
+                    return False
+                # Dated by the file server, on the inode which was read
+                os.utime(lease.fileno())
+        except (IOError, ValueError):
+            return False
+        # Taken over between the read and the renewal, missing while
+        # another daemon gives it back
+        return self.read_owner(lease_file) in (self.owner, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.lease_time / 4.0)
+            try:
+                self.renew()
+            except:
+                self.logger.error("Failed to renew the leases")
+                self.logger.error(sys.exc_info()[1])
+
+
+class stack_sampler(Thread):
+    """Sampling profiler counting the stacks of the threads, written in the
+    collapsed format of the flame graphs
+    """
+
+    def __init__(self, logger, profile_file, rate, write_time=60):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = "profiler"
+        self.logger = logger
+        self.profile_file = profile_file
+        self.rate = rate
+        self.write_time = write_time
+        self.counts = {}
+
+    def sample(self):
+        """Count the current stack of each thread, from the thread name
+        """
+        names = {thread.ident: re.sub(r"[_-]\d+$", "", thread.name)
+                 for thread in list_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame:
+                stack.append("{0} ({1}:{2})".format(
+                    frame.f_code.co_name,
+                    os.path.basename(frame.f_code.co_filename),
+                    frame.f_code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, "unknown"))
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def write(self):
+        """Replace the profile with the counts so far
+        """
+        write_atomic(self.profile_file, "".join(
+            "{0} {1}\n".format(stack, count)
+            for stack, count in sorted(self.counts.items())))
+
+    def run(self):
+        write_date = time.time()
+        while True:
+            time.sleep(1.0 / self.rate)
+            try:
+                self.sample()
+                if time.time() - write_date >= self.write_time:
+                    self.write()
+                    write_date = time.time()
+            except:
+                self.logger.error("Profiler failed")
+                self.logger.error(sys.exc_info()[1])
+
+
+class galaxy_janitor(Thread):
+    """Purge the histories and libraries left in galaxy by the jobs
+    """
+    # Names given by galaxy.prepare()
+    patterns = {"history": re.compile(
+                    r"^(data_|batch_)?shaman_([A-Za-z0-9-]+_)?\d+_\d+(_\d+)?$"),
+                "library": re.compile(
+                    r"^lib_shaman_([A-Za-z0-9-]+_)?\d+_\d+$")}
+
+    def __init__(self, logger, galaxy_url, galaxy_key, https_mode,
+                 registry_file, retention, grace_time, poll_time=3600,
+                 doing_dir=None, limiter=None, node=None, task_dirs=()):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = "janitor"
+        self.logger = logger
+        self.gi = GalaxyInstance(url=galaxy_url, key=galaxy_key)
+        self.gi.verify = https_mode
+        if limiter:
+            self.gi = limited_galaxy(self.gi, limiter)
+        self.registry_file = registry_file
+        self.retention = retention
+        self.grace_time = grace_time
+        self.poll_time = poll_time
+        self.doing_dir = doing_dir
+        # Done and error, whose tasks name the jobs of the old daemons
+        self.task_dirs = task_dirs
+        self.limiter = limiter
+        self.node = node
+        self.lock = Lock()
+        self.items = {}
+        self.quota = None
+        # Items of the previous executions of the daemon
+        if os.path.isfile(registry_file):
+            try:
+                with open(registry_file, "rt") as registry:
+                    self.items = json.load(registry)["items"]
+            except (ValueError, KeyError):
+                self.logger.error("Cannot read the janitor registry {0}"
+                                  .format(registry_file))
+
+    def configure(self, galaxy_url, galaxy_key, https_mode, retention,
+                  grace_time, poll_time):
+        """Change the galaxy and the delays, the registry is kept
+        """
+        gi = GalaxyInstance(url=galaxy_url, key=galaxy_key)
+        gi.verify = https_mode
+        if self.limiter:
+            gi = limited_galaxy(gi, self.limiter)
+        with self.lock:
+            self.gi = gi
+            self.retention = retention
+            self.grace_time = grace_time
+            self.poll_time = poll_time
+
+    def save(self):
+        """Write the registry, called with the lock
+        """
+        write_atomic(self.registry_file, json.dumps(
+            {"items": self.items, "quota": self.quota}, indent=1))
+
+    def track(self, kind, item, task):
+        """Register an history or a library created for a task
+        """
+        with self.lock:
+            self.items[item['id']] = {"kind": kind, "name": item['name'],
+                                      "task": task, "created": time.time(),
+                                      "expire": None}
+            self.save()
+
+    def release(self, task, grace_time=None):
+        """The items of a task can be purged after the grace time
+        """
+        if grace_time is None:
+            grace_time = self.grace_time
+        with self.lock:
+            for item in self.items.values():
+                if item["task"] == task:
+                    item["expire"] = time.time() + grace_time
+            self.save()
+
+    def forget(self, task):
+        """Remove the items of a task purged by the task itself
+        """
+        with self.lock:
+            for item_id in [item_id for item_id in self.items
+                            if self.items[item_id]["task"] == task]:
+                del self.items[item_id]
+            self.save()
+
+    def purge(self, item_id, kind, name):
+        """Delete an history or a library in galaxy
+        """
+        self.logger.info("Janitor purges the {0} {1} : {2}".format(
+            kind, name, item_id))
+        if kind == "history":
+            self.gi.histories.delete_history(item_id, purge=True)
+        else:
+            self.gi.libraries.delete_library(item_id)
+
+    def age(self, item):
+        """Seconds since the last update of a galaxy item
+        """
+        update_time = item.get('update_time') or item.get('create_time')
+        if not update_time:
+            return 0
+        update_time = datetime.datetime.strptime(update_time[:19],
+                                                 "%Y-%m-%dT%H:%M:%S")
+        return (datetime.datetime.utcnow() - update_time).total_seconds()
+
+    def clean(self):
+        """Purge the released and the old items, then the unknown ones
+        """
+        now = time.time()
+        # Jobs in doing keep their items, even past the retention
+        running = self.running_jobs()
+        with self.lock:
+            expired = [(item_id, dict(item))
+                       for item_id, item in self.items.items()
+                       if self.job_id(item["name"]) not in running and
+                       ((item["expire"] is not None and
+                         now > item["expire"]) or
+                        now - item["created"] > self.retention)]
+        for item_id, item in expired:
+            try:
+                self.purge(item_id, item["kind"], item["name"])
+            except:
+                self.logger.error("Janitor failed to purge {0}".format(
+                    item["name"]))
+                self.logger.error(sys.exc_info()[1])
+                # Retried at the next cleaning until twice the retention
+                if now - item["created"] < 2 * self.retention:
+                    continue
+            with self.lock:
+                self.items.pop(item_id, None)
+                self.save()
+        # Leaked before the registry, the other hosts purge their own
+        with self.lock:
+            known = set(self.items)
+        jobs = running.union(*[self.task_jobs(task_dir)
+                               for task_dir in self.task_dirs])
+        unknown = ([("history", item)
+                    for item in self.gi.histories.get_histories()] +
+                   [("library", item)
+                    for item in self.gi.libraries.get_libraries()])
+        for kind, item in unknown:
+            if (item['id'] not in known and not item.get('deleted') and
+                self.patterns[kind].match(item['name']) and
+                self.own(item['name'], jobs) and
+                self.job_id(item['name']) not in running and
+                self.age(item) > self.retention):
+                try:
+                    self.purge(item['id'], kind, item['name'])
+                except:
+                    self.logger.error("Janitor failed to purge {0}".format(
+                        item['name']))
+                    self.logger.error(sys.exc_info()[1])
+
+    def job_id(self, name):
+        """Part of an history or library name common to a job
+        """
+        for prefix in ["data_shaman_", "batch_shaman_", "lib_shaman_",
+                       "shaman_"]:
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+                break
+        # Without the run of a sweep
+        return "_".join(name.split("_")[:3])
+
+    def own(self, name, jobs):
+        """Check if an item was created on this host, or before the names
+        of the jobs had a host by a job of the task files
+        """
+        job = self.job_id(name)
+        host = job.split("_")[0]
+        if host.isdigit():
+            return job in jobs
+        return host == self.node
+
+    def task_jobs(self, task_dir):
+        """Galaxy names of the jobs of the task files of a directory
+        """
+        jobs = set()
+        for task in check_work(task_dir):
+            try:
+                with open(task, "rt") as task_file:
+                    data_task = json.load(task_file)
+                jobs.add(self.job_id(data_task["data_history_name"]))
+                # The batch history lives as long as one of its jobs
+                if "batch_history_name" in data_task:
+                    jobs.add(self.job_id(data_task["batch_history_name"]))
+            except (IOError, ValueError, KeyError, TypeError):
+                pass
+        return jobs
+
+    def running_jobs(self):
+        """Galaxy names of the jobs in doing, whichever daemon runs them
+        """
+        if not self.doing_dir:
+            return set()
+        return self.task_jobs(self.doing_dir)
+
+    def report_quota(self):
+        """Log the disk usage of the galaxy user
+        """
+        user = self.gi.users.get_current_user()
+        self.quota = {"total_disk_usage": user.get('total_disk_usage'),
+                      "quota_percent": user.get('quota_percent'),
+                      "quota": user.get('quota'), "time": time.time()}
+        self.logger.info("Galaxy disk usage {0} ({1}% of the quota {2})"
+                         .format(user.get('nice_total_disk_usage'),
+                                 user.get('quota_percent'),
+                                 user.get('quota')))
+        with self.lock:
+            self.save()
+
+    def run(self):
+        while True:
+            try:
+                self.clean()
+                self.report_quota()
+            except:
+                self.logger.error("Janitor failed to clean galaxy")
+                self.logger.error(sys.exc_info()[1])
+            time.sleep(self.poll_time)
+
+
+class upload_watcher(Thread):
+    """Follow the uploads of a data history while the workflow runs
+    """
+
+    def __init__(self, logger, gi, history, progress, poll_time=10):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.gi = gi
+        self.history = history
+        self.progress = progress
+        self.poll_time = poll_time
+        self.failed = Event()
+        self.reported = False
+        self.stopped = Event()
+
+    def stop(self):
+        """Stop to follow the uploads
+        """
+        self.stopped.set()
+
+    def run(self):
+        """Poll the data history until all uploads are ok or one failed
+        """
+        while not self.stopped.is_set():
+            try:
+                upload_story = self.gi.histories.get_status(
+                    self.history['id'])
+                self.progress.update(
+                    "data", float(upload_story['percent_complete']) / 100.0)
+                if (upload_story['state'] == "error" or
+                    upload_story['state_details']['error'] > 0):
+                    self.logger.error(upload_story)
+                    self.failed.set()
+                    break
+                elif upload_story['state'] == "ok":
+                    break
+            except bioblend.ConnectionError:
+                self.logger.error("Upload watcher lost the connection for "
+                                  "{0}".format(self.history['id']))
+            self.stopped.wait(self.poll_time)
+
+
+class result_watcher(Thread):
+    """Download the result files as soon as they are ready in galaxy
+    """
+
+    def __init__(self, logger, gi, history, list_result, result_dir,
+                 delivered, poll_time=10):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.gi = gi
+        self.history = history
+        self.list_result = list_result
+        self.result_dir = result_dir
+        self.delivered = delivered
+        self.poll_time = poll_time
+        self.stopped = Event()
+
+    def stop(self):
+        """Stop to follow the results
+        """
+        self.stopped.set()
+
+    def deliver(self):
+        """Download the expected results that are ready
+        """
+        contents = self.gi.histories.show_history(self.history['id'],
+                                                  contents=True)
+        ready = {}
+        for dataset in contents:
+            if (dataset['state'] == "ok" and not dataset['deleted'] and
+                dataset['name'] not in ready):
+                ready[dataset['name']] = dataset['id']
+        for result_type in self.list_result:
+            for result_file in self.list_result[result_type]:
+                res = self.result_dir + result_file + "." + result_type
+                if res in self.delivered or result_file not in ready:
+                    continue
+                self.gi.datasets.download_dataset(
+                    ready[result_file], file_path=res,
+                    use_default_filename=False, maxwait=60)
+                if os.stat(res).st_size > 0:
+                    self.delivered[res] = ready[result_file]
+                    self.logger.info("Delivered {0}".format(res))
+
+    def run(self):
+        """Poll the result history until the workflow is over
+        """
+        if not os.path.isdir(self.result_dir):
+            os.makedirs(self.result_dir)
+        while not self.stopped.is_set():
+            try:
+                self.deliver()
+            except (bioblend.ConnectionError,
+                    bioblend.galaxy.datasets.DatasetTimeoutException,
+                    IOError):
+                self.logger.error("Result watcher failed to deliver for "
+                                  "{0}".format(self.history['id']))
+                self.logger.error(sys.exc_info()[1])
+            self.stopped.wait(self.poll_time)
+
+
+class pipeline(object):
+    """Staged job execution, each stage has its own queue and worker pool
+    """
+    stages = ["upload", "execute", "download", "package", "notify"]
+
+    def __init__(self, logger, pool_sizes):
+        self.logger = logger
+        self.queues = {}
+        self.workers = []
+        # Keep the submission order between jobs of same priority
+        self.order = itertools.count()
+        # Jobs in the stages by name
+        self.jobs = {}
+        # Stage and job run by each worker thread
+        self.running = {}
+        self.lock = Lock()
+        # No more job started in galaxy once set
+        self.draining = Event()
+        # Number of workers wanted by stage
+        self.sizes = {stage: 0 for stage in self.stages}
+        for stage in self.stages:
+            self.queues[stage] = queue.PriorityQueue()
+        self.resize(pool_sizes)
+
+    def resize(self, pool_sizes):
+        """Start or stop workers to reach the new pool sizes, the jobs in
+        progress finish on their worker
+        """
+        for stage in self.stages:
+            size = max(1, int(pool_sizes.get(stage, 1)))
+            with self.lock:
+                missing = size - self.sizes[stage]
+                self.sizes[stage] = size
+            for num_worker in range(missing):
+                worker = Thread(target=self.work, args=(stage,),
+                                name="{0}_{1}".format(
+                                    stage, next(self.order)))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            # A stop before the jobs of the queue frees an idle worker
+            for num_worker in range(-missing):
+                self.queues[stage].put(
+                    (float("-inf"), next(self.order), None))
+            if missing != 0:
+                self.logger.info("{0} workers for the stage {1}".format(
+                    size, stage))
+
+    def submit(self, djinn, stage=None):
+        """Queue a prepared job on the first stage or a resumed one on its
+        stage
+        """
+        with self.lock:
+            self.jobs[djinn.data_task["name"]] = djinn
+        self.put(stage or self.stages[0], djinn)
+
+    def put(self, stage, djinn):
+        """Queue a job by priority, the lowest first
+        """
+        # The wait in the queue is not charged to the phase deadline
+        djinn.pause()
+        self.queues[stage].put((djinn.priority, next(self.order), djinn))
+
+    def work(self, stage):
+        """Run one stage of the jobs and hand them to the next stage
+        """
+        position = self.stages.index(stage)
+        if position + 1 < len(self.stages):
+            next_stage = self.stages[position + 1]
+        else:
+            next_stage = None
+        while True:
+            djinn = self.queues[stage].get()[2]
+            if djinn is None:
+                self.queues[stage].task_done()
+                self.workers.remove(current_thread())
+                return
+            with self.lock:
+                self.running[current_thread().ident] = (stage, djinn)
+            success = False
+            # Jobs not started yet in galaxy are handed off when draining
+            if self.draining.is_set() and (
+                    stage == "upload" or (stage == "execute" and
+                                          djinn.resumed)):
+                djinn.checkpoint()
+            if not djinn.cancelled.is_set():
+                try:
+                    success = getattr(djinn, stage)()
+                except:
+                    self.logger.error("Stage {0} failed for {1}".format(
+                        stage, djinn.task_file))
+                    self.logger.error(traceback.format_exc())
+                    djinn.discard(sys.exc_info()[1])
+                    success = False
+            if djinn.cancelled.is_set():
+                # Purge what the stage created after the cancellation
+                djinn.abort()
+                success = False
+            if success and next_stage:
+                self.put(next_stage, djinn)
+            else:
+                with self.lock:
+                    self.jobs.pop(djinn.data_task["name"], None)
+                djinn.release_lease()
+            with self.lock:
+                self.running.pop(current_thread().ident, None)
+            self.queues[stage].task_done()
+
+    def drain(self, timeout):
+        """Checkpoint the jobs waiting for galaxy and let the uploads and
+        the deliveries finish before the timeout
+          Returns: True when no job was interrupted
+        """
+        self.draining.set()
+        deadline = time.time() + timeout
+        interrupted = False
+        while True:
+            with self.lock:
+                jobs = list(self.jobs.values())
+            if not jobs:
+                return not interrupted
+            if time.time() >= deadline:
+                if interrupted:
+                    return False
+                self.logger.warning("Drain timeout, {0} jobs resumed "
+                                    "later".format(len(jobs)))
+                # Some time for the workers to notice the checkpoint
+                interrupted = True
+                deadline = time.time() + 60
+            for djinn in jobs:
+                if interrupted or djinn.phase == "workflow":
+                    djinn.checkpoint()
+            time.sleep(1)
+
+def batch_members(data_task):
+    """Tasks of a batch, a list of tasks or an object whose "tasks" share
+    its other fields
+      Returns: The tasks, None when it is a single task
+    """
+    if (isinstance(data_task, dict) and
+            isinstance(data_task.get("tasks"), list) and
+            len(data_task["tasks"]) > 0):
+        common = {key: value for key, value in data_task.items()
+                  if key != "tasks"}
+        return [dict(common, **member) if isinstance(member, dict)
+                else member for member in data_task["tasks"]]
+    if isinstance(data_task, list) and len(data_task) > 1:
+        return data_task
+    return None
+
+
+def split_batch(logger, task_file, leases=None):
+    """Write each task of a batch file as a task of todo
+      Returns: True when the file was a batch
+    """
+    try:
+        with open(task_file, "rt") as task:
+            members = batch_members(json.load(task))
+    except (IOError, ValueError):
+        return False
+    if not members:
+        return False
+    name = os.path.splitext(os.path.basename(task_file))[0]
+    # Only one daemon splits a batch
+    if leases and not leases.acquire(name):
+        return True
+    try:
+        if not os.path.isfile(task_file):
+            return True
+        for num_member, member in enumerate(members):
+            if isinstance(member, dict):
+                member["batch"] = name
+                member["batch_size"] = len(members)
+            write_atomic("{0}{1}_{2}.json".format(
+                os.path.dirname(task_file) + os.sep, name, num_member),
+                json.dumps(member))
+        os.remove(task_file)
+        logger.info("Batch {0} split in {1} tasks".format(name,
+                                                           len(members)))
+    finally:
+        if leases:
+            leases.release(name)
+    return True
+
+
+def validate_task(data_task, task_file):
+    """Check a task like shaman writes it in todo
+      Returns: The task, named after its file
+    """
+    if isinstance(data_task, (list, tuple)) and len(data_task) > 0:
+        data_task = data_task[0]
+    if not isinstance(data_task, dict) or len(data_task) == 0:
+        raise ValueError("Json {0} is empty".format(task_file))
+    data_task["name"] = os.path.splitext(os.path.basename(task_file))[0]
+    if "paired" not in data_task:
+        raise ValueError("Paired information is missing in {0}".format(task_file))
+    isinstance(data_task["paired"], bool)
+    if data_task["paired"]:
+        for pair in ["path_R1", "path_R2"]:
+            if pair not in data_task:
+                raise ValueError(
+                    pair + " information is missing in {0}".format(task_file))
+            if not os.path.isdir(data_task[pair]):
+                raise ValueError(
+                    pair + " is not a file in {0}".format(task_file))
+            if "pattern_R1" not in data_task:
+                raise ValueError(
+                "pattern_R1 information is missing in {0}".format(task_file))
+    else:
+        if "path" not in data_task:
+            raise ValueError(
+                "path information is missing in {0}".format(task_file))
+        if not os.path.isdir(data_task["path"]):
+            raise ValueError(
+                "path information is not a directory for {0}".format(task_file))
+    if "contaminant" not in data_task:
+        raise ValueError(
+            "path information is missing in {0}".format(task_file))
+    if not os.path.isfile(data_task["contaminant"]):        
+        raise ValueError(
+            "contaminant information is not a file for {0}".format(task_file))
+    if "host" not in data_task:
+        raise ValueError("host information is missing in {0}".format(task_file))
+    if "type" not in data_task:
+        raise ValueError("type information is missing in {0}".format(task_file))
+    if data_task["type"] not in ["16S", "18S", "23S_28S",
+                                 "ITS", "WGS"]:
+        raise ValueError("type information is incorrect in {0}".format(task_file))
+    if "mail" not in data_task:
+        raise ValueError(
+                "mail information is missing in {0}".format(task_file))
+    if "sweep" in data_task:
+        if (not isinstance(data_task["sweep"], list) or
+            len(data_task["sweep"]) == 0):
+            raise ValueError(
+                "sweep is not a list of parameters in {0}".format(task_file))
+        for parameters in data_task["sweep"]:
+            if (not isinstance(parameters, dict) or
+                not set(parameters) <= set(sweep_parameters)):
+                raise ValueError(
+                    "sweep parameters are incorrect in {0}".format(task_file))
+    return data_task
+
+
+def task_paths(data_task):
+    """Directories of the reads of a task
+    """
+    if data_task["paired"]:
+        return [data_task["path_R1"], data_task["path_R2"]]
+    return [data_task["path"]]
+
+
+def task_size(data_task):
+    """Count the bytes of a task to send
+    """
+    total_bytes = os.path.getsize(data_task["contaminant"])
+    for path in task_paths(data_task):
+        for fastq_file in glob.glob('{0}/*.f*q*'.format(path)):
+            total_bytes += os.path.getsize(fastq_file)
+    return total_bytes
+
+
+def record_wait(logger, wait_file, reason):
+    """Record in todo why a task is not started, logged when the cause
+    changes
+    """
+    try:
+        with open(wait_file, "rt") as wait:
+            previous = wait.readline().rstrip("\n")
+    except IOError:
+        previous = None
+    if previous == reason:
+        return
+    # The same cause with other figures is not logged again
+    if previous is None or (re.sub(r"[0-9.]+", "", previous) !=
+                            re.sub(r"[0-9.]+", "", reason)):
+        logger.info("{0} waits: {1}".format(
+            os.path.splitext(wait_file)[0] + ".json", reason))
+    write_atomic(wait_file, "{0}\n{1}\n".format(
+        reason, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+
+def held(logger, task_file, admission):
+    """Check from the task alone if the admission keeps it in todo, before
+    any galaxy client or lease is made for it
+      Returns: True when the task waits
+    """
+    try:
+        with open(task_file, "rt") as task:
+            data_task = validate_task(json.load(task), task_file)
+        reason = admission.hold(task_size(data_task),
+                                len(data_task.get("sweep", [None])))
+    except:
+        # Reported when the task is prepared
+        return False
+    if reason:
+        record_wait(logger, os.path.splitext(task_file)[0] + ".wait", reason)
+        return True
+    return False
+
+
+def supervise(workers, doing_dir, deadlines):
+    """Cancel the jobs asked in doing and the ones late in their phase
+    """
+    with workers.lock:
+        jobs = dict(workers.jobs)
+    for name, djinn in jobs.items():
+        # None while the job waits in a queue
+        phase_start = djinn.phase_start
+        if os.path.isfile(doing_dir + name + ".cancel"):
+            djinn.cancel("cancelled on request")
+        elif (phase_start and deadlines.get(djinn.phase, 0) > 0 and
+              time.time() - phase_start > deadlines[djinn.phase]):
+            djinn.cancel("{0} exceeded its deadline of {1:.3g} h".format(
+                djinn.phase, deadlines[djinn.phase] / 3600.0), mail=True)
+
+
+def solve_linear(matrix):
+    """Solve a linear system given as an augmented matrix by gaussian
+    elimination, None when it is singular
+    """
+    size = len(matrix)
+    matrix = [list(row) for row in matrix]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda row: abs(matrix[row][col]))
+        if abs(matrix[pivot][col]) < 1e-12:
+            return None
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        for row in range(size):
+            if row != col:
+                factor = matrix[row][col] / matrix[col][col]
+                for k in range(col, size + 1):
+                    matrix[row][k] -= factor * matrix[col][k]
+    return [matrix[row][size] / matrix[row][row] for row in range(size)]
+
+
+def read_tsv(tsv_file):
+    """Read a table with a header and the identifiers in the first column
+      Returns: header, identifiers, rows
+    """
+    with open(tsv_file, "rt") as tsv:
+        header = tsv.readline().rstrip("\r\n").split("\t")
+        identifiers = []
+        rows = []
+        for line in tsv:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) == 1 and fields[0] == "":
+                continue
+            identifiers.append(fields[0])
+            # Unassigned ranks can be missing at the end of the line
+            rows.append((fields[1:] + [""] * (len(header) - len(fields)))
+                        [:len(header) - 1])
+    return header, identifiers, rows
+
+
+def read_otu_table(tsv_file):
+    """Read the non zero counts of the OTU table, line by line
+      Returns: samples, OTU identifiers, rows, columns and values of the
+        counts (OTU x samples)
+    """
+    row = array.array("q")
+    col = array.array("q")
+    data = array.array("d")
+    otu_ids = []
+    with open(tsv_file, "rt") as tsv:
+        header = tsv.readline().rstrip("\r\n").split("\t")
+        for line in tsv:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) == 1 and fields[0] == "":
+                continue
+            if len(fields) < len(header):
+                raise ValueError("Missing counts for {0} in {1}".format(
+                    fields[0], tsv_file))
+            for sample, value in enumerate(fields[1:len(header)]):
+                count = float(value)
+                if count != 0:
+                    row.append(len(otu_ids))
+                    col.append(sample)
+                    data.append(count)
+            otu_ids.append(fields[0])
+    row = numpy.frombuffer(row, dtype=numpy.int64)
+    col = numpy.frombuffer(col, dtype=numpy.int64)
+    data = numpy.frombuffer(data, dtype=float)
+    if numpy.all(numpy.mod(data, 1) == 0):
+        data = data.astype(numpy.int64)
+    return header[1:], otu_ids, row, col, data
+
+
+def export_columnar(tsv_file, columnar_format):
+    """Write a feather or npz copy of an OTU table or an annotation
+      Returns: Path to the new file
+    """
+    is_otu_table = os.path.basename(tsv_file) == "shaman_otu_table.tsv"
+    if columnar_format == "feather":
+        if not pyarrow:
+            raise ImportError("pyarrow is required for the feather export")
+        columnar_file = os.path.splitext(tsv_file)[0] + ".feather"
+        header, identifiers, rows = read_tsv(tsv_file)
+        columns = {header[0]: identifiers}
+        for i, column in enumerate(header[1:]):
+            values = [row[i] for row in rows]
+            if is_otu_table:
+                values = [float(value) for value in values]
+            columns[column] = values
+        pyarrow.feather.write_feather(pyarrow.table(columns), columnar_file)
+    else:
+        if not numpy:
+            raise ImportError("numpy is required for the npz export")
+        columnar_file = os.path.splitext(tsv_file)[0] + ".npz"
+        if is_otu_table:
+            samples, otu_ids, row, col, data = read_otu_table(tsv_file)
+            # Sparse coordinates of the non zero counts
+            numpy.savez_compressed(
+                columnar_file, otu_ids=numpy.array(otu_ids),
+                samples=numpy.array(samples), row=row.astype(numpy.int32),
+                col=col.astype(numpy.int32), data=data,
+                shape=numpy.array([len(otu_ids), len(samples)]))
+        else:
+            header, identifiers, rows = read_tsv(tsv_file)
+            numpy.savez_compressed(
+                columnar_file, otu_ids=numpy.array(identifiers),
+                ranks=numpy.array(header[1:]),
+                annotation=numpy.array(rows, dtype=str).reshape(
+                    len(identifiers), len(header) - 1))
+    return columnar_file
+
+
+def read_fastq(fastq_file):
+    """Records of a fastq, gzipped or not
+    """
+    if fastq_file.endswith(".gz"):
+        fastq = gzip.open(fastq_file, "rb")
+    else:
+        fastq = open(fastq_file, "rb")
+    with fastq:
+        while True:
+            record = b"".join(itertools.islice(fastq, 4))
+            if not record:
+                return
+            yield record
+
+
+def subsample_fastq(input_dirs, output_dirs, num_reads, seed=None):
+    """Reservoir sample of the reads of each sample in one pass, the mates
+    of paired reads are kept together
+    """
+    rng = random.Random(seed)
+    input_files = [sorted(glob.glob('{0}/*.f*q*'.format(input_dir)))
+                   for input_dir in input_dirs]
+    for output_dir in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+    for sample_files in zip(*input_files):
+        reservoir = []
+        for index, records in enumerate(
+                zip(*[read_fastq(sample_file)
+                      for sample_file in sample_files])):
+            if index < num_reads:
+                reservoir.append(records)
+            else:
+                slot = rng.randint(0, index)
+                if slot < num_reads:
+                    reservoir[slot] = records
+        for position, (sample_file, output_dir) in enumerate(
+                zip(sample_files, output_dirs)):
+            fastq_name = os.path.basename(sample_file)
+            if fastq_name.endswith(".gz"):
+                fastq_name = fastq_name[:-3]
+            with open(output_dir + fastq_name, "wb") as fastq:
+                for records in reservoir:
+                    fastq.write(records[position])
+
+
+def file_hash(path, hash_function):
+    """Hash of a file read by chunks
+    """
+    digest = hashlib.new(hash_function)
+    with open(path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(1048576), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_fasta_ids(fasta_file):
+    """Identifiers of the sequences, without the size annotation
+    """
+    with open(fasta_file, "rt") as fasta:
+        return [line[1:].split()[0].split(";")[0] for line in fasta
+                if line.startswith(">") and len(line) > 2]
+
+
+def read_biom_ids(biom_file):
+    """Identifiers of the rows of a json biom, None for an hdf5 biom
+      and an empty list for an unreadable biom
+    """
+    with open(biom_file, "rb") as biom:
+        if biom.read(4) == b"\x89HDF":
+            return None
+    try:
+        with open(biom_file, "rt") as biom:
+            return [row['id'] for row in json.load(biom)['rows']]
+    except (ValueError, KeyError, TypeError):
+        return []
+
+
+def write_tsv(tsv_file, header, rows):
+    """Write a table with a header
+    """
+    with open(tsv_file, "wt") as tsv:
+        tsv.write("\t".join(header) + "\n")
+        for row in rows:
+            tsv.write("\t".join(str(value) for value in row) + "\n")
+
+
+def rarefaction(counts, depths):
+    """Expected richness of each sample subsampled at each depth
+      Arguments:
+          counts: Sparse OTU x samples counts (csc)
+          depths: Depths of subsampling
+      Returns: Richness (samples x depths), nan above the library size
+    """
+    library_size = numpy.asarray(counts.sum(axis=0)).ravel()
+    richness = numpy.full((counts.shape[1], len(depths)), numpy.nan)
+    gammaln = scipy.special.gammaln
+    depths = numpy.asarray(depths, dtype=float)
+    for sample in range(counts.shape[1]):
+        abundance = counts.data[counts.indptr[sample]:counts.indptr[sample + 1]]
+        total = library_size[sample]
+        reachable = depths <= total
+        depth = depths[reachable][numpy.newaxis, :]
+        # Probability that an OTU is absent from the subsample (OTU x depth)
+        rest = (total - abundance)[:, numpy.newaxis]
+        possible = rest >= depth
+        log_absent = (gammaln(rest + 1) - gammaln(numpy.where(possible, rest - depth, 0) + 1)
+                      - gammaln(total + 1) + gammaln(total - depth + 1))
+        absent = numpy.where(possible, numpy.exp(log_absent), 0.0)
+        richness[sample, reachable] = numpy.sum(1.0 - absent, axis=0)
+    return richness
+
+
+def summarize(otu_table_file, annotation_files, summary_dir, num_depth=20):
+    """Compute library sizes, alpha diversity, rarefaction curves and the
+       counts at each taxonomic rank
+      Returns: Paths to the summary tables
+    """
+    if not numpy or not scipy:
+        raise ImportError("numpy and scipy are required for the summaries")
+    if not os.path.isdir(summary_dir):
+        os.makedirs(summary_dir)
+    summary_files = []
+    samples, otu_ids, row, col, data = read_otu_table(otu_table_file)
+    counts = scipy.sparse.csc_matrix(
+        (data.astype(float), (row, col)), shape=(len(otu_ids), len(samples)))
+    # Alpha diversity from the non zero counts of each sample
+    library_size = numpy.asarray(counts.sum(axis=0)).ravel()
+    sample_index = numpy.repeat(numpy.arange(counts.shape[1]),
+                                numpy.diff(counts.indptr))
+    proportion = counts.data / library_size[sample_index]
+    num_sample = counts.shape[1]
+    observed = numpy.diff(counts.indptr)
+    shannon = -numpy.bincount(sample_index,
+                              weights=proportion * numpy.log(proportion),
+                              minlength=num_sample)
+    simpson = numpy.bincount(sample_index, weights=proportion ** 2,
+                             minlength=num_sample)
+    singletons = numpy.bincount(sample_index, weights=counts.data == 1,
+                                minlength=num_sample)
+    doubletons = numpy.bincount(sample_index, weights=counts.data == 2,
+                                minlength=num_sample)
+    chao1 = observed + singletons * (singletons - 1) / (2.0 * (doubletons + 1))
+    alpha_file = summary_dir + "shaman_alpha_diversity.tsv"
+    write_tsv(alpha_file, ["sample", "library_size", "observed", "chao1",
+                           "shannon", "simpson", "inverse_simpson"],
+              [[samples[i], int(library_size[i]), int(observed[i]),
+                round(chao1[i], 4), round(abs(shannon[i]), 4),
+                round(1.0 - simpson[i], 4), round(1.0 / simpson[i], 4)]
+               if library_size[i] > 0 else
+               [samples[i], 0, 0, 0, "NA", "NA", "NA"]
+               for i in range(num_sample)])
+    summary_files.append(alpha_file)
+    # Rarefaction curves on the same depths for all the samples
+    if library_size.max() > 0:
+        depths = numpy.unique(numpy.linspace(
+            1, library_size.max(), num_depth).astype(numpy.int64))
+        richness = rarefaction(counts, depths)
+        rarefaction_file = summary_dir + "shaman_rarefaction.tsv"
+        write_tsv(rarefaction_file, ["sample", "depth", "richness"],
+                  [[samples[i], depths[j], round(richness[i, j], 4)]
+                   for i in range(num_sample) for j in range(len(depths))
+                   if not numpy.isnan(richness[i, j])])
+        summary_files.append(rarefaction_file)
+    # Counts aggregated at each rank of each annotation
+    otu_position = {otu_id: i for i, otu_id in enumerate(otu_ids)}
+    for annotation_file in annotation_files:
+        header, annotated_ids, ranks = read_tsv(annotation_file)
+        rows = []
+        for level, rank in enumerate(header[1:]):
+            taxa = ["Unassigned"] * len(otu_ids)
+            for otu_id, lineage in zip(annotated_ids, ranks):
+                if otu_id in otu_position and lineage[level] != "":
+                    taxa[otu_position[otu_id]] = lineage[level]
+            taxon_names, taxon_index = numpy.unique(taxa, return_inverse=True)
+            # Taxa x OTU indicator times the counts
+            membership = scipy.sparse.csr_matrix(
+                (numpy.ones(len(otu_ids)),
+                 (taxon_index.ravel(), numpy.arange(len(otu_ids)))),
+                shape=(len(taxon_names), len(otu_ids)))
+            taxon_counts = (membership @ counts).toarray()
+            for j, taxon in enumerate(taxon_names):
+                rows.append([rank, taxon] + [
+                    int(value) if value == int(value) else value
+                    for value in taxon_counts[j]])
+        rank_file = (summary_dir + os.path.basename(annotation_file)
+                     .replace("_annotation.tsv", "_rank_counts.tsv"))
+        write_tsv(rank_file, ["rank", "taxon"] + samples, rows)
+        summary_files.append(rank_file)
+    return summary_files
+
+
+def isdir(path):
+    """Check if path is an existing file.
+      Arguments:
+          path: Path to the file
+    """
+    if not os.path.isdir(path):
+        if os.path.isfile(path):
+            msg = "{0} is a file.".format(path)
+        else:
+            msg = "{0} does not exist.".format(path)
+        raise argparse.ArgumentTypeError(msg)
+    return path
+
+
+def iswritable(path):
+    """Check if path is an existing directory where files can be written.
+      Arguments:
+          path: Path to the directory
+    """
+    isdir(path)
+    if not os.access(path, os.W_OK | os.X_OK):
+        raise argparse.ArgumentTypeError("{0} is not writable.".format(path))
+    return path
+
+
+def get_parser():
+    """Options of the program, on the command line or in the config file
+      Returns: The argument parser
+    """
+    parser = argparse.ArgumentParser(description=__doc__, usage=
+                                     "{0} -h".format(sys.argv[0]))
+    parser.add_argument('-u', dest='galaxy_url', type=str, #required=True,
+                        default='https://galaxy.pasteur.fr',
+                        #default='https://galaxy-dev.pasteur.fr',
+                        #default='https://maestro-galaxy-dev.maestro.pasteur.fr',
+                        #default='http://127.0.0.1:8080',
+                        help='Url to galaxy.')
+    parser.add_argument('-k', dest='galaxy_key', type=str, #required=True,
+                        default='31f05d9edaa2228b66c538f43b0d5d52',
+                        #default=keyring.get_password("galaxy", "aghozlan"),
+                        #default='7ac30484f696937116f960531a05c2b6',
+                        #default='f293dce7785a77c338db9e8b8df9922c',
+                        help='User galaxy key.')
+    parser.add_argument('-w', dest='work_dir', type=iswritable, required=True,
+                        action=FullPaths, help='Path to the top directory.')
+    parser.add_argument('-i', dest='interactive_mode', action='store_false',
+                        default=True, help='Do not detatch process.')
+    parser.add_argument('-s', dest='https_mode', action='store_true',
+                        default=False, help='Activate https verification.')
+    parser.add_argument('-d', dest='delete_mode', action='store_true',
+                        default=False, help='Delete reads provided as input.')
+    parser.add_argument('-n', dest='upload_wait', action='store_false',
+                        default=True, help='Start the workflow without '
+                        'waiting for the end of the uploads.')
+    parser.add_argument('-r', dest='incremental', action='store_true',
+                        default=False, help='Download each result file as '
+                        'soon as it is ready in galaxy.')
+    parser.add_argument('-f', dest='fetch_mode', action='store_true',
+                        default=False, help='Upload the reads of each '
+                        'collection in one request.')
+    parser.add_argument('--compress_threads', dest='compress_threads',
+                        type=int, default=0, help='Threads gzipping the raw '
+                        'fastq in bgzf blocks while they are sent, the reads '
+                        'are then uploaded like with -f, 0 to send them as '
+                        'they are (default 0).')
+    parser.add_argument('--preview_reads', dest='preview_reads', type=int,
+                        default=10000, help='Reads per sample of the preview '
+                        'run of a task asking for it with "preview": true, '
+                        'or a number of reads (default 10000).')
+    parser.add_argument('--preview_size', dest='preview_size', type=float,
+                        default=0.0, help='Input size in Gb from which a '
+                        'preview is run for every task, 0 to run it only on '
+                        'demand (default 0).')
+    parser.add_argument('--export_threshold', dest='export_threshold',
+                        type=int, default=12, help='Number of result files '
+                        'from which the whole history is exported in one '
+                        'archive (default 12).')
+    parser.add_argument('--columnar', dest='columnar', type=str,
+                        choices=['feather', 'npz'], default=None,
+                        help='Add a columnar copy of the OTU table and the '
+                        'annotations in the archive.')
+    parser.add_argument('--summary', dest='summary', action='store_true',
+                        default=False, help='Add library sizes, alpha '
+                        'diversity, rarefaction curves and counts per rank '
+                        'in the archive.')
+    parser.add_argument('--no_verify', dest='verify', action='store_false',
+                        default=True, help='Do not check the downloaded '
+                        'files against galaxy.')
+    parser.add_argument('--grace_time', dest='grace_time', type=float,
+                        default=48.0, help='Hours during which the galaxy '
+                        'histories of a failed job are kept for '
+                        'shaman_finisher.py (default 48).')
+    parser.add_argument('--retention', dest='retention', type=float,
+                        default=14.0, help='Days after which the janitor '
+                        'purges any history or library of the daemon '
+                        '(default 14).')
+    parser.add_argument('--no_janitor', dest='janitor', action='store_false',
+                        default=True, help='Do not purge the histories and '
+                        'libraries left in galaxy, for a galaxy account '
+                        'shared with other tools.')
+    parser.add_argument('--janitor_time', dest='janitor_time', type=float,
+                        default=60.0, help='Minutes between two cleanings '
+                        'of galaxy (default 60).')
+    parser.add_argument('--result_size', dest='result_size', type=float,
+                        default=500.0, help='Disk space in Mb expected for '
+                        'the results of one run, a job waits in todo '
+                        'without it (default 500).')
+    parser.add_argument('--max_quota', dest='max_quota', type=float,
+                        default=90.0, help='Percentage of the galaxy quota '
+                        'above which jobs wait in todo, 0 to disable '
+                        '(default 90).')
+    parser.add_argument('--max_galaxy_jobs', dest='max_galaxy_jobs',
+                        type=int, default=200, help='Number of queued or '
+                        'running galaxy jobs above which jobs wait in todo, '
+                        '0 to disable (default 200).')
+    parser.add_argument('--aging', dest='aging', type=float, default=1.0,
+                        help='Seconds of expected runtime a job waiting for '
+                        'one second overtakes, higher favours the arrival '
+                        'order over the shortest jobs (default 1).')
+    parser.add_argument('--upload_deadline', dest='upload_deadline',
+                        type=float, default=12.0, help='Hours allowed to '
+                        'send the reads, 0 for no limit (default 12).')
+    parser.add_argument('--data_deadline', dest='data_deadline', type=float,
+                        default=24.0, help='Hours allowed to galaxy to '
+                        'process the reads, 0 for no limit (default 24).')
+    parser.add_argument('--workflow_deadline', dest='workflow_deadline',
+                        type=float, default=168.0, help='Hours allowed to '
+                        'the workflow, 0 for no limit (default 168).')
+    parser.add_argument('--download_deadline', dest='download_deadline',
+                        type=float, default=12.0, help='Hours allowed to '
+                        'download the results, 0 for no limit (default 12).')
+    parser.add_argument('--api_port', dest='api_port', type=int,
+                        default=0, help='Local port of the submission '
+                        'api, open to every local user without '
+                        'authentication, refused with -d and without '
+                        '--input_root, 0 to disable it (default 0).')
+    parser.add_argument('--api_socket', dest='api_socket', type=str,
+                        default=None, help='Unix socket of the submission '
+                        'api instead of the local port, only open to the '
+                        'user of the daemon.')
+    parser.add_argument('--input_root', dest='input_root', type=isdir,
+                        action=FullPaths, default=None, help='Directory '
+                        'holding the reads and the contaminants of the tasks '
+                        'submitted through the api, the other paths are '
+                        'refused.')
+    parser.add_argument('--lease_time', dest='lease_time', type=float,
+                        default=60.0, help='Seconds without heartbeat after '
+                        'which another daemon sharing the work directory '
+                        'takes over a job (default 60).')
+    parser.add_argument('--read_rate', dest='read_rate', type=float,
+                        default=10.0, help='Galaxy calls per second other '
+                        'than uploads and invocations, 0 for no limit '
+                        '(default 10).')
+    parser.add_argument('--upload_rate', dest='upload_rate', type=float,
+                        default=2.0, help='Galaxy upload calls per second, '
+                        '0 for no limit (default 2).')
+    parser.add_argument('--invoke_rate', dest='invoke_rate', type=float,
+                        default=0.5, help='Galaxy workflow invocations per '
+                        'second, 0 for no limit (default 0.5).')
+    parser.add_argument('--bandwidth', dest='bandwidth', type=float,
+                        default=0.0, help='Upload bandwidth in Mb/s shared '
+                        'between the submitters, the reads are then sent as '
+                        'with -f except the large files sent through a '
+                        'library, 0 for no limit (default 0).')
+    parser.add_argument('--mail_weight', dest='mail_weight', type=str,
+                        action='append', default=[], help='Share of the '
+                        'bandwidth of a submitter as mail=weight (default 1), '
+                        'can be repeated.')
+    parser.add_argument('--cache_size', dest='cache_size', type=float,
+                        default=10.0, help='Disk space in Gb kept for the '
+                        'results of previous jobs, 0 to disable the cache '
+                        '(default 10).')
+    parser.add_argument('--upload_workers', dest='upload_workers', type=int,
+                        default=2, help='Number of jobs uploading reads at '
+                        'the same time (default 2).')
+    parser.add_argument('--execute_workers', dest='execute_workers',
+                        type=int, default=10, help='Number of jobs running '
+                        'on galaxy at the same time (default 10).')
+    parser.add_argument('--download_workers', dest='download_workers',
+                        type=int, default=2, help='Number of jobs '
+                        'downloading results at the same time (default 2).')
+    parser.add_argument('--package_workers', dest='package_workers',
+                        type=int, default=2, help='Number of jobs building '
+                        'their archive at the same time (default 2).')
+    parser.add_argument('--notify_workers', dest='notify_workers', type=int,
+                        default=1, help='Number of jobs sending their mail at '
+                        'the same time (default 1).')
+    parser.add_argument('--loop_time', dest='loop_time', type=float,
+                        default=5, help='Seconds between two checks of the '
+                        'todo directory (default 5).')
+    parser.add_argument('--poll_time', dest='poll_time', type=float,
+                        default=10, help='Seconds between two checks of a '
+                        'galaxy history or invocation (default 10).')
+    parser.add_argument('--large_file', dest='large_file', type=float,
+                        default=2.0, help='Size in Gb of a fastq sent through '
+                        'a library instead of the upload tool (default 2).')
+    parser.add_argument('--attachment_size', dest='attachment_size',
+                        type=float, default=10.0, help='Size in Mb under '
+                        'which the results are attached to the mail '
+                        '(default 10).')
+    parser.add_argument('--drain_time', dest='drain_time', type=float,
+                        default=10, help='Minutes given on SIGTERM to the '
+                        'uploads and deliveries in progress, the jobs running '
+                        'in galaxy are left for the next start (default 10).')
+    parser.add_argument('--profile_rate', dest='profile_rate', type=float,
+                        default=0, help='Samples per second of the stacks of '
+                        'the threads, written every minute in '
+                        'profile_<host>.folded of the work directory for the '
+                        'flame graphs, 0 to disable (default 0).')
+    parser.add_argument('--config', dest='config', type=str, default=None,
+                        help='Json file of options named like their '
+                        'destination, e.g. {"execute_workers": 20}, read at '
+                        'start and again on SIGHUP. The jobs already running '
+                        'keep their galaxy and their options.')
+    return parser
+
+
+def getArguments():
+    """Retrieves the arguments of the program.
+      Returns: An object that contains the arguments
+    """
+    # Parsing arguments
+    args = get_parser().parse_args()
+    return args
+
+
+def get_log(path_log):
+    """
+    """
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
+    # Create log file
+    file_handler = RotatingFileHandler(path_log, 'a', 1000000, 1)
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+    # Stream in the the console
+    ## TO REMOVE IF daemon
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.DEBUG)
+    logger.addHandler(stream_handler)
+    return logger
+
+
+def check_work(todo_dir):
+    """Check if a new job need to be done
+    """
+    return [task for task in glob.glob('{0}/*.json'.format(todo_dir))
+            if os.path.basename(task) != "progress.json"]
+
+def create_dir(list_dir):
+    """
+    """
+    for dir_path in list_dir:
+        try:
+            os.mkdir(dir_path)
+        except FileExistsError:
+            pass
+
+
+def get_options(args):
+    """Gather the daemon tuning options
+    """
+    options = {}
+    options["pool_sizes"] = {stage: getattr(args, stage + "_workers")
+                             for stage in pipeline.stages}
+    options["upload_wait"] = args.upload_wait
+    options["incremental"] = args.incremental
+    options["fetch_mode"] = args.fetch_mode
+    options["compress_threads"] = args.compress_threads
+    options["preview_reads"] = args.preview_reads
+    options["preview_size"] = int(args.preview_size * 1000000000)
+    options["export_threshold"] = args.export_threshold
+    options["columnar"] = args.columnar
+    options["summary"] = args.summary
+    options["verify"] = args.verify
+    options["cache_size"] = int(args.cache_size * 1000000000)
+    options["result_size"] = int(args.result_size * 1000000)
+    options["max_quota"] = args.max_quota
+    options["max_galaxy_jobs"] = args.max_galaxy_jobs
+    options["aging"] = max(args.aging, 1e-6)
+    options["deadlines"] = {
+        phase: getattr(args, phase + "_deadline") * 3600
+        for phase in ["upload", "data", "workflow", "download"]}
+    options["api_port"] = args.api_port
+    options["api_socket"] = args.api_socket
+    options["input_root"] = args.input_root
+    options["lease_time"] = args.lease_time
+    options["node"] = socket.gethostname().split(".")[0].replace("_", "-")
+    options["rates"] = (args.read_rate, args.upload_rate, args.invoke_rate)
+    options["bandwidth"] = int(args.bandwidth * 1000000)
+    options["mail_weights"] = {}
+    for mail_weight in args.mail_weight:
+        mail, weight = mail_weight.rsplit("=", 1)
+        options["mail_weights"][mail] = float(weight)
+    options["grace_time"] = args.grace_time * 3600
+    options["retention"] = args.retention * 86400
+    options["janitor"] = args.janitor
+    options["janitor_time"] = args.janitor_time * 60
+    options["loop_time"] = args.loop_time
+    options["poll_time"] = args.poll_time
+    options["large_file"] = int(args.large_file * 1000000000)
+    options["attachment_size"] = int(args.attachment_size * 1000000)
+    options["drain_time"] = args.drain_time * 60
+    options["profile_rate"] = args.profile_rate
+    return options
+
+
+def read_config(args):
+    """Override the arguments by the values of the config file
+      Returns: New arguments, those of the command line are kept
+    """
+    with open(args.config, "rt") as config_file:
+        config = json.load(config_file)
+    if not isinstance(config, dict):
+        raise ValueError("Config {0} is not a json object".format(
+            args.config))
+    parser = get_parser()
+    actions = {action.dest: action for action in parser._actions}
+    config_args = argparse.Namespace(**vars(args))
+    for key, value in config.items():
+        if key not in vars(args) or key not in actions or key == "config":
+            raise ValueError("Unknown option {0} in {1}".format(
+                key, args.config))
+        action = actions[key]
+        try:
+            if action.nargs == 0:
+                # A flag
+                if not isinstance(value, bool):
+                    raise ValueError("true or false is expected")
+            elif isinstance(action, argparse._AppendAction):
+                if not isinstance(value, list):
+                    raise ValueError("a list is expected")
+                value = [config_value(action, item) for item in value]
+            elif value is not None or action.default is not None:
+                value = config_value(action, value)
+        except (argparse.ArgumentTypeError, ValueError, TypeError):
+            raise ValueError("Wrong value {0} for {1} in {2}: {3}".format(
+                value, key, args.config, sys.exc_info()[1]))
+        if isinstance(action, FullPaths):
+            action(parser, config_args, value)
+        else:
+            setattr(config_args, key, value)
+    return config_args
+
+
+def config_value(action, value):
+    """Check a value of the config file with the type and the choices of
+    its option, as on the command line
+      Returns: The value converted by the type
+    """
+    if isinstance(value, bool):
+        raise ValueError("{0} is not a flag".format(action.dest))
+    if action.type in (int, float):
+        if not isinstance(value, (int, float)):
+            raise ValueError("a number is expected")
+        if action.type is int and value != int(value):
+            raise ValueError("an integer is expected")
+        value = action.type(value)
+    else:
+        if not isinstance(value, str):
+            raise ValueError("a string is expected")
+        if action.type:
+            value = action.type(value)
+    if action.choices is not None and value not in action.choices:
+        raise ValueError("choose from {0}".format(
+            ", ".join(str(choice) for choice in action.choices)))
+    return value
+
+
+def reload_config(logger, args, config_args):
+    """Read again the config file, the options fixed at start are kept
+      Returns: The new arguments or None when the config is wrong
+    """
+    try:
+        new_args = read_config(args)
+        get_options(new_args)
+    except (IOError, ValueError, TypeError):
+        logger.error("Cannot reload the config {0}".format(args.config))
+        logger.error(sys.exc_info()[1])
+        return None
+    for key in fixed_options:
+        if getattr(new_args, key) != getattr(config_args, key):
+            logger.warning("Option {0} needs a restart of the daemon"
+                           .format(key))
+            setattr(new_args, key, getattr(config_args, key))
+    return new_args
+
+
+def remove_progress(progress_file):
+    """Delete the progression of a job, if any
+    """
+    try:
+        os.remove(progress_file)
+    except OSError:
+        pass
+
+
+def write_atomic(path, text):
+    """Replace the content of a file in one step
+    """
+    handle, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix="." + os.path.basename(path))
+    with os.fdopen(handle, "wt") as tmp_file:
+        tmp_file.write(text)
+    # Readable by shaman like a file opened normally
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def introspect(workers, limiter=None):
+    """State of the threads and of the jobs of the daemon
+      Returns: A dict that json can write
+    """
+    now = time.time()
+    frames = sys._current_frames()
+    with workers.lock:
+        running = dict(workers.running)
+        jobs = list(workers.jobs.values())
+    calls = limiter.snapshot() if limiter else {}
+    threads = []
+    for thread in list_threads():
+        state = {"name": thread.name}
+        if thread.ident in running:
+            stage, djinn = running[thread.ident]
+            state["job"] = djinn.data_task["name"]
+            state["stage"] = stage
+            state["phase"] = djinn.phase
+            if djinn.phase_start:
+                state["phase_time"] = round(now - djinn.phase_start, 1)
+        if thread.ident in calls:
+            state["galaxy_call"] = calls[thread.ident]
+        if thread.ident in frames:
+            state["stack"] = [line.rstrip("\n") for line in
+                              traceback.format_stack(frames[thread.ident])]
+        threads.append(state)
+    job_states = []
+    for djinn in jobs:
+        job = {"name": djinn.data_task["name"], "phase": djinn.phase,
+               "cancelled": djinn.cancelled.is_set()}
+        if djinn.phase_start:
+            job["phase_time"] = round(now - djinn.phase_start, 1)
+        job_states.append(job)
+    return {"date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "threads": threads, "jobs": job_states}
+
+
+def format_introspection(state):
+    """Text of the introspection, one block by thread
+    """
+    lines = ["Introspection of {0}, {1} jobs".format(state["date"],
+                                                    len(state["jobs"]))]
+    for job in state["jobs"]:
+        lines.append("  {0}: {1} for {2} s{3}".format(
+            job["name"], job["phase"], job.get("phase_time", 0),
+            " (cancelled)" if job["cancelled"] else ""))
+    for thread in state["threads"]:
+        lines.append("")
+        title = "Thread {0}".format(thread["name"])
+        if "job" in thread:
+            title += ": {0} of {1}, {2} for {3} s".format(
+                thread["stage"], thread["job"], thread["phase"],
+                thread.get("phase_time", 0))
+        lines.append(title)
+        call = thread.get("galaxy_call")
+        if call and call["running"]:
+            lines.append("  galaxy {0} running for {1} s".format(
+                call["method"], call["seconds"]))
+        elif call:
+            lines.append("  galaxy {0} took {1} s, {2} s ago".format(
+                call["method"], call["seconds"], call["ago"]))
+        lines += thread.get("stack", [])
+    return "\n".join(lines) + "\n"
+
+
+def pandaemonium(path_log, galaxy_url, galaxy_key, work_dir, https_mode, 
+                 delete_mode, options, args=None):
+    """Daemon function that should do something
+    """
+    todo_dir = work_dir + os.sep + "todo" + os.sep
+    doing_dir = work_dir + os.sep + "doing" + os.sep
+    done_dir = work_dir + os.sep + "done" + os.sep
     error_dir = work_dir + os.sep + "error" + os.sep
     todo_list = []
     num_job = 0
@@ -1063,21 +4978,207 @@ def pandaemonium(path_log, galaxy_url, galaxy_key, work_dir, https_mode,
     logger.info("Let's start to work")
     # Create important dir
     create_dir([todo_dir, doing_dir, done_dir, error_dir])
+    # Start the stage workers
+    workers = pipeline(logger, options["pool_sizes"])
+    # Progression of the jobs polled by shaman
+    board = progress_board(host=options["node"])
+    board_file = doing_dir + "progress.json"
+    # Results of the previous jobs
+    cache = None
+    if options["cache_size"] > 0:
+        cache_dir = work_dir + os.sep + "cache" + os.sep
+        create_dir([cache_dir])
+        cache = result_cache(cache_dir, options["cache_size"])
+    # Galaxy calls and upload bandwidth shared by the jobs
+    limiter = rate_limiter(*options["rates"])
+    share = bandwidth_share(options["bandwidth"], options["mail_weights"])
+    # Raw reads gzipped while they are sent
+    compressor = None
+    if options["compress_threads"] > 0:
+        compressor = block_compressor(options["compress_threads"])
+    # Purge what the jobs leave in galaxy
+    janitor = None
+    if options["janitor"]:
+        janitor = galaxy_janitor(logger, galaxy_url, galaxy_key, https_mode,
+                                 work_dir + os.sep + "janitor_{0}.json"
+                                 .format(options["node"]),
+                                 options["retention"], options["grace_time"],
+                                 options["janitor_time"], doing_dir, limiter,
+                                 options["node"], [done_dir, error_dir])
+        janitor.start()
+    # Setup and report shared by the tasks of a batch file
+    batches = task_batches(logger, done_dir, janitor)
+    # Expected durations to run the shortest jobs first
+    model = runtime_model(logger, work_dir + os.sep + "timings.json")
+    # Keep in todo the jobs that would fail for lack of resources
+    admission = admission_control(logger, galaxy_url, galaxy_key, https_mode,
+                                  done_dir, options["result_size"],
+                                  options["max_quota"],
+                                  options["max_galaxy_jobs"],
+                                  limiter=limiter)
+    # Submission without waiting for the next check of todo
+    wake = Event()
+    api_port = options["api_port"]
+    if api_port and not options["api_socket"]:
+        # Open to every local user, who must not delete or send any file
+        if delete_mode or not options["input_root"]:
+            logger.error("Submission api disabled, the local port needs "
+                         "--input_root and no -d, see --api_socket")
+            api_port = 0
+    if api_port or options["api_socket"]:
+        api = submission_api(logger,
+                             [todo_dir, doing_dir, done_dir, error_dir],
+                             board, workers, wake, api_port,
+                             options["api_socket"], limiter,
+                             options["input_root"])
+        api.start()
+    # Stop on SIGTERM once the jobs are handed off
+    drain = Event()
+    if current_thread() is main_thread():
+        def terminate(signum, frame):
+            drain.set()
+            wake.set()
+        signal.signal(signal.SIGTERM, terminate)
+    # Stacks of the threads and state of the jobs on SIGUSR1
+    introspect_file = work_dir + os.sep + "introspect_{0}.txt".format(
+        options["node"])
+    def dump_introspection():
+        try:
+            write_atomic(introspect_file, format_introspection(
+                introspect(workers, limiter)))
+            logger.info("Introspection written in {0}".format(
+                introspect_file))
+        except:
+            logger.error("Failed to write {0}".format(introspect_file))
+            logger.error(sys.exc_info()[1])
+    if current_thread() is main_thread():
+        def user_signal(signum, frame):
+            # Not in the main thread, which may hold the locks
+            dumper = Thread(target=dump_introspection, name="introspect")
+            dumper.daemon = True
+            dumper.start()
+        signal.signal(signal.SIGUSR1, user_signal)
+    profiler = None
+    if options["profile_rate"] > 0:
+        profiler = stack_sampler(logger, work_dir + os.sep +
+                                 "profile_{0}.folded".format(options["node"]),
+                                 options["profile_rate"])
+        profiler.start()
+    # Options tuned live with the config file, reloaded on SIGHUP
+    reload = Event()
+    config_args = args
+    if args and args.config:
+        config_args = read_config(args)
+        if current_thread() is main_thread():
+            def hangup(signum, frame):
+                reload.set()
+                wake.set()
+            signal.signal(signal.SIGHUP, hangup)
+    # Claim of the jobs shared with the other daemons
+    leases = lease_manager(logger, doing_dir, options["node"],
+                           options["lease_time"])
+    leases.start()
     # Start daemon activity
-    while True:
+    while not drain.is_set():
+        if reload.is_set():
+            reload.clear()
+            new_args = reload_config(logger, args, config_args)
+            if new_args:
+                # The running jobs keep their galaxy and their options
+                config_args = new_args
+                galaxy_url = config_args.galaxy_url
+                galaxy_key = config_args.galaxy_key
+                https_mode = config_args.https_mode
+                delete_mode = config_args.delete_mode
+                if api_port and not options["api_socket"] and delete_mode:
+                    logger.warning("Option delete_mode needs a restart of "
+                                   "the daemon without the api port")
+                    delete_mode = False
+                options = get_options(config_args)
+                workers.resize(options["pool_sizes"])
+                limiter.configure(*options["rates"])
+                share.configure(options["bandwidth"], options["mail_weights"])
+                if janitor:
+                    janitor.configure(galaxy_url, galaxy_key, https_mode,
+                                      options["retention"],
+                                      options["grace_time"],
+                                      options["janitor_time"])
+                admission.configure(galaxy_url, galaxy_key, https_mode,
+                                    options["result_size"],
+                                    options["max_quota"],
+                                    options["max_galaxy_jobs"])
+                logger.info("Config {0} reloaded".format(args.config))
         todo_list = check_work(todo_dir)
         if len(todo_list) > 0:
             logger.info("I have a new job todo")
             for task in todo_list: 
-                #todo_file = doing_dir + os.path.basename(task)
-                #shutil.move(task, todo_file)  
+                if drain.is_set():
+                    break
+                # The tasks of a batch are claimed on the next check
+                if split_batch(logger, task, leases):
+                    wake.set()
+                    continue
+                if held(logger, task, admission):
+                    continue
                 djinn = galaxy(logger, task, doing_dir, done_dir,
                                error_dir, galaxy_url, galaxy_key, num_job,
-                               https_mode, delete_mode)
-                djinn.start()
-                logger.info("task on {0} started".format(task))
+                               https_mode, delete_mode, options, board,
+                               cache, janitor, admission, model, leases,
+                               limiter, share, batches, compressor)
+                # Claim the task before the next check of todo
+                try:
+                    prepared = djinn.prepare()
+                except:
+                    logger.error("Failed to prepare {0}".format(task))
+                    logger.error(traceback.format_exc())
+                    djinn.discard(sys.exc_info()[1])
+                    continue
+                if prepared:
+                    workers.submit(djinn)
+                    logger.info("task on {0} started".format(task))
+                    num_job += 1
+        # Jobs of the daemons which stopped renewing their lease
+        for task in check_work(doing_dir):
+            if drain.is_set():
+                break
+            name = os.path.splitext(os.path.basename(task))[0]
+            with leases.lock:
+                if name in leases.jobs:
+                    continue
+            if not leases.expired(leases.lease_file(name)):
+                continue
+            djinn = galaxy(logger, task, doing_dir, done_dir, error_dir,
+                           galaxy_url, galaxy_key, num_job, https_mode,
+                           delete_mode, options, board, cache, janitor,
+                           admission, model, leases, limiter, share,
+                           batches, compressor)
+            try:
+                stage = djinn.resume()
+            except:
+                logger.error("Failed to take over {0}".format(task))
+                logger.error(sys.exc_info()[1])
+                djinn.release_lease(name)
+                continue
+            if stage:
+                workers.submit(djinn, stage)
+                logger.info("task on {0} resumed at {1}".format(task, stage))
                 num_job += 1
-        time.sleep(5)        
+        supervise(workers, doing_dir, options["deadlines"])
+        board.dump(board_file)
+        wake.wait(options["loop_time"])
+        wake.clear()        
+    logger.info("Stop claiming jobs, drain the pipeline")
+    if workers.drain(options["drain_time"]):
+        logger.info("All the jobs are finished or checkpointed")
+    # The other daemons take over at once
+    with leases.lock:
+        names = list(leases.jobs)
+    for name in names:
+        leases.release(name)
+    board.dump(board_file)
+    if profiler:
+        profiler.write()
+    logger.info("Daemon stopped")
         
 
 
@@ -1085,6 +5186,9 @@ def main():
     """Main program
     """
     args = getArguments()
+    config_args = args
+    if args.config:
+        config_args = read_config(args)
     now = datetime.datetime.now()
     # Check if root
     if os.geteuid() != 0:
@@ -1098,11 +5202,12 @@ def main():
     with daemon.DaemonContext(working_directory=os.curdir,
                               pidfile=lockfile.FileLock(path_log),
                               stdout=sys.stdout, stderr=sys.stderr,
-                              detach_process=args.interactive_mode):
+                              detach_process=config_args.interactive_mode):
         print("PID: {0}".format(os.getpid()))
         print("Path to log file: {0}".format(path_log))
-        pandaemonium(path_log, args.galaxy_url, args.galaxy_key, args.work_dir,
-                     args.https_mode, args.delete_mode)
+        pandaemonium(path_log, config_args.galaxy_url, config_args.galaxy_key,
+                     config_args.work_dir, config_args.https_mode,
+                     config_args.delete_mode, get_options(config_args), args)
 
 
 if __name__ == '__main__':
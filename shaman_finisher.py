@@ -91,13 +91,16 @@ class galaxy:
         self.gi = GalaxyInstance(url=self.galaxy_url, key=self.galaxy_key)
         self.gi.verify = False
 
-    def zip_archive(self, list_downloaded_files, zip_file):
+    def zip_archive(self, list_downloaded_files, zip_file, root=None):
         """Extract tar file and build a clean zip file
         """
         #try:
         with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for file in list_downloaded_files:
-                zipf.write(file, os.path.basename(file))
+                if root:
+                    zipf.write(file, os.path.relpath(file, root))
+                else:
+                    zipf.write(file, os.path.basename(file))
         #except IOError:
         #    self.logger.error("Error cannot open {0}".format(zip_file))
 
@@ -174,13 +177,15 @@ class galaxy:
         self.data_task = self.load_json()
         data_history = self.gi.histories.get_histories(name=self.data_task['data_history_name'])[0]
         print(data_history)
-        result_history = self.gi.histories.get_histories(name=self.data_task['result_history_name'])[0]
-        print(result_history)
-        # Load json data
-        
         # Output
         zip_file = self.done_dir + os.sep + "shaman_" + self.data_task["name"].replace("file", "") + ".zip"
         result_dir = self.done_dir + os.sep + self.data_task["name"] + os.sep
+        # One result history per set of parameters of a sweep
+        runs = [(self.data_task['result_history_name'], result_dir)]
+        if "sweep" in self.data_task:
+            runs = [(self.data_task['result_history_name'] + "_" + str(index),
+                     result_dir + "run_{0}".format(index) + os.sep)
+                    for index in range(len(self.data_task["sweep"]))]
         # Expected result files
         list_result['fasta'] = ["shaman_otu"]
         list_result['tsv'] = ["shaman_rdp_annotation", "shaman_otu_table",
@@ -195,13 +200,29 @@ class galaxy:
         list_result['tsv'] += [i + "_annotation"  for i in list_result['biom']]
         list_result['nhx'] = [i + "_tree"  for i in list_result['biom']]
         # Download results
-        download_success, list_downloaded_files = self.download_result(
-                                result_history['id'], list_result,
-                                result_dir)
+        download_success = False
+        list_downloaded_files = []
+        result_histories = []
+        for result_history_name, run_dir in runs:
+            histories = self.gi.histories.get_histories(name=result_history_name)
+            if len(histories) == 0:
+                print("History {0} is missing".format(result_history_name),
+                      file=sys.stderr)
+                continue
+            result_history = histories[0]
+            print(result_history)
+            result_histories.append(result_history)
+            if not os.path.isdir(result_dir):
+                os.mkdir(result_dir)
+            run_success, run_files = self.download_result(
+                                    result_history['id'], list_result,
+                                    run_dir)
+            download_success = download_success or run_success
+            list_downloaded_files += run_files
         #if os.path.isfile(result_file) and download_success:
         if download_success:
             # Prepare zip
-            self.zip_archive(list_downloaded_files, zip_file)
+            self.zip_archive(list_downloaded_files, zip_file, result_dir)
             if len(self.message) > 0:
                 self.send_mail(zip_file)
             shutil.move(self.task_file, self.done_dir + 
@@ -209,7 +230,8 @@ class galaxy:
             # Delete_history
             if self.clear_history:
                 self.gi.histories.delete_history(data_history['id'], purge=True)
-                self.gi.histories.delete_history(result_history['id'], purge=True)
+                for result_history in result_histories:
+                    self.gi.histories.delete_history(result_history['id'], purge=True)
 
 
 def isdir(path):
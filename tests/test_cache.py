@@ -0,0 +1,71 @@
+"""Archives of the previous jobs kept in the result cache
+"""
+import os
+import time
+
+import pytest
+
+pytest.importorskip("bioblend")
+pytest.importorskip("daemon")
+pytest.importorskip("lockfile")
+
+import shaman_bioblend
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    return shaman_bioblend.result_cache(str(cache_dir) + os.sep, 250)
+
+
+def archive(tmp_path, name, size=100):
+    path = tmp_path / name
+    path.write_bytes(name.encode().ljust(size, b"0"))
+    return str(path)
+
+
+def put(cache, tmp_path, key, age):
+    cache.put(key, archive(tmp_path, key + ".zip"))
+    past = time.time() - age
+    os.utime(cache.cache_dir + key + ".zip", (past, past))
+
+
+def test_oldest_archive_is_evicted(cache, tmp_path):
+    put(cache, tmp_path, "a", 30)
+    put(cache, tmp_path, "b", 20)
+    put(cache, tmp_path, "c", 10)
+    assert sorted(os.listdir(cache.cache_dir)) == ["b.zip", "c.zip"]
+
+
+def test_hit_copies_the_archive(cache, tmp_path):
+    put(cache, tmp_path, "a", 0)
+    zip_file = str(tmp_path / "shaman_job.zip")
+    assert cache.get("a", zip_file)
+    with open(zip_file, "rb") as copy:
+        assert copy.read().startswith(b"a.zip")
+    assert [name for name in os.listdir(str(tmp_path))
+            if name.startswith("shaman_job.zip.")] == []
+
+
+def test_hit_survives_the_eviction(cache, tmp_path):
+    put(cache, tmp_path, "a", 30)
+    put(cache, tmp_path, "b", 20)
+    zip_file = str(tmp_path / "shaman_job.zip")
+    # Recently used, b is evicted instead
+    assert cache.get("a", zip_file)
+    put(cache, tmp_path, "c", 10)
+    assert sorted(os.listdir(cache.cache_dir)) == ["a.zip", "c.zip"]
+    # The copy of the job does not depend on the cache
+    os.remove(cache.cache_dir + "a.zip")
+    with open(zip_file, "rb") as copy:
+        assert copy.read().startswith(b"a.zip")
+
+
+def test_evicted_archive_is_a_miss(cache, tmp_path):
+    put(cache, tmp_path, "a", 30)
+    put(cache, tmp_path, "b", 20)
+    put(cache, tmp_path, "c", 10)
+    zip_file = str(tmp_path / "shaman_job.zip")
+    assert not cache.get("a", zip_file)
+    assert not os.path.exists(zip_file)
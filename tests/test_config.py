@@ -0,0 +1,87 @@
+"""Options read from the config file
+"""
+import json
+import logging
+import os
+
+import pytest
+
+pytest.importorskip("bioblend")
+pytest.importorskip("daemon")
+pytest.importorskip("lockfile")
+
+import shaman_bioblend
+
+
+@pytest.fixture
+def args(tmp_path):
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    args = shaman_bioblend.get_parser().parse_args(["-w", str(work_dir)])
+    args.config = str(tmp_path / "config.json")
+    return args
+
+
+def read(args, config):
+    with open(args.config, "wt") as config_file:
+        json.dump(config, config_file)
+    return shaman_bioblend.read_config(args)
+
+
+def test_values_are_converted(args):
+    config_args = read(args, {"execute_workers": 20, "grace_time": 2,
+                              "summary": True, "columnar": "npz",
+                              "mail_weight": ["a@b.fr=2"]})
+    assert config_args.execute_workers == 20
+    assert isinstance(config_args.grace_time, float)
+    assert config_args.summary is True
+    assert config_args.columnar == "npz"
+    assert config_args.mail_weight == ["a@b.fr=2"]
+    # The command line is kept
+    assert args.execute_workers == 10
+
+
+@pytest.mark.parametrize("config", [
+    {"columnar": "parquet"},
+    {"api_socket": 5},
+    {"api_port": 1.5},
+    {"api_port": True},
+    {"summary": 1},
+    {"retention": None},
+    {"mail_weight": "a@b.fr=2"},
+    {"work_dir": "/nonexistent/shaman"},
+    {"unknown": 1},
+    {"config": "other.json"},
+])
+def test_wrong_values_are_refused(args, config):
+    with pytest.raises(ValueError):
+        read(args, config)
+
+
+def test_null_only_for_an_option_without_default(args):
+    assert read(args, {"columnar": None}).columnar is None
+
+
+def test_work_dir_is_expanded(args, tmp_path):
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    assert read(args, {"work_dir": str(other_dir)}).work_dir == (
+        str(other_dir) + os.sep)
+
+
+def test_reload_keeps_the_fixed_options(args):
+    config_args = read(args, {"cache_size": 10.0, "execute_workers": 4})
+    with open(args.config, "wt") as config_file:
+        json.dump({"cache_size": 20.0, "execute_workers": 8}, config_file)
+    new_args = shaman_bioblend.reload_config(logging.getLogger("test"),
+                                             args, config_args)
+    assert new_args.cache_size == 10.0
+    assert new_args.execute_workers == 8
+
+
+def test_wrong_reload_is_ignored(args):
+    config_args = read(args, {"execute_workers": 4})
+    with open(args.config, "wt") as config_file:
+        json.dump({"columnar": "parquet"}, config_file)
+    assert shaman_bioblend.reload_config(logging.getLogger("test"), args,
+                                         config_args) is None
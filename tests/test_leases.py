@@ -0,0 +1,85 @@
+"""Leases of the jobs shared by the daemons of a work directory
+"""
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("bioblend")
+pytest.importorskip("daemon")
+pytest.importorskip("lockfile")
+
+import shaman_bioblend
+
+
+class claimed_job(object):
+    """Job cancelled by the lease manager when its lease is lost
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.cleanup = None
+
+    def cancel(self, reason, mail=False, cleanup=True):
+        self.cleanup = cleanup
+        self.cancelled.set()
+
+
+@pytest.fixture
+def doing_dir(tmp_path):
+    return str(tmp_path) + os.sep
+
+
+def leases(doing_dir, node):
+    return shaman_bioblend.lease_manager(logging.getLogger("test"),
+                                         doing_dir, node, lease_time=60)
+
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_lease_is_exclusive(doing_dir):
+    first, second = leases(doing_dir, "a"), leases(doing_dir, "b")
+    assert first.acquire("job")
+    assert not second.acquire("job")
+    assert first.read_owner(first.lease_file("job")) == first.owner
+    # No temporary file left
+    assert os.listdir(doing_dir) == ["job.lease"]
+
+
+def test_released_lease_is_free(doing_dir):
+    first, second = leases(doing_dir, "a"), leases(doing_dir, "b")
+    assert first.acquire("job")
+    second.release("job")
+    assert os.path.isfile(first.lease_file("job"))
+    first.release("job")
+    assert second.acquire("job")
+
+
+def test_expired_lease_is_taken_over(doing_dir):
+    first, second = leases(doing_dir, "a"), leases(doing_dir, "b")
+    job = claimed_job()
+    assert first.acquire("job", job)
+    age(first.lease_file("job"), 120)
+    assert second.acquire("job")
+    assert second.read_owner(second.lease_file("job")) == second.owner
+    # The old owner stops the job and leaves galaxy to the new one
+    first.renew()
+    assert job.cancelled.is_set()
+    assert job.cleanup is False
+    assert "job" not in first.jobs
+
+
+def test_renewal_keeps_the_lease(doing_dir):
+    first, second = leases(doing_dir, "a"), leases(doing_dir, "b")
+    job = claimed_job()
+    assert first.acquire("job", job)
+    age(first.lease_file("job"), 50)
+    first.renew()
+    assert not job.cancelled.is_set()
+    assert not second.expired(second.lease_file("job"))
+    assert not second.acquire("job")
@@ -0,0 +1,105 @@
+"""Stages of the jobs, drain on stop and progression files
+"""
+import logging
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("bioblend")
+pytest.importorskip("daemon")
+pytest.importorskip("lockfile")
+
+import shaman_bioblend
+
+
+class staged_job(object):
+    """Job whose workflow runs until it is checkpointed
+    """
+
+    def __init__(self, name):
+        self.data_task = {"name": name}
+        self.task_file = name + ".json"
+        self.priority = 0.0
+        self.phase = None
+        self.resumed = False
+        self.cancelled = threading.Event()
+        self.running = threading.Event()
+        self.stages = []
+        self.checkpointed = False
+        self.aborted = False
+        self.released = False
+
+    def pause(self):
+        pass
+
+    def checkpoint(self):
+        self.checkpointed = True
+        self.cancelled.set()
+
+    def abort(self):
+        self.aborted = True
+
+    def release_lease(self, name=None):
+        self.released = True
+
+    def upload(self):
+        self.stages.append("upload")
+        return True
+
+    def execute(self):
+        self.stages.append("execute")
+        self.phase = "workflow"
+        self.running.set()
+        self.cancelled.wait(10)
+        return not self.cancelled.is_set()
+
+    def download(self):
+        self.stages.append("download")
+        return True
+
+
+@pytest.fixture
+def workers():
+    return shaman_bioblend.pipeline(logging.getLogger("test"), {})
+
+
+def test_drain_checkpoints_the_running_workflow(workers):
+    job = staged_job("job")
+    workers.submit(job)
+    assert job.running.wait(5)
+    assert workers.drain(5)
+    assert job.checkpointed
+    assert job.stages == ["upload", "execute"]
+    assert job.aborted and job.released
+    assert workers.jobs == {}
+
+
+def test_drain_hands_off_the_uploads(workers):
+    workers.draining.set()
+    job = staged_job("job")
+    workers.submit(job)
+    assert workers.drain(5)
+    assert job.checkpointed
+    assert job.stages == []
+
+
+def test_progress_file_removed_on_failure(tmp_path):
+    progress_file = str(tmp_path / "job_progress.txt")
+    progress = shaman_bioblend.progress_model(progress_file, "job")
+    progress.update("upload", 0.5)
+    assert os.path.isfile(progress_file)
+    progress.finish("error")
+    assert not os.path.exists(progress_file)
+    # Not written again by a stage still running
+    progress.update("upload", 1.0)
+    assert not os.path.exists(progress_file)
+
+
+def test_progress_file_kept_for_the_next_daemon(tmp_path):
+    progress_file = str(tmp_path / "job_progress.txt")
+    progress = shaman_bioblend.progress_model(progress_file, "job")
+    progress.update("upload", 0.5)
+    progress.finish("moved")
+    with open(progress_file) as progression:
+        assert float(progression.read()) == 10.0
@@ -0,0 +1,107 @@
+"""Streamed upload bodies of the fetch requests
+"""
+import gzip
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+pytest.importorskip("bioblend")
+pytest.importorskip("daemon")
+pytest.importorskip("lockfile")
+requests = pytest.importorskip("requests")
+
+import shaman_bioblend
+
+
+class recording_handler(BaseHTTPRequestHandler):
+    """Keep the headers and the body of the last request
+    """
+    received = {}
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length",
+                                                        0)))
+        self.received["headers"] = dict(self.headers)
+        self.received["body"] = body
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(("127.0.0.1", 0), recording_handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def fastq(tmp_path):
+    path = tmp_path / "sample_R1.fastq"
+    path.write_bytes(b"".join(b"@read%d\nACGTACGTAC\n+\nIIIIIIIIII\n" % i
+                              for i in range(20000)))
+    return str(path)
+
+
+def post(server, body):
+    requests.post("http://127.0.0.1:{0}/".format(server.server_port),
+                  data=body, headers={"Content-Type": body.content_type()})
+    return recording_handler.received
+
+
+def file_part(body, received):
+    """Content of the only file of a multipart body
+    """
+    boundary = ("--" + body.boundary).encode()
+    for part in received["body"].split(boundary):
+        if b"filename=" in part:
+            return part.split(b"\r\n\r\n", 1)[1][:-2]
+    return None
+
+
+def test_block_compressor_is_readable_by_gzip(fastq):
+    compressor = shaman_bioblend.block_compressor(2)
+    data = b"".join(compressor.stream(fastq))
+    with open(fastq, "rb") as raw:
+        assert gzip.decompress(data) == raw.read()
+    assert data.endswith(shaman_bioblend.block_compressor.eof_block)
+
+
+def test_plain_body_has_its_length(server, fastq):
+    body = shaman_bioblend.multipart_body([("history_id", "h1")],
+                                          [("files_0|file_data", fastq)])
+    received = post(server, body)
+    assert int(received["headers"]["Content-Length"]) == body.length
+    assert len(received["body"]) == body.length
+    with open(fastq, "rb") as raw:
+        assert file_part(body, received) == raw.read()
+
+
+def test_compressed_body_is_sent_chunked(server, fastq):
+    body = shaman_bioblend.multipart_body(
+        [("history_id", "h1")], [("files_0|file_data", fastq)],
+        compressor=shaman_bioblend.block_compressor(2))
+    received = post(server, body)
+    assert received["headers"].get("Transfer-Encoding") == "chunked"
+    assert b'filename="sample_R1.fastq.gz"' in received["body"]
+    with open(fastq, "rb") as raw:
+        assert gzip.decompress(file_part(body, received)) == raw.read()